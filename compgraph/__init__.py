@@ -0,0 +1 @@
+from .graph import Graph  # noqa: F401
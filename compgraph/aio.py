@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import contextlib
+import itertools
+import threading
+import typing as tp
+from concurrent import futures
+
+from .mappers import AsyncMapper, Operation, TRowsGenerator, TRowsIterable
+
+TRow = dict[str, tp.Any]
+
+ASYNC_BATCH_ROWS = 256
+ASYNC_QUEUE_BATCHES = 8
+
+_END = object()
+
+
+class _Loop(threading.local):
+    """Event loop which runs graph in current thread, None outside of run_async"""
+    loop: asyncio.AbstractEventLoop | None = None
+
+
+running_loop = _Loop()
+
+
+async def _next_batch(rows: tp.AsyncIterator[TRow], size: int) -> tp.List[TRow]:
+    batch = []
+    async for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            break
+    return batch
+
+
+def blocking_rows(rows: tp.AsyncIterable[TRow], loop: asyncio.AbstractEventLoop,
+                  batch_size: int = ASYNC_BATCH_ROWS) -> tp.Generator[TRow, None, None]:
+    """Rows of async iterable for a thread other than the one running loop: rows are pulled
+    by loop in batches of batch_size, so the loop stays free between the pulls"""
+    iterator = rows.__aiter__()
+    while True:
+        batch = asyncio.run_coroutine_threadsafe(_next_batch(iterator, batch_size), loop).result()
+        yield from batch
+        if len(batch) < batch_size:
+            return
+
+
+def _is_async(source: tp.Any) -> bool:
+    return hasattr(source, '__aiter__')
+
+
+def blocking_source(source: tp.Any, loop: asyncio.AbstractEventLoop) -> tp.Any:
+    """Source passed to Graph.run made of a source passed to Graph.run_async.
+    Async iterables and factories returning them become factories of blocking iterators,
+    other sources are returned as they are."""
+    if _is_async(source):
+        return lambda: blocking_rows(source, loop)
+    if not callable(source):
+        return source
+
+    def factory(*args: tp.Any, **kwargs: tp.Any) -> tp.Any:
+        rows = source(*args, **kwargs)
+        return blocking_rows(rows, loop) if _is_async(rows) else rows
+
+    return factory
+
+
+def _produce(rows: tp.Callable[[], tp.Iterable[TRow]], loop: asyncio.AbstractEventLoop,
+             queue: asyncio.Queue[tp.Any], stop: threading.Event) -> None:
+    """Run graph in current thread and put batches of its rows to queue, then _END or the error"""
+    running_loop.loop = loop
+    result: tp.Any = _END
+    iterator: tp.Iterator[TRow] = iter(())
+    try:
+        iterator = iter(rows())
+        while not stop.is_set():
+            batch = list(itertools.islice(iterator, ASYNC_BATCH_ROWS))
+            if not batch:
+                break
+            asyncio.run_coroutine_threadsafe(queue.put(batch), loop).result()
+    except BaseException as exc:
+        result = exc
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+        running_loop.loop = None
+    if not stop.is_set():
+        asyncio.run_coroutine_threadsafe(queue.put(result), loop).result()
+
+
+async def run_in_thread(rows: tp.Callable[[], tp.Iterable[TRow]]) -> tp.AsyncGenerator[TRow, None]:
+    """Async generator of rows of a blocking row stream: the stream is pulled in a thread of the default
+    executor, at most ASYNC_QUEUE_BATCHES batches of rows are kept waiting for the consumer.
+    :param rows: factory of the stream, called in the thread
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue[tp.Any] = asyncio.Queue(maxsize=ASYNC_QUEUE_BATCHES)
+    stop = threading.Event()
+    producer = loop.run_in_executor(None, _produce, rows, loop, queue, stop)
+    try:
+        while True:
+            item = await queue.get()
+            if item is _END:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            for row in item:
+                yield row
+    finally:
+        stop.set()
+        while not producer.done():
+            while not queue.empty():
+                queue.get_nowait()
+            await asyncio.wait([producer], timeout=0.01)
+        await producer
+
+
+async def _cancel_tasks() -> None:
+    current = asyncio.current_task()
+    tasks = [task for task in asyncio.all_tasks() if task is not current]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@contextlib.contextmanager
+def event_loop() -> tp.Iterator[asyncio.AbstractEventLoop]:
+    """Loop to run coroutines of current thread on: the loop of run_async running the graph,
+    otherwise a private loop in a background thread, stopped with its tasks cancelled on exit"""
+    if running_loop.loop is not None:
+        yield running_loop.loop
+        return
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name='compgraph_event_loop', daemon=True)
+    thread.start()
+    try:
+        yield loop
+    finally:
+        asyncio.run_coroutine_threadsafe(_cancel_tasks(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+class AsyncMap(Operation):
+    """
+    Map with async mapper: up to mapper.concurrency rows are being mapped at the same time on an event loop,
+    so waits of a row (e.g. for a service response) overlap with waits of others. With ordered mapper
+    rows follow in the same order as of Map, otherwise rows are yielded as soon as they are done.
+    Inside Graph.run_async coroutines run on its event loop, otherwise on a private loop.
+    """
+
+    def __init__(self, mapper: AsyncMapper) -> None:
+        """
+        :param mapper: mapper to use
+        """
+        self.mapper = mapper
+
+    def ordered_by(self, keys: tp.Sequence[str]) -> tp.Tuple[str, ...]:
+        """Sortedness of output rows, see Mapper.ordered_by"""
+        return self.mapper.ordered_by(keys) if self.mapper.ordered else ()
+
+    def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
+        mapper = self.mapper
+        in_flight: tp.Deque[futures.Future[tp.List[TRow]]] = collections.deque()
+        with event_loop() as loop:
+            try:
+                for row in itertools.chain(rows, [None]):
+                    if row is not None:
+                        in_flight.append(asyncio.run_coroutine_threadsafe(mapper.map_row(row), loop))
+                        if len(in_flight) < mapper.concurrency:
+                            continue
+                    while in_flight and (row is None or len(in_flight) >= mapper.concurrency):
+                        if mapper.ordered:
+                            done = in_flight.popleft()
+                        else:
+                            done = next(iter(futures.wait(in_flight, return_when=futures.FIRST_COMPLETED).done))
+                            in_flight.remove(done)
+                        yield from done.result()
+            finally:
+                for task in in_flight:
+                    task.cancel()
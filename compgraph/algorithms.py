@@ -1,29 +1,32 @@
 from . import Graph
 from . import operations
-import copy
 
 
 def word_count_graph(input_stream_name: str, text_column: str = 'text', count_column: str = 'count') -> Graph:
-    """Constructs graph which counts words in text_column of all rows passed"""
+    """Constructs graph which counts words in text_column of all rows passed.
+    Words are sorted and counted by their integer codes, see operations.ValueDictionary"""
+    words = operations.ValueDictionary()
     return Graph.graph_from_iter(input_stream_name) \
-        .map(operations.FilterPunctuation(text_column)) \
-        .map(operations.LowerCase(text_column)) \
-        .map(operations.Split(text_column)) \
+        .map(operations.NormalizeText(text_column, dictionary=words)) \
         .sort([text_column]) \
         .reduce(operations.Count(count_column), [text_column]) \
+        .map(operations.DecodeColumn(text_column, words)) \
         .sort([count_column, text_column])
 
 
 def inverted_index_graph(input_stream_name: str, doc_column: str = 'doc_id', text_column: str = 'text',
-                         result_column: str = 'tf_idf') -> Graph:
-    """Constructs graph which calculates tf-idf for every word/document pair"""
+                         result_column: str = 'tf_idf', sort_workers: int = 1) -> Graph:
+    """Constructs graph which calculates tf-idf for every word/document pair.
+    Words are sorted, grouped and joined by their integer codes (see operations.ValueDictionary),
+    top rows of every word are decoded and sorted by words at the end
+    :param sort_workers: number of processes used by every sort
+    """
 
     graph = Graph.graph_from_iter(input_stream_name)
+    words = operations.ValueDictionary()
 
-    split_word = copy.deepcopy(graph) \
-        .map(operations.LowerCase(text_column)) \
-        .map(operations.FilterPunctuation(text_column)) \
-        .map(operations.Split(text_column))
+    split_word = graph \
+        .map(operations.NormalizeText(text_column, dictionary=words))
 
     total_docs_column = 'total_number_docs'
     count_docs = graph.reduce(operations.Count(total_docs_column), [])
@@ -34,38 +37,43 @@ def inverted_index_graph(input_stream_name: str, doc_column: str = 'doc_id', tex
         """Функция для вычисления IDF"""
         return operations.log(row[total_docs_column]) - operations.log(row[docs_column])
 
-    count_idf = copy.deepcopy(split_word) \
-        .sort([doc_column, text_column]) \
+    count_idf = split_word \
+        .sort([doc_column, text_column], workers=sort_workers) \
         .reduce(operations.FirstReducer(), [doc_column, text_column]) \
-        .sort([text_column]) \
+        .sort([text_column], workers=sort_workers) \
         .reduce(operations.Count(docs_word_present), [text_column]) \
         .join(operations.InnerJoiner(), count_docs, []) \
         .map(
         operations.Calculate(idf_operation, {'total_docs_column': total_docs_column, 'docs_column': docs_word_present},
                              'idf')) \
-        .sort([text_column])
+        .sort([text_column], workers=sort_workers)
 
-    tf = split_word.sort([doc_column]) \
+    tf = split_word.sort([doc_column], workers=sort_workers) \
         .reduce(operations.TermFrequency(text_column), [doc_column]) \
-        .sort([text_column])
+        .sort([text_column], workers=sort_workers)
 
     return tf.join(operations.InnerJoiner(), count_idf, [text_column]) \
         .map(operations.Product(['tf', 'idf'], result_column)) \
-        .sort([text_column]) \
+        .sort([text_column], workers=sort_workers) \
         .map(operations.Project([text_column, doc_column, result_column])) \
-        .reduce(operations.TopN(result_column, 3), [text_column])
+        .reduce(operations.TopN(result_column, 3), [text_column]) \
+        .map(operations.DecodeColumn(text_column, words)) \
+        .sort([text_column], workers=sort_workers)
 
 
 def pmi_graph(input_stream_name: str, doc_column: str = 'doc_id', text_column: str = 'text',
-              result_column: str = 'pmi') -> Graph:
-    """Constructs graph which gives for every document the top 10 words ranked by pointwise mutual information"""
+              result_column: str = 'pmi', sort_workers: int = 1) -> Graph:
+    """Constructs graph which gives for every document the top 10 words ranked by pointwise mutual information.
+    Tokens are sorted, grouped and joined by integer codes of words (see operations.ValueDictionary),
+    words are decoded in the reduced rows before the sorts which define the order of the result
+    :param sort_workers: number of processes used by every sort
+    """
     graph = Graph.graph_from_iter(input_stream_name)
+    words = operations.ValueDictionary()
 
-    split_word = copy.deepcopy(graph) \
-        .map(operations.LowerCase(text_column)) \
-        .map(operations.FilterPunctuation(text_column)) \
-        .map(operations.Split(text_column)) \
-        .sort([doc_column, text_column])
+    split_word = graph \
+        .map(operations.NormalizeText(text_column, dictionary=words)) \
+        .sort([doc_column, text_column], workers=sort_workers)
 
     result_column_count, result_column_tf, tf_total_docs_column = 'count_column', 'tf_all_column', 'tf'
 
@@ -73,21 +81,23 @@ def pmi_graph(input_stream_name: str, doc_column: str = 'doc_id', text_column: s
 
     words_filtered = split_word \
         .join(operations.OuterJoiner(), count_doc_words, [doc_column, text_column]) \
-        .map(operations.Filter(lambda x: (x[result_column_count] >= 2) and (len(x[text_column]) >= 4)))
+        .map(operations.Filter(lambda x: (x[result_column_count] >= 2) and (len(words.decode(x[text_column])) >= 4)))
 
-    tf = words_filtered.sort([doc_column]) \
+    tf = words_filtered.sort([doc_column], workers=sort_workers) \
         .reduce(operations.TermFrequency(text_column), [doc_column]) \
-        .sort([text_column])
+        .map(operations.DecodeColumn(text_column, words)) \
+        .sort([text_column], workers=sort_workers)
 
     all_tf = words_filtered \
         .reduce(operations.TermFrequency(text_column, result_column_tf), []) \
         .map(operations.Project([result_column_tf, text_column])) \
-        .sort([text_column])
+        .map(operations.DecodeColumn(text_column, words)) \
+        .sort([text_column], workers=sort_workers)
 
     return tf \
         .join(operations.OuterJoiner(), all_tf, [text_column]) \
         .map(operations.ReverseFreq(tf_total_docs_column, result_column_tf, result_column)) \
-        .sort([doc_column]) \
+        .sort([doc_column], workers=sort_workers) \
         .map(operations.Project([text_column, doc_column, result_column])) \
         .reduce(operations.TopN(result_column, 10), [doc_column])
 
@@ -96,33 +106,44 @@ def yandex_maps_graph(input_stream_name_time: str, input_stream_name_length: str
                       enter_time_column: str = 'enter_time', leave_time_column: str = 'leave_time',
                       edge_id_column: str = 'edge_id', start_coord_column: str = 'start', end_coord_column: str = 'end',
                       weekday_result_column: str = 'weekday', hour_result_column: str = 'hour',
-                      speed_result_column: str = 'speed') -> Graph:
-    """Constructs graph which measures average speed in km/h depending on the weekday and hour"""
+                      speed_result_column: str = 'speed', columnar: bool = False) -> Graph:
+    """Constructs graph which measures average speed in km/h depending on the weekday and hour
+    :param columnar: run in columnar mode, geo and time functions are computed for whole batches (requires numpy)
+    """
 
     graph_time = Graph.graph_from_iter(input_stream_name_time)
 
     graph_length = Graph.graph_from_iter(input_stream_name_length) \
         .map(operations.Calculate(operations.haversine_distance,
-                                  {'start_coords': start_coord_column, 'end_coords': end_coord_column}, 'distance')) \
-        .sort([edge_id_column])
+                                  {'start_coords': start_coord_column, 'end_coords': end_coord_column}, 'distance',
+                                  vectorized=True))
 
     graph_time_transformed = graph_time \
-        .sort([edge_id_column]) \
+        .map(operations.ParseTimestamp(enter_time_column)) \
+        .map(operations.ParseTimestamp(leave_time_column)) \
         .map(operations.Calculate(operations.road_time,
-                                  {'enter_time': enter_time_column, 'leave_time': leave_time_column}, 'road_time')) \
+                                  {'enter_time': enter_time_column, 'leave_time': leave_time_column}, 'road_time',
+                                  vectorized=True)) \
         .map(operations.Calculate(operations.hour,
-                                  {'datetime_column': enter_time_column}, hour_result_column)) \
+                                  {'datetime_column': enter_time_column}, hour_result_column,
+                                  vectorized=True)) \
         .map(operations.Calculate(operations.weekday,
-                                  {'datetime_column': enter_time_column}, weekday_result_column))
+                                  {'datetime_column': enter_time_column}, weekday_result_column,
+                                  vectorized=True))
 
-    joined_graph = graph_time_transformed.join(operations.InnerJoiner(), graph_length, [edge_id_column])
+    joined_graph = graph_time_transformed.join(operations.InnerJoiner(), graph_length, [edge_id_column],
+                                               hash_join=True)
 
     graph_with_speed = joined_graph \
         .map(operations.Calculate(operations.speed,
-                                  {'distance': 'distance', 'time': 'road_time'}, speed_result_column)) \
+                                  {'distance': 'distance', 'time': 'road_time'}, speed_result_column,
+                                  vectorized=True)) \
         .sort([weekday_result_column, hour_result_column])
 
     result_graph = graph_with_speed.reduce(operations.Average(speed_result_column),
                                            [weekday_result_column, hour_result_column])
 
-    return result_graph.map(operations.Project([weekday_result_column, hour_result_column, speed_result_column]))
+    result_graph = result_graph.map(operations.Project([weekday_result_column, hour_result_column,
+                                                        speed_result_column]))
+    result_graph.columnar = columnar
+    return result_graph
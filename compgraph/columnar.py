@@ -0,0 +1,528 @@
+# mypy: ignore-errors
+
+from __future__ import annotations
+
+import contextlib
+import datetime
+import heapq
+import itertools
+import sys
+import tempfile
+import typing as tp
+from operator import itemgetter
+
+from . import operations as ops
+from .external_sort import ExternalSort, _merge_runs, _read_run, _write_run
+from .mappers import timestamp_column
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+DEFAULT_BATCH_ROWS = 4096
+SCALAR_TYPES = (bool, int, float, str)
+AGGREGATE_REDUCERS = (ops.Count, ops.Sum, ops.Average)
+
+TKey = tp.Tuple[tp.Any, ...]
+TBatches = tp.Iterable['Batch']
+TKernel = tp.Callable[[TBatches], tp.Iterator['Batch']]
+TJoinKernel = tp.Callable[[TBatches, ops.TRowsIterable], tp.Iterator['Batch']]
+
+
+def to_array(values: tp.List[tp.Any]) -> tp.Any:
+    """Column array of values: typed array if all values are bool, int, float or str of one type
+    or naive datetimes, object array otherwise, so that values come back from the array unchanged
+    """
+    types = set(map(type, values))
+    value_type = types.pop() if len(types) == 1 else None
+    if value_type in SCALAR_TYPES:
+        try:
+            return np.array(values)
+        except OverflowError:
+            pass
+    if value_type is datetime.datetime and all(value.tzinfo is None for value in values):
+        return np.array(values, dtype='M8[us]')
+    return np.fromiter(values, dtype=object, count=len(values))
+
+
+def concatenate_arrays(arrays: tp.List[tp.Any]) -> tp.Any:
+    """Arrays of one column joined in one; arrays of different types are joined as object array,
+    since numpy would promote values (e.g. ints to floats or to strings) and they would not come back unchanged
+    """
+    dtype = arrays[0].dtype
+    if any(array.dtype != dtype for array in arrays) and not all(array.dtype.kind == 'U' for array in arrays):
+        arrays = [array.astype(object) for array in arrays]
+    return np.concatenate(arrays)
+
+
+class Batch:
+    """Block of rows with equal columns stored as one array per column"""
+
+    def __init__(self, columns: tp.Dict[str, tp.Any], length: int) -> None:
+        """
+        :param columns: column name to array of its values, in order of columns in rows
+        :param length: number of rows
+        """
+        self.columns = columns
+        self.length = length
+
+    @staticmethod
+    def from_rows(rows: tp.List[ops.TRow]) -> Batch:
+        """
+        :param rows: rows with equal column names in equal order
+        """
+        return Batch({column: to_array([row[column] for row in rows]) for column in rows[0]}, len(rows))
+
+    def to_rows(self) -> ops.TRowsGenerator:
+        names = list(self.columns)
+        if not names:
+            for _ in range(self.length):
+                yield {}
+            return
+        for values in zip(*(array.tolist() for array in self.columns.values())):
+            yield dict(zip(names, values))
+
+    def take(self, indices: tp.Any) -> Batch:
+        """Batch of rows selected by boolean mask or index array"""
+        indices = np.asarray(indices)
+        length = int(np.count_nonzero(indices)) if indices.dtype == bool else len(indices)
+        return Batch({name: array[indices] for name, array in self.columns.items()}, length)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self.columns.values())
+
+    @staticmethod
+    def concatenate(batches: tp.List[Batch]) -> Batch | None:
+        """One batch of all rows, None if batches have different columns"""
+        names = list(batches[0].columns)
+        if any(list(batch.columns) != names for batch in batches):
+            return None
+        columns = {name: concatenate_arrays([batch.columns[name] for batch in batches]) for name in names}
+        return Batch(columns, sum(batch.length for batch in batches))
+
+
+def to_batches(rows: ops.TRowsIterable, batch_rows: int = DEFAULT_BATCH_ROWS) -> tp.Iterator[Batch]:
+    """Pack rows into batches, a new batch is started whenever column names of rows change"""
+    buffer: tp.List[ops.TRow] = []
+    names: tp.Tuple[str, ...] = ()
+    for row in rows:
+        row_names = tuple(row)
+        if buffer and (row_names != names or len(buffer) >= batch_rows):
+            yield Batch.from_rows(buffer)
+            buffer = []
+        names = row_names
+        buffer.append(row)
+    if buffer:
+        yield Batch.from_rows(buffer)
+
+
+def to_rows(batches: TBatches) -> ops.TRowsGenerator:
+    for batch in batches:
+        yield from batch.to_rows()
+
+
+def _broadcast(value: tp.Any, length: int) -> tp.Any:
+    array = np.asarray(value)
+    return np.repeat(array, length) if array.ndim == 0 else array
+
+
+def _product(factors: tp.List[tp.Any]) -> tp.Any:
+    """Elementwise product of columns. Integer columns are multiplied in Python ints (object arrays)
+    when the products may not fit int64, so they never overflow, as in Product"""
+    if factors and all(factor.dtype.kind in 'iu' for factor in factors):
+        bound = 1
+        for factor in factors:
+            bound *= max(int(factor.max()), -int(factor.min())) if len(factor) else 0
+        if bound > np.iinfo(np.int64).max:
+            factors = [factor.astype(object) for factor in factors]
+    result = 1
+    for factor in factors:
+        result = result * factor
+    return result
+
+
+def _map_kernel(mapper: ops.Mapper) -> TKernel | None:
+    """Batch implementation of mapper, None if mapper has none"""
+    if isinstance(mapper, ops.DummyMapper):
+        return lambda batches: iter(batches)
+
+    if isinstance(mapper, ops.Project):
+        def project(batches: TBatches) -> tp.Iterator[Batch]:
+            for batch in batches:
+                yield Batch({column: batch.columns[column] for column in mapper.columns if column in batch.columns},
+                            batch.length)
+        return project
+
+    if isinstance(mapper, ops.ParseTimestamp):
+        def parse(batches: TBatches) -> tp.Iterator[Batch]:
+            for batch in batches:
+                columns = dict(batch.columns)
+                columns[mapper.result_column] = timestamp_column(batch.columns[mapper.column])
+                yield Batch(columns, batch.length)
+        return parse
+
+    if isinstance(mapper, ops.Filter) and mapper.vectorized:
+        def filter_rows(batches: TBatches) -> tp.Iterator[Batch]:
+            for batch in batches:
+                mask = _broadcast(mapper.condition(batch.columns), batch.length).astype(bool)
+                if mask.all():
+                    yield batch
+                elif mask.any():
+                    yield batch.take(mask)
+        return filter_rows
+
+    if isinstance(mapper, (ops.Calculate, ops.Product)) and \
+            (isinstance(mapper, ops.Product) or mapper.vectorized):
+        def calculate(batches: TBatches) -> tp.Iterator[Batch]:
+            for batch in batches:
+                if isinstance(mapper, ops.Product):
+                    result = _product([batch.columns[column] for column in mapper.columns
+                                       if column in batch.columns])
+                else:
+                    result = mapper.operation(batch.columns, **mapper.params)
+                columns = dict(batch.columns)
+                columns[mapper.result_column] = _broadcast(result, batch.length)
+                yield Batch(columns, batch.length)
+        return calculate
+
+    return None
+
+
+def _group_starts(batch: Batch, keys: tp.Sequence[str]) -> tp.Any:
+    """Indices of first rows of groups of consecutive rows with equal keys"""
+    change = np.zeros(batch.length, dtype=bool)
+    change[0] = True
+    for key in keys:
+        values = batch.columns[key]
+        change[1:] |= values[1:] != values[:-1]
+    return np.flatnonzero(change)
+
+
+def _group_sums(values: tp.Any, starts: tp.Any) -> tp.Any:
+    """Sums of groups of values beginning at starts. Integer values are summed in Python ints
+    (object array) when the sums may not fit the array type, so they never overflow, as in Reduce"""
+    if values.dtype.kind in 'iu':
+        info = np.iinfo(values.dtype)
+        bound = max(int(values.max()), -int(values.min())) * len(values)
+        if bound > info.max or -bound < info.min:
+            values = values.astype(object)
+    return np.add.reduceat(values, starts)
+
+
+def _add_carried(totals: tp.Any, carried: tp.Any) -> tp.Any:
+    """totals with the total carried from the previous batch added to the first one"""
+    if totals.dtype.kind in 'iuO' and carried.dtype.kind in 'iuO':
+        first = totals[:1].tolist()[0] + carried[:1].tolist()[0]
+        if totals.dtype.kind != 'O' and isinstance(first, int) and \
+                np.iinfo(totals.dtype).min <= first <= np.iinfo(totals.dtype).max:
+            totals = totals.copy()
+        else:
+            totals = totals.astype(object)
+        totals[0] = first
+        return totals
+    return concatenate_arrays([totals[:1] + carried, totals[1:]])
+
+
+def _reduce_kernel(reducer: ops.Reducer, keys: tp.Sequence[str]) -> TKernel | None:
+    """Batch implementation of Reduce with Count, Sum or Average.
+    Like Reduce, it folds groups of consecutive rows with equal keys; a group may span several batches.
+    Integer sums which would overflow the array type are done in Python ints, so results match Reduce.
+    """
+    if type(reducer) not in AGGREGATE_REDUCERS:
+        return None
+    column = reducer.column
+
+    def result(key_columns: tp.Dict[str, tp.Any], counts: tp.Any, totals: tp.Any) -> Batch:
+        columns = dict(key_columns)
+        if isinstance(reducer, ops.Count):
+            columns[column] = counts
+        elif isinstance(reducer, ops.Sum):
+            columns[column] = totals
+        else:
+            columns[column] = totals / counts
+        return Batch(columns, len(counts))
+
+    def reduce(batches: TBatches) -> tp.Iterator[Batch]:
+        carry: tp.Tuple[tp.Dict[str, tp.Any], tp.Any, tp.Any] | None = None
+        for batch in batches:
+            if batch.length == 0:
+                continue
+            starts = _group_starts(batch, keys)
+            counts = np.diff(np.append(starts, batch.length))
+            totals = None
+            if not isinstance(reducer, ops.Count):
+                if column in batch.columns:
+                    totals = _group_sums(batch.columns[column], starts)
+                elif isinstance(reducer, ops.Sum):
+                    totals = np.zeros(len(starts), dtype=int)
+                else:
+                    raise KeyError(column)
+            key_columns = {key: batch.columns[key][starts] for key in keys}
+            if carry is not None:
+                carry_keys, carry_counts, carry_totals = carry
+                if all(carry_keys[key][0] == key_columns[key][0] for key in keys):
+                    counts[:1] += carry_counts
+                    if totals is not None:
+                        totals = _add_carried(totals, carry_totals)
+                else:
+                    yield result(carry_keys, carry_counts, carry_totals)
+            if len(starts) > 1:
+                yield result({key: values[:-1] for key, values in key_columns.items()},
+                             counts[:-1], None if totals is None else totals[:-1])
+            carry = ({key: values[-1:] for key, values in key_columns.items()},
+                     counts[-1:], None if totals is None else totals[-1:])
+        if carry is not None:
+            yield result(*carry)
+
+    return reduce
+
+
+def _sort_kernel(operation: ExternalSort, batch_rows: int, columns: tp.Sequence[str] | None = None) -> TKernel:
+    """Batch implementation of ExternalSort in current process: batches are collected until
+    their size exceeds memory_limit, then sorted and spilled as a run file; the result is the same
+    as of ExternalSort.
+    :param columns: columns to keep, the rest are dropped before sorting; all columns are kept if None
+    """
+    keys = list(operation.keys)
+    key = itemgetter(*keys)
+
+    def sort_buffer(buffer: tp.List[Batch]) -> tp.Iterator[Batch]:
+        if not buffer:
+            return
+        batch = Batch.concatenate(buffer)
+        if batch is None:
+            rows = list(to_rows(buffer))
+            rows.sort(key=key)
+            yield from to_batches(rows, batch_rows)
+            return
+        order = np.arange(batch.length)
+        for name in reversed(keys):
+            order = order[np.argsort(batch.columns[name][order], kind='stable')]
+        yield batch.take(order)
+
+    def sort(batches: TBatches) -> tp.Iterator[Batch]:
+        with contextlib.ExitStack() as stack:
+            run_dir = ''
+            paths: tp.List[str] = []
+            buffer: tp.List[Batch] = []
+            buffer_size = 0
+            for batch in batches:
+                if columns is not None:
+                    batch = Batch({name: batch.columns[name] for name in columns if name in batch.columns},
+                                  batch.length)
+                buffer.append(batch)
+                buffer_size += batch.nbytes
+                if buffer_size >= operation.memory_limit:
+                    if not run_dir:
+                        run_dir = stack.enter_context(tempfile.TemporaryDirectory(prefix='compgraph_sort_',
+                                                                                  dir=operation.tmp_dir))
+                    paths.append(_write_run(to_rows(sort_buffer(buffer)), run_dir, len(paths)))
+                    buffer, buffer_size = [], 0
+            if not paths:
+                yield from sort_buffer(buffer)
+                return
+            paths = _merge_runs(paths, key, run_dir)
+            rows = heapq.merge(*map(_read_run, paths), to_rows(sort_buffer(buffer)), key=key)
+            yield from to_batches(rows, batch_rows)
+
+    return sort
+
+
+def _key_tuples(batch: Batch, keys: tp.Sequence[str]) -> tp.Iterable[TKey]:
+    if not keys:
+        return itertools.repeat((), batch.length)
+    return zip(*(batch.columns[key].tolist() for key in keys))
+
+
+def _join_batches(joiner: ops.Joiner, keys: tp.Sequence[str], batch_a: Batch, batch_b: Batch) -> Batch:
+    """Inner join of rows of batch_a and batch_b which are already matched pairwise,
+    columns are named as InnerJoiner names them
+    """
+    columns_b = set(batch_b.columns) - set(keys)
+    columns_a = set(batch_a.columns) - set(keys)
+    columns = {key: batch_a.columns[key] for key in keys}
+    for name, values in batch_a.columns.items():
+        if name not in keys:
+            columns[name + joiner._a_suffix if name in columns_b else name] = values
+    for name, values in batch_b.columns.items():
+        if name not in keys:
+            columns[name + joiner._b_suffix if name in columns_a else name] = values
+    return Batch(columns, batch_a.length)
+
+
+def _join_kernel(operation: ops.HashJoin, batch_rows: int) -> TJoinKernel | None:
+    """Batch implementation of HashJoin with InnerJoiner. As in HashJoin, the side which ends first is
+    built into hash table of row indices and the other side is probed through it batch by batch,
+    so the output order is the same. Both sides are given to HashJoin itself if they exceed memory_limit
+    or the build side has rows with different columns.
+    """
+    if type(operation.joiner) is not ops.InnerJoiner:
+        return None
+    keys = list(operation.keys)
+
+    def probe(build: Batch, probe_batches: TBatches, build_is_left: bool) -> tp.Iterator[Batch]:
+        table: tp.Dict[TKey, tp.List[int]] = {}
+        for index, key in enumerate(_key_tuples(build, keys)):
+            table.setdefault(key, []).append(index)
+        for batch in probe_batches:
+            probe_indices: tp.List[int] = []
+            build_indices: tp.List[int] = []
+            for index, key in enumerate(_key_tuples(batch, keys)):
+                matches = table.get(key)
+                if matches is not None:
+                    probe_indices.extend([index] * len(matches))
+                    build_indices.extend(matches)
+            if not probe_indices:
+                continue
+            matched_build, matched_probe = build.take(build_indices), batch.take(probe_indices)
+            if build_is_left:
+                yield _join_batches(operation.joiner, keys, matched_build, matched_probe)
+            else:
+                yield _join_batches(operation.joiner, keys, matched_probe, matched_build)
+
+    def join(batches: TBatches, rows_b: ops.TRowsIterable) -> tp.Iterator[Batch]:
+        iter_a, iter_b = iter(batches), iter(rows_b)
+        buffer_a: tp.List[Batch] = []
+        buffer_b: tp.List[ops.TRow] = []
+        count_a = size_a = size_b = 0
+        build_is_left = None
+        while build_is_left is None:
+            batch = next(iter_a, None)
+            if batch is None:
+                # right side has at least as many rows as the whole left side
+                build_is_left = True
+                break
+            buffer_a.append(batch)
+            count_a += batch.length
+            size_a += batch.nbytes
+            for row in itertools.islice(iter_b, count_a - len(buffer_b)):
+                buffer_b.append(row)
+                size_b += sys.getsizeof(row)
+            if len(buffer_b) < count_a:
+                build_is_left = False
+            elif min(size_a, size_b) > operation.memory_limit:
+                break
+        if build_is_left is not None and not (buffer_a if build_is_left else buffer_b):
+            return
+        build = None
+        if build_is_left:
+            build = Batch.concatenate(buffer_a)
+        elif build_is_left is False and all(row.keys() == buffer_b[0].keys() for row in buffer_b):
+            build = Batch.from_rows(buffer_b)
+        if build is None:
+            rows_a = to_rows(itertools.chain(buffer_a, iter_a))
+            yield from to_batches(operation(rows_a, itertools.chain(buffer_b, iter_b)), batch_rows)
+        elif build_is_left:
+            yield from probe(build, to_batches(itertools.chain(buffer_b, iter_b), batch_rows), True)
+        else:
+            yield from probe(build, itertools.chain(buffer_a, iter_a), False)
+
+    return join
+
+
+def kernel(operation: ops.Operation, batch_rows: int = DEFAULT_BATCH_ROWS) -> TKernel | TJoinKernel | None:
+    """Batch implementation of operation, None if operation has none.
+    Kernel of join takes rows of the joined graph as the second argument.
+    """
+    if isinstance(operation, ops.Map):
+        return _map_kernel(operation.mapper)
+    if type(operation) is ExternalSort:
+        return _sort_kernel(operation, batch_rows)
+    if isinstance(operation, ops.Reduce):
+        return _reduce_kernel(operation.reducer, operation.keys)
+    if isinstance(operation, ops.HashJoin):
+        return _join_kernel(operation, batch_rows)
+    return None
+
+
+class ColumnarStage(ops.Operation):
+    """
+    Chain of operations done on batches of column arrays instead of separate rows.
+    Rows are packed into batches on input and unpacked on output, so the stage is a drop-in
+    replacement of operations it is built from; they are kept to track sortedness.
+    A stage with joins takes rows of joined graphs as extra arguments, one per join.
+    A sort followed by Count, Sum or Average reduce sorts only columns the reduce reads.
+    """
+
+    def __init__(self, operations: tp.Sequence[ops.Operation], batch_rows: int = DEFAULT_BATCH_ROWS) -> None:
+        """
+        :param operations: operations which have batch implementation, see kernel
+        :param batch_rows: maximal number of rows in one batch
+        """
+        self.operations = list(operations)
+        self.batch_rows = batch_rows
+        self.kernels: tp.List[tp.Any] = []
+        for index, operation in enumerate(self.operations):
+            following = self.operations[index + 1] if index + 1 < len(self.operations) else None
+            if type(operation) is ExternalSort and isinstance(following, ops.Reduce) \
+                    and type(following.reducer) in AGGREGATE_REDUCERS:
+                columns = [*operation.keys, *following.keys, following.reducer.column]
+                self.kernels.append(_sort_kernel(operation, batch_rows, columns))
+            else:
+                self.kernels.append(kernel(operation, batch_rows))
+        assert all(self.kernels), 'operation without batch implementation'
+
+    @property
+    def join_inputs(self) -> int:
+        """Number of joined graphs the stage reads"""
+        return sum(isinstance(operation, ops.HashJoin) for operation in self.operations)
+
+    def __call__(self, rows: ops.TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> ops.TRowsGenerator:
+        """
+        :param rows: input rows
+        :param args: rows of joined graphs, one iterable per join of the stage
+        """
+        joined = iter(args)
+        batches = to_batches(rows, self.batch_rows)
+        for operation, do_kernel in zip(self.operations, self.kernels):
+            if isinstance(operation, ops.HashJoin):
+                batches = do_kernel(batches, next(joined))
+            else:
+                batches = do_kernel(batches)
+        yield from to_rows(batches)
+
+
+def vectorize(operations: tp.Sequence[ops.Operation],
+              batch_rows: int = DEFAULT_BATCH_ROWS) -> tp.List[ops.Operation]:
+    """Replace every chain of operations having batch implementation with ColumnarStage.
+    Fused maps are split, so that supported mappers join the stage and the rest stay fused.
+    :param operations: graph operations
+    :param batch_rows: maximal number of rows in one batch
+    """
+    if np is None:
+        raise ImportError('columnar execution requires numpy')
+    result: tp.List[ops.Operation] = []
+    stage: tp.List[ops.Operation] = []
+    mappers: tp.List[ops.Mapper] = []
+
+    def flush_mappers() -> None:
+        if len(mappers) == 1:
+            result.append(ops.Map(mappers[0]))
+        elif mappers:
+            result.append(ops.FusedMap(mappers))
+        mappers.clear()
+
+    def flush_stage() -> None:
+        if stage:
+            result.append(ColumnarStage(stage, batch_rows))
+        stage.clear()
+
+    for operation in operations:
+        parts = [ops.Map(mapper) for mapper in operation.mappers] if isinstance(operation, ops.FusedMap) \
+            else [operation]
+        for part in parts:
+            if kernel(part, batch_rows) is not None:
+                flush_mappers()
+                stage.append(part)
+                continue
+            flush_stage()
+            if isinstance(part, ops.Map):
+                mappers.append(part.mapper)
+            else:
+                flush_mappers()
+                result.append(part)
+    flush_mappers()
+    flush_stage()
+    return result
@@ -0,0 +1,175 @@
+# mypy: ignore-errors
+
+from __future__ import annotations
+
+import contextlib
+import typing as tp
+
+from . import operations as ops
+from . import optimizer
+from .columnar import ColumnarStage, vectorize
+from .external_sort import ExternalSort, SortWorkerPool, DEFAULT_MEMORY_LIMIT
+from .distributed import Cluster, Stage, distribute
+from .parallel import ParallelJoin
+from .spill import SpillingTee
+
+if tp.TYPE_CHECKING:
+    from .graph import Graph
+
+JOIN_OPERATIONS = (ops.Join, ops.HashJoin, ops.BroadcastJoin, ParallelJoin)
+
+
+def join_inputs(operation: ops.Operation) -> int:
+    """Number of joined graphs operation reads"""
+    if isinstance(operation, ColumnarStage):
+        return operation.join_inputs
+    if isinstance(operation, Stage):
+        return join_inputs(operation.operation)
+    return 1 if isinstance(operation, JOIN_OPERATIONS) else 0
+
+
+class _Step:
+    """One operation of the graph, steps with equal operation and inputs are merged"""
+
+    def __init__(self, operation: ops.Operation, parent: _Step | None, join_input: _Step | None) -> None:
+        self.operation = operation
+        self.parent = parent
+        self.join_input = join_input
+        self.children: tp.Dict[tp.Tuple[int, int], _Step] = {}
+        self.outside_uses = 0
+
+
+class PlanNode:
+    """Chain of operations whose output is consumed by one or several other nodes"""
+
+    def __init__(self, operations: tp.List[ops.Operation], source: PlanNode | None,
+                 joined: tp.List[PlanNode]) -> None:
+        """
+        :param operations: operations of the chain, the first one reads data if source is None
+        :param source: node whose output is the input of the chain
+        :param joined: nodes whose output is joined by join operations of the chain, in order
+        """
+        self.operations = operations
+        self.source = source
+        self.joined = joined
+        self.consumers = 0
+
+
+def _add_graph(graph: Graph, roots: tp.Dict[tp.Tuple[int, int], _Step],
+               ends: tp.Dict[int, _Step]) -> _Step:
+    """Merge operations of graph and all joined graphs into the tree of steps
+    :return: step which gives output of graph
+    """
+    if id(graph) in ends:
+        return ends[id(graph)]
+    step: _Step | None = None
+    join_index = 0
+    for operation in graph.operations:
+        join_input = None
+        if isinstance(operation, JOIN_OPERATIONS):
+            join_input = _add_graph(graph.graphs_to_join[join_index], roots, ends)
+            join_index += 1
+        children = roots if step is None else step.children
+        key = (id(operation), id(join_input))
+        if key not in children:
+            children[key] = _Step(operation, step, join_input)
+            if join_input is not None:
+                join_input.outside_uses += 1
+        step = children[key]
+    assert step is not None, 'graph has no operations'
+    ends[id(graph)] = step
+    return step
+
+
+class Plan:
+    """
+    Graph and its joined graphs as one DAG: operations shared by several graphs (e.g. branches built
+    from the same graph object) are done once, their output is fanned out through SpillingTee.
+    """
+
+    def __init__(self, graph: Graph, optimize: bool = True,
+                 report: tp.List[optimizer.SortRewrite] | None = None, columnar: bool = False,
+                 compact_rows: bool = False) -> None:
+        """
+        :param graph: graph to plan
+        :param optimize: whether to apply optimizer to every chain
+        :param report: list to append records about sorts removed or weakened by optimizer
+        :param columnar: whether to replace chains having batch implementation with columnar stages
+        :param compact_rows: whether rows read by sources are stored as ops.CompactRow, see ops.compact
+        """
+        end = _add_graph(graph, {}, {})
+        end.outside_uses += 1
+        self._nodes: tp.Dict[_Step, PlanNode] = {}
+        self._orderings: tp.Dict[PlanNode, tp.Tuple[str, ...]] = {}
+        self._optimize = optimize
+        self._report = report
+        self._columnar = columnar
+        self._compact_rows = compact_rows
+        self.output = self._node(end)
+
+    def _node(self, end: _Step) -> PlanNode:
+        if end in self._nodes:
+            return self._nodes[end]
+        steps = [end]
+        while steps[-1].parent is not None and len(steps[-1].parent.children) == 1 \
+                and steps[-1].parent.outside_uses == 0:
+            steps.append(steps[-1].parent)
+        steps.reverse()
+        source = None if steps[0].parent is None else self._node(steps[0].parent)
+        joined = [self._node(step.join_input) for step in steps if step.join_input is not None]
+        operations = [step.operation for step in steps]
+        ordering = () if source is None else self._orderings[source]
+        if self._optimize:
+            operations = optimizer.optimize(operations, self._report, ordering, self._columnar)
+        elif self._columnar:
+            operations = vectorize(operations)
+        node = PlanNode(operations, source, joined)
+        node.consumers = len(end.children) + end.outside_uses
+        self._orderings[node] = optimizer.stream_ordering(operations, ordering)
+        self._nodes[end] = node
+        return node
+
+    def nodes(self) -> tp.List[PlanNode]:
+        """All nodes, every node follows the nodes it reads from"""
+        return list(self._nodes.values())
+
+    def run(self, sources: tp.Dict[str, tp.Any], sort_pool: SortWorkerPool | None = None,
+            memory_limit: int = DEFAULT_MEMORY_LIMIT, tmp_dir: str | None = None,
+            cluster: Cluster | None = None) -> ops.TRowsGenerator:
+        """
+        :param sources: data sources passed to graph run
+        :param sort_pool: processes used by all sorts
+        :param cluster: nodes which run key-partitioned operations (reduces and joins by keys) as stages
+        :param memory_limit: every shared stream spills rows to disk above this budget (in bytes)
+        :param tmp_dir: directory for spilled rows, system default if None
+        :return: output rows as plain dicts, copy-on-write rows used inside the graph do not leave it
+        """
+        tees: tp.Dict[PlanNode, SpillingTee] = {}
+        with contextlib.ExitStack() as stack:
+
+            def stream(node: PlanNode) -> ops.TRowsIterable:
+                if node in tees:
+                    return tees[node].reader()
+                operations = node.operations
+                if node.source is None:
+                    passed_data = operations[0](**sources)
+                    if self._compact_rows:
+                        passed_data = ops.compact(passed_data)
+                    operations = operations[1:]
+                else:
+                    passed_data = stream(node.source)
+                joined = iter(node.joined)
+                for do_operation in operations:
+                    if cluster is not None:
+                        do_operation = distribute(do_operation, cluster)
+                    if isinstance(do_operation, ExternalSort):
+                        passed_data = do_operation(passed_data, sort_pool=sort_pool)
+                    else:
+                        passed_data = do_operation(passed_data,
+                                                   *[stream(next(joined)) for _ in range(join_inputs(do_operation))])
+                if node.consumers > 1:
+                    tees[node] = stack.enter_context(SpillingTee(passed_data, node.consumers, memory_limit, tmp_dir))
+                    return tees[node].reader()
+                return passed_data
+
+            yield from map(ops.as_dict, stream(self.output))
@@ -0,0 +1,345 @@
+from __future__ import annotations
+
+import contextlib
+import os
+import pickle
+import tempfile
+import threading
+import typing as tp
+from concurrent import futures
+from multiprocessing import Pipe, Process, connection
+
+from . import operations as ops
+from .parallel import ParallelJoin, ParallelReduce, shuffle
+from .spill import SPILL_CHUNK_SIZE, read_spilled
+
+TRANSFER_BLOCK_SIZE = 1024 * 1024
+# errors of a connection to a node: its process died, the network connection broke or a message is corrupted
+NODE_ERRORS = (EOFError, OSError, pickle.UnpicklingError)
+
+
+class RemoteTaskError(Exception):
+    """Operation of a task failed on a node: the error is not retried, since it repeats on any node"""
+
+
+class NodeLostError(Exception):
+    """Connection to a node failed in the middle of a task: the node is dropped and the task is retried"""
+
+
+class _NodeConnection:
+    """Coordinator end of a connection to a node: its failures are raised as NodeLostError,
+    so they are told apart from errors of local files"""
+
+    def __init__(self, endpoint: connection.Connection) -> None:
+        self._endpoint = endpoint
+
+    @staticmethod
+    def _call(method: tp.Callable[..., tp.Any], *args: tp.Any) -> tp.Any:
+        try:
+            return method(*args)
+        except NODE_ERRORS as exc:
+            raise NodeLostError(f'{type(exc).__name__}: {exc}') from exc
+
+    def send(self, obj: tp.Any) -> None:
+        self._call(self._endpoint.send, obj)
+
+    def recv(self) -> tp.Any:
+        return self._call(self._endpoint.recv)
+
+    def send_bytes(self, data: bytes) -> None:
+        self._call(self._endpoint.send_bytes, data)
+
+    def recv_bytes(self) -> bytes:
+        return self._call(self._endpoint.recv_bytes)
+
+    def close(self) -> None:
+        self._endpoint.close()
+
+
+TEndpoint = tp.Union[connection.Connection, _NodeConnection]
+
+
+def _send_file(endpoint: TEndpoint, f: tp.BinaryIO) -> OSError | None:
+    """Stream file as raw blocks, empty block marks the end.
+    When reading fails, the end is sent anyway so the connection stays in sync, and the error is returned"""
+    error = None
+    while True:
+        try:
+            block = f.read(TRANSFER_BLOCK_SIZE)
+        except OSError as exc:
+            error = exc
+            break
+        if not block:
+            break
+        endpoint.send_bytes(block)
+    endpoint.send_bytes(b'')
+    return error
+
+
+def _receive_file(endpoint: TEndpoint, f: tp.BinaryIO) -> OSError | None:
+    """Write blocks sent by _send_file to f.
+    When writing fails, the rest of blocks is received anyway so the connection stays in sync,
+    and the error is returned"""
+    error = None
+    for block in iter(endpoint.recv_bytes, b''):
+        if error is None:
+            try:
+                f.write(block)
+            except OSError as exc:
+                error = exc
+    return error
+
+
+def _run_task(endpoint: connection.Connection, operation: ops.Operation, inputs: int) -> None:
+    """Receive spilled inputs, run operation on them and stream its output back in spill file format,
+    then send None or the error of operation"""
+    with tempfile.TemporaryDirectory(prefix='compgraph_node_') as run_dir:
+        paths = [os.path.join(run_dir, f'input_{index}') for index in range(inputs)]
+        for path in paths:
+            with open(path, 'wb') as f:
+                receive_error = _receive_file(endpoint, f)
+            if receive_error is not None:
+                # disk of the node failed: the node stops, so coordinator retries the task on another node
+                raise receive_error
+        error = None
+        try:
+            chunk: tp.List[ops.TRow] = []
+            for row in operation(*map(read_spilled, paths)):
+                chunk.append(row)
+                if len(chunk) >= SPILL_CHUNK_SIZE:
+                    endpoint.send_bytes(pickle.dumps(chunk, protocol=pickle.HIGHEST_PROTOCOL))
+                    chunk = []
+            if chunk:
+                endpoint.send_bytes(pickle.dumps(chunk, protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception as exc:
+            error = RemoteTaskError(f'{type(exc).__name__}: {exc}')
+        endpoint.send_bytes(b'')
+        endpoint.send(error)
+
+
+def serve(address: tp.Tuple[str, int], authkey: bytes,
+          ready: connection.Connection | None = None) -> None:
+    """Loop of a node: accept coordinator connections and run tasks sent by them until None arrives.
+    Task is a pair (operation, number of inputs), followed by the spilled inputs.
+    :param address: host and port to listen on, port 0 picks a free one
+    :param authkey: secret shared with coordinator
+    :param ready: connection to send the actual listening address to
+    """
+    with connection.Listener(address, authkey=authkey) as listener:
+        if ready is not None:
+            ready.send(listener.address)
+            ready.close()
+        while True:
+            with listener.accept() as endpoint:
+                while True:
+                    try:
+                        task = endpoint.recv()
+                    except EOFError:
+                        break
+                    if task is None:
+                        return
+                    _run_task(endpoint, *task)
+
+
+class Node:
+    """Coordinator side of a connection to one node"""
+
+    def __init__(self, address: tp.Tuple[str, int], authkey: bytes) -> None:
+        self.address = address
+        self.endpoint = _NodeConnection(connection.Client(address, authkey=authkey))
+
+    def run(self, operation: ops.Operation, input_paths: tp.List[str], output_path: str) -> None:
+        """Run operation on the node, inputs and output are spill files of the coordinator.
+        Failures of the connection are raised as NodeLostError. Errors of local files are raised as they are
+        once the exchange is over, so the node stays ready for the next task."""
+        with contextlib.ExitStack() as stack:
+            inputs = [stack.enter_context(open(path, 'rb')) for path in input_paths]
+            output = stack.enter_context(open(output_path, 'wb'))
+            self.endpoint.send((operation, len(inputs)))
+            local_errors = [_send_file(self.endpoint, f) for f in inputs]
+            local_errors.append(_receive_file(self.endpoint, output))
+            error = self.endpoint.recv()
+        for local_error in local_errors:
+            if local_error is not None:
+                raise local_error
+        if error is not None:
+            raise error
+
+    def stop(self) -> None:
+        try:
+            self.endpoint.send(None)
+        except NodeLostError:
+            pass
+        self.close()
+
+    def close(self) -> None:
+        self.endpoint.close()
+
+
+class ClusterStats:
+    """Counters of tasks done by nodes"""
+
+    def __init__(self) -> None:
+        self.tasks = 0
+        self.retries = 0
+        self.lost_nodes = 0
+
+    def reset(self) -> None:
+        self.__init__()
+
+    def __repr__(self) -> str:
+        return f'ClusterStats(tasks={self.tasks}, retries={self.retries}, lost_nodes={self.lost_nodes})'
+
+
+class Cluster:
+    """
+    Coordinator of nodes serving tasks over TCP (see serve). Every task is a partition of a stage:
+    its spilled inputs are streamed to a free node, the output is streamed back into a local file.
+    When a node is lost in the middle of a task, the node is dropped and the task is retried on another one;
+    inputs stay on the coordinator until the task is done. Errors of local files of the coordinator
+    (e.g. a full disk) are not retried and leave the node in the cluster.
+    """
+
+    def __init__(self, addresses: tp.Sequence[tp.Tuple[str, int]], authkey: bytes) -> None:
+        """
+        :param addresses: nodes to connect to
+        :param authkey: secret shared with nodes
+        """
+        self.nodes = [Node(address, authkey) for address in addresses]
+        self.stats = ClusterStats()
+        self._idle = list(self.nodes)
+        self._alive = len(self.nodes)
+        self._condition = threading.Condition()
+        self._threads = futures.ThreadPoolExecutor(max(len(self.nodes), 1), thread_name_prefix='compgraph_cluster')
+
+    @property
+    def size(self) -> int:
+        """Number of nodes which are not lost"""
+        return self._alive
+
+    def _acquire(self) -> Node:
+        with self._condition:
+            while not self._idle:
+                if self._alive == 0:
+                    raise RuntimeError('all nodes of the cluster are lost')
+                self._condition.wait()
+            return self._idle.pop()
+
+    def _release(self, node: Node, lost: bool = False, done: bool = False) -> None:
+        """Return node after a task, stats are updated under the same lock
+        :param lost: node is lost, the task is retried on another one
+        :param done: task has finished successfully
+        """
+        with self._condition:
+            if lost:
+                node.close()
+                self._alive -= 1
+                self.stats.lost_nodes += 1
+                self.stats.retries += 1
+            else:
+                self._idle.append(node)
+                if done:
+                    self.stats.tasks += 1
+            self._condition.notify_all()
+
+    def _run(self, operation: ops.Operation, input_paths: tp.List[str], output_path: str) -> str:
+        while True:
+            node = self._acquire()
+            try:
+                node.run(operation, input_paths, output_path)
+            except NodeLostError:
+                self._release(node, lost=True)
+                continue
+            except BaseException:
+                self._release(node)
+                raise
+            self._release(node, done=True)
+            return output_path
+
+    def submit(self, operation: ops.Operation, input_paths: tp.List[str], output_path: str) -> futures.Future[str]:
+        """Run operation on spilled inputs of one partition on some node
+        :return: future of output_path, the file holds output rows in spill file format
+        """
+        return self._threads.submit(self._run, operation, input_paths, output_path)
+
+    def shutdown(self) -> None:
+        """Stop nodes and disconnect from them"""
+        self._threads.shutdown()
+        for node in self._idle:
+            node.stop()
+        self._idle = []
+        self._alive = 0
+
+    def __enter__(self) -> Cluster:
+        return self
+
+    def __exit__(self, *args: tp.Any) -> None:
+        self.shutdown()
+
+
+class LocalCluster(Cluster):
+    """Cluster of node processes started on localhost"""
+
+    def __init__(self, nodes: int, authkey: bytes | None = None) -> None:
+        """
+        :param nodes: number of node processes
+        :param authkey: secret shared with nodes, random if None
+        """
+        assert nodes >= 1
+        authkey = authkey if authkey is not None else os.urandom(16)
+        self.processes: tp.List[Process] = []
+        addresses = []
+        for _ in range(nodes):
+            ready, remote_ready = Pipe(duplex=False)
+            process = Process(target=serve, args=(('localhost', 0), authkey, remote_ready), daemon=True)
+            process.start()
+            remote_ready.close()
+            addresses.append(ready.recv())
+            self.processes.append(process)
+        super().__init__(addresses, authkey)
+
+    def kill(self, index: int) -> None:
+        """Terminate node process, e.g. to check failure handling"""
+        self.processes[index].terminate()
+        self.processes[index].join()
+
+    def shutdown(self) -> None:
+        super().shutdown()
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+
+class Stage(ops.Operation):
+    """Key-partitioned operation run by cluster nodes on hash partitions of its inputs, see parallel.shuffle"""
+
+    def __init__(self, operation: ops.Operation, cluster: Cluster) -> None:
+        """
+        :param operation: Reduce, HashReduce, Join or HashJoin; sorted ones keep their output order
+        :param cluster: nodes to run partitions on
+        """
+        self.operation = operation
+        self.cluster = cluster
+        self.ordered = isinstance(operation, (ops.Reduce, ops.Join))
+
+    def __call__(self, rows: ops.TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> ops.TRowsGenerator:
+        if self.cluster.size == 0:
+            raise RuntimeError('no cluster nodes are available: all nodes are lost or the cluster is shut down')
+        yield from shuffle(self.operation, [rows, *args], self.operation.keys, self.cluster.size, self.ordered,
+                           getattr(self.operation, 'tmp_dir', None), self.cluster)
+
+
+def distribute(operation: ops.Operation, cluster: Cluster) -> ops.Operation:
+    """Stage run by cluster for key-partitioned operations, other operations are returned as they are"""
+    if isinstance(operation, ParallelReduce):
+        operation = ops.HashReduce(operation.reducer, operation.keys, operation.memory_limit,
+                                   tmp_dir=operation.tmp_dir) if operation.hash_grouping \
+            else ops.Reduce(operation.reducer, operation.keys)
+    elif isinstance(operation, ParallelJoin):
+        operation = ops.HashJoin(operation.joiner, operation.keys, operation.memory_limit,
+                                 tmp_dir=operation.tmp_dir) if operation.hash_join \
+            else ops.Join(operation.joiner, operation.keys)
+    if isinstance(operation, (ops.Reduce, ops.HashReduce, ops.Join, ops.HashJoin)) and operation.keys:
+        return Stage(operation, cluster)
+    return operation
@@ -1,51 +1,523 @@
 # mypy: ignore-errors
 
+from __future__ import annotations
+
+import bisect
+import contextlib
+import heapq
+import itertools
+import os
+import pickle
+import sys
+import tempfile
+import time
 import typing as tp
 
 from multiprocessing import Pipe, Process, connection
-from operator import itemgetter
 
 from . import operations as ops
+from .rows import key_function
+
+DEFAULT_MEMORY_LIMIT = 64 * 1024 * 1024
+RUN_CHUNK_SIZE = 1024
+MAX_MERGE_FAN_IN = 64
+DEFAULT_BATCH_SIZE = 1024
+DEFAULT_SAMPLE_SIZE = 10000
+DRIFT_THRESHOLD = 0.5
+
+
+def _write_run(rows: tp.Iterable[ops.TRow], run_dir: str, run_index: int) -> str:
+    """Dump already sorted rows to a run file in chunks
+    :param rows: sorted rows
+    :param run_dir: directory to create run file in
+    :param run_index: sequence number of the run, keeps file names unique
+    """
+    path = os.path.join(run_dir, f'run_{run_index}.pickle')
+    with open(path, 'wb') as f:
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= RUN_CHUNK_SIZE:
+                pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+                chunk = []
+        if chunk:
+            pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def _read_run(path: str) -> ops.TRowsGenerator:
+    """Stream rows back from a run file written by _write_run"""
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                chunk = pickle.load(f)
+            except EOFError:
+                break
+            yield from chunk
+
+
+def _merge_runs(paths: tp.List[str], key: tp.Callable[[ops.TRow], tp.Any], run_dir: str) -> tp.List[str]:
+    """Merge runs in several passes until at most MAX_MERGE_FAN_IN of them are left.
+    Runs are merged in their original order, so equal rows keep their relative order.
+    """
+    run_index = len(paths)
+    while len(paths) > MAX_MERGE_FAN_IN:
+        merged_paths = []
+        for start in range(0, len(paths), MAX_MERGE_FAN_IN):
+            group = paths[start:start + MAX_MERGE_FAN_IN]
+            merged_paths.append(_write_run(heapq.merge(*map(_read_run, group), key=key), run_dir, run_index))
+            run_index += 1
+            for path in group:
+                os.remove(path)
+        paths = merged_paths
+    return paths
+
+
+def sort_rows(rows: tp.Iterable[tp.Tuple[ops.TRow, int]], keys: tp.Sequence[str],
+              memory_limit: int = DEFAULT_MEMORY_LIMIT, tmp_dir: str | None = None) -> ops.TRowsGenerator:
+    """Stable external merge sort.
+    Rows are collected until their total size exceeds memory_limit, then sorted and spilled to a run file.
+    Runs are combined with k-way heap merge at the end.
+    :param rows: pairs of row and its size estimation in bytes
+    :param keys: sorting keys
+    :param memory_limit: budget for rows kept in memory (in bytes of their serialized form)
+    :param tmp_dir: directory for run files, system default if None
+    """
+    key = key_function(keys)
+    with contextlib.ExitStack() as stack:
+        run_dir = ''
+        paths: tp.List[str] = []
+        buffer: tp.List[ops.TRow] = []
+        buffer_size = 0
+        for row, row_size in rows:
+            buffer.append(row)
+            buffer_size += row_size
+            if buffer_size >= memory_limit:
+                if not run_dir:
+                    run_dir = stack.enter_context(tempfile.TemporaryDirectory(prefix='compgraph_sort_', dir=tmp_dir))
+                buffer.sort(key=key)
+                paths.append(_write_run(buffer, run_dir, len(paths)))
+                buffer, buffer_size = [], 0
+        buffer.sort(key=key)
+        if not paths:
+            yield from buffer
+            return
+        paths = _merge_runs(paths, key, run_dir)
+        yield from heapq.merge(*map(_read_run, paths), iter(buffer), key=key)
+
+
+class TransportStats:
+    """Counters of traffic between main process and sorting process"""
+
+    def __init__(self) -> None:
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.messages_sent = 0
+        self.messages_received = 0
+
+    def reset(self) -> None:
+        self.__init__()
+
+    def __repr__(self) -> str:
+        return (f'TransportStats(bytes_sent={self.bytes_sent}, bytes_received={self.bytes_received}, '
+                f'messages_sent={self.messages_sent}, messages_received={self.messages_received})')
+
+
+class BatchSender:
+    """Packs rows into pickled blocks of batch_size rows, empty block marks end of stream"""
+
+    def __init__(self, endpoint: connection.Connection, batch_size: int,
+                 stats: TransportStats | None = None) -> None:
+        """
+        :param endpoint: connection to send into
+        :param batch_size: number of rows in one message
+        :param stats: counters to update
+        """
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.stats = stats
+        self.row_count = 0
+        self._batch: tp.List[ops.TRow] = []
 
+    def _flush(self) -> None:
+        message = pickle.dumps(self._batch, protocol=pickle.HIGHEST_PROTOCOL)
+        self.endpoint.send_bytes(message)
+        if self.stats is not None:
+            self.stats.bytes_sent += len(message)
+            self.stats.messages_sent += 1
+        self.row_count += len(self._batch)
+        self._batch = []
 
-def do_sort(endpoint: connection.Connection, keys: tuple[str, ...]) -> None:
-    rows = []
+    def send(self, row: ops.TRow) -> None:
+        self._batch.append(row)
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+
+    def close(self) -> int:
+        """Send the rest of rows and end of stream mark
+        :return: number of rows sent
+        """
+        if self._batch:
+            self._flush()
+        self._flush()
+        return self.row_count
+
+
+def send_batches(endpoint: connection.Connection, rows: ops.TRowsIterable, batch_size: int,
+                 stats: TransportStats | None = None) -> int:
+    """Send all rows with BatchSender
+    :return: number of rows sent
+    """
+    sender = BatchSender(endpoint, batch_size, stats)
+    for row in rows:
+        sender.send(row)
+    return sender.close()
+
+
+def receive_batches(endpoint: connection.Connection,
+                    stats: TransportStats | None = None) -> tp.Generator[tp.Tuple[ops.TRow, int], None, None]:
+    """Receive blocks sent by send_batches
+    :return: pairs of row and its share of the message size in bytes
+    """
     while True:
-        row = endpoint.recv()
-        if row is None:
+        message = endpoint.recv_bytes()
+        if stats is not None:
+            stats.bytes_received += len(message)
+            stats.messages_received += 1
+        batch = pickle.loads(message)
+        if not batch:
             break
-        rows.append(row)
-    rows.sort(key=itemgetter(*keys))
-    for row in rows:
-        endpoint.send(row)
-    endpoint.send(None)
+        row_size = len(message) // len(batch)
+        for row in batch:
+            yield row, row_size
+
+
+def do_sort(endpoint: connection.Connection, keys: tuple[str, ...], memory_limit: int = DEFAULT_MEMORY_LIMIT,
+            tmp_dir: str | None = None, batch_size: int = DEFAULT_BATCH_SIZE) -> None:
+    send_batches(endpoint, sort_rows(receive_batches(endpoint), keys, memory_limit, tmp_dir), batch_size)
+
+
+def _serve(endpoint: connection.Connection) -> None:
+    """Loop of long-lived sorting process: report readiness, then serve sort tasks until None arrives"""
+    endpoint.send_bytes(b'')
+    while True:
+        task = endpoint.recv()
+        if task is None:
+            break
+        do_sort(endpoint, *task)
+
+
+class SortWorker:
+    """Handle of a sorting process able to serve many sorts one after another"""
+
+    def __init__(self) -> None:
+        self.endpoint, remote_endpoint = Pipe()
+        self.process = Process(target=_serve, args=(remote_endpoint,), daemon=True)
+        self.process.start()
+        self.endpoint.recv_bytes()
+
+    def submit(self, keys: tp.Sequence[str], memory_limit: int, tmp_dir: str | None, batch_size: int) -> None:
+        """Start new sort, after that rows are exchanged with send_batches / receive_batches"""
+        self.endpoint.send((tuple(keys), memory_limit, tmp_dir, batch_size))
+
+    def stop(self) -> None:
+        """Ask idle worker to exit and wait for it"""
+        self.endpoint.send(None)
+        self.process.join()
+        self.endpoint.close()
+
+    def kill(self) -> None:
+        """Terminate worker in any state, e.g. in the middle of abandoned sort"""
+        self.process.terminate()
+        self.process.join()
+        self.endpoint.close()
+
+
+class PoolStats:
+    """Time spent on starting sorting processes and on sorting itself.
+    Sorting time is measured inside the sort operation, so it includes pulling of input rows,
+    but not the time spent by consumers of sorted rows.
+    """
+
+    def __init__(self) -> None:
+        self.spawn_count = 0
+        self.spawn_seconds = 0.0
+        self.sort_count = 0
+        self.sort_seconds = 0.0
+
+    def reset(self) -> None:
+        self.__init__()
+
+    def __repr__(self) -> str:
+        return (f'PoolStats(spawn_count={self.spawn_count}, spawn_seconds={self.spawn_seconds:.6f}, '
+                f'sort_count={self.sort_count}, sort_seconds={self.sort_seconds:.6f})')
+
+
+class SortWorkerPool:
+    """
+    Reusable sorting processes shared by all sorts of graph runs.
+    Several sorts of one graph are usually active at the same time (one streams its result into another),
+    so when all max_workers processes are busy a temporary process is started instead of waiting.
+    """
+
+    def __init__(self, max_workers: int | None = None) -> None:
+        """
+        :param max_workers: number of processes kept alive, number of CPUs if None
+        """
+        self.max_workers = max_workers if max_workers is not None else (os.cpu_count() or 1)
+        assert self.max_workers >= 1
+        self.stats = PoolStats()
+        self._idle: tp.List[SortWorker] = []
+        self._busy: tp.List[SortWorker] = []
+
+    def _spawn(self) -> SortWorker:
+        started = time.perf_counter()
+        worker = SortWorker()
+        self.stats.spawn_seconds += time.perf_counter() - started
+        self.stats.spawn_count += 1
+        return worker
+
+    def start(self, warm_workers: int | None = None) -> SortWorkerPool:
+        """Start processes in advance so first sorts do not pay for spawning
+        :param warm_workers: number of processes to have ready, max_workers if None
+        """
+        warm_workers = self.max_workers if warm_workers is None else min(warm_workers, self.max_workers)
+        while len(self._idle) + len(self._busy) < warm_workers:
+            self._idle.append(self._spawn())
+        return self
+
+    @property
+    def size(self) -> int:
+        return len(self._idle) + len(self._busy)
+
+    def acquire(self) -> SortWorker:
+        if self._idle:
+            worker = self._idle.pop()
+        else:
+            worker = self._spawn()
+        if self.size < self.max_workers:
+            self._busy.append(worker)
+        return worker
+
+    def release(self, worker: SortWorker, completed: bool = True) -> None:
+        """Return worker after sort
+        :param worker: worker got from acquire
+        :param completed: whether the sort was read till the end, otherwise worker is killed
+        """
+        if worker in self._busy:
+            self._busy.remove(worker)
+            if completed:
+                self._idle.append(worker)
+                return
+        if completed:
+            worker.stop()
+        else:
+            worker.kill()
+
+    def shutdown(self) -> None:
+        """Stop idle processes gracefully and kill the ones in the middle of a sort"""
+        for worker in self._idle:
+            worker.stop()
+        for worker in self._busy:
+            worker.kill()
+        self._idle, self._busy = [], []
+
+    def __enter__(self) -> SortWorkerPool:
+        return self
+
+    def __exit__(self, *args: tp.Any) -> None:
+        self.shutdown()
 
 
 class ExternalSort(ops.Operation):
     """
     In order to not account materialization during sorting in main process memory consumption, we delegate
     sorting to a separate process.
+    The child process keeps at most memory_limit bytes of rows in memory, the rest is spilled to sorted
+    run files in tmp_dir and merged back.
+    Rows travel between processes in blocks of batch_size rows, traffic is counted in stats.
     This class illustrates cross-process streaming.
     """
 
-    def __init__(self, keys: tp.Sequence[str]):
+    def __init__(self, keys: tp.Sequence[str], memory_limit: int = DEFAULT_MEMORY_LIMIT,
+                 tmp_dir: str | None = None, batch_size: int = DEFAULT_BATCH_SIZE):
+        """
+        :param keys: sorting keys
+        :param memory_limit: memory budget of sorting process (in bytes of serialized rows)
+        :param tmp_dir: directory for temporary run files, system default if None
+        :param batch_size: number of rows sent in one message, 1 sends every row separately
+        """
+        assert batch_size >= 1
         self.keys = keys
+        self.memory_limit = memory_limit
+        self.tmp_dir = tmp_dir
+        self.batch_size = batch_size
+        self.stats = TransportStats()
+        self.partition_rows: tp.List[int] = []
+
+    def _acquire_workers(self, count: int, pool: SortWorkerPool | None) -> tp.List[SortWorker]:
+        workers = [pool.acquire() if pool is not None else SortWorker() for _ in range(count)]
+        for worker in workers:
+            worker.submit(self.keys, self.memory_limit, self.tmp_dir, self.batch_size)
+        return workers
+
+    @staticmethod
+    def _release_workers(workers: tp.List[SortWorker], pool: SortWorkerPool | None, completed: bool) -> None:
+        for worker in workers:
+            if pool is not None:
+                pool.release(worker, completed)
+            elif completed:
+                worker.stop()
+            else:
+                worker.kill()
+
+    def _partition(self, rows: ops.TRowsIterable) -> tp.Tuple[ops.TRowsIterable, tp.List[tp.Any]]:
+        """Choose key-range splitters, one sorting process is used per range
+        :return: rows to sort and splitters
+        """
+        return rows, []
+
+    def _sort(self, rows: ops.TRowsIterable, splitters: tp.List[tp.Any],
+              workers: tp.List[SortWorker]) -> ops.TRowsGenerator:
+        senders = [BatchSender(worker.endpoint, self.batch_size, self.stats) for worker in workers]
+        if len(senders) == 1:
+            for row in rows:
+                senders[0].send(row)
+        else:
+            key = key_function(self.keys)
+            for row in rows:
+                senders[bisect.bisect_right(splitters, key(row))].send(row)
+        self.partition_rows = [sender.close() for sender in senders]
+        row_count_before = sum(self.partition_rows)
 
-    def __call__(self, rows: ops.TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> ops.TRowsGenerator:
-        local_endpoint, remote_endpoint = Pipe()
-        process = Process(target=do_sort, args=(remote_endpoint, self.keys))
-        process.start()
-        row_count_before = 0
-        for row in rows:
-            local_endpoint.send(row)
-            row_count_before += 1
-        local_endpoint.send(None)
         row_count_after = 0
-        while True:
-            local_endpoint_row = local_endpoint.recv()
-            if local_endpoint_row is None:
-                break
-            yield local_endpoint_row
-            row_count_after += 1
+        for worker in workers:
+            for row, _ in receive_batches(worker.endpoint, self.stats):
+                yield row
+                row_count_after += 1
         assert row_count_before == row_count_after
-        process.join()
+
+    def __call__(self, rows: ops.TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> ops.TRowsGenerator:
+        """
+        :param rows: rows to sort
+        :param sort_pool: SortWorkerPool to take sorting processes from, new processes are started if None
+        """
+        pool: SortWorkerPool | None = kwargs.get('sort_pool')
+        rows, splitters = self._partition(rows)
+        workers = self._acquire_workers(len(splitters) + 1, pool)
+        sort_seconds = 0.0
+        started = time.perf_counter()
+        completed = False
+        try:
+            for row in self._sort(rows, splitters, workers):
+                sort_seconds += time.perf_counter() - started
+                yield row
+                started = time.perf_counter()
+            sort_seconds += time.perf_counter() - started
+            completed = True
+        finally:
+            self._release_workers(workers, pool, completed)
+            if pool is not None:
+                pool.stats.sort_seconds += sort_seconds
+                pool.stats.sort_count += 1
+
+
+def choose_splitters(sample_keys: tp.List[tp.Any], partitions: int) -> tp.List[tp.Any]:
+    """Pick key-range boundaries splitting sorted sample into roughly equal parts
+    :param sample_keys: sorted keys of sampled rows
+    :param partitions: desired number of partitions
+    :return: sorted distinct splitters, there are at most partitions - 1 of them
+    """
+    splitters: tp.List[tp.Any] = []
+    for i in range(1, partitions):
+        if not sample_keys:
+            break
+        splitter = sample_keys[len(sample_keys) * i // partitions]
+        if not splitters or splitters[-1] < splitter:
+            splitters.append(splitter)
+    return splitters
+
+
+class ParallelSort(ExternalSort):
+    """
+    Sort with several sorting processes.
+    First sample_size rows are used to choose key-range splitters, every row is sent to the process
+    responsible for its range, and sorted ranges are streamed back one after another.
+    When ranges of leading rows drift along the sample (e.g. input is already sorted), the rest of rows
+    would go to one process anyway, so all rows are sorted by one process, as by ExternalSort.
+    Row counts of the ranges of the last sort are kept in partition_rows.
+    Rows with equal keys always go to one process, so the result is the same as of ExternalSort.
+    """
+
+    def __init__(self, keys: tp.Sequence[str], workers: int, memory_limit: int = DEFAULT_MEMORY_LIMIT,
+                 tmp_dir: str | None = None, batch_size: int = DEFAULT_BATCH_SIZE,
+                 sample_size: int = DEFAULT_SAMPLE_SIZE):
+        """
+        :param keys: sorting keys
+        :param workers: number of sorting processes
+        :param memory_limit: memory budget of every sorting process (in bytes of serialized rows)
+        :param tmp_dir: directory for temporary run files, system default if None
+        :param batch_size: number of rows sent in one message
+        :param sample_size: number of leading rows used to choose splitters
+        """
+        super().__init__(keys, memory_limit, tmp_dir, batch_size)
+        assert workers >= 1 and sample_size >= 1
+        self.workers = workers
+        self.sample_size = sample_size
+
+    def _partition(self, rows: ops.TRowsIterable) -> tp.Tuple[ops.TRowsIterable, tp.List[tp.Any]]:
+        rows = iter(rows)
+        sample = list(itertools.islice(rows, self.sample_size))
+        sample_keys = list(map(key_function(self.keys), sample))
+        splitters = choose_splitters(sorted(sample_keys), self.workers)
+        rest = list(itertools.islice(rows, 1))
+        if rest and is_drifting(sample_keys, splitters):
+            splitters = []
+        return itertools.chain(sample, rest, rows), splitters
+
+
+def is_drifting(sample_keys: tp.List[tp.Any], splitters: tp.List[tp.Any]) -> bool:
+    """Check if key ranges of leading rows do not describe the rest of the stream, e.g. of (nearly) sorted input:
+    the two halves of the sample are split into ranges differently, so the following rows would mostly go
+    to one range. Ranges are compared by total variation distance of the shares of rows they get.
+    :param sample_keys: keys of sampled rows in order of the stream
+    :param splitters: key-range boundaries chosen from the sample
+    """
+    middle = len(sample_keys) // 2
+    if middle == 0 or not splitters:
+        return False
+    shares: tp.List[tp.List[float]] = []
+    for half in (sample_keys[:middle], sample_keys[middle:]):
+        counts = [0] * (len(splitters) + 1)
+        for key in half:
+            counts[bisect.bisect_right(splitters, key)] += 1
+        shares.append([count / len(half) for count in counts])
+    return sum(abs(first - second) for first, second in zip(*shares)) / 2 > DRIFT_THRESHOLD
+
+
+class GroupSort(ops.Operation):
+    """
+    Sort of rows which are already sorted by the first prefix_length keys.
+    Only groups of rows with equal prefix are sorted, in current process;
+    a group which does not fit into memory_limit is spilled to disk.
+    The result is the same as of ExternalSort by all keys.
+    """
+
+    def __init__(self, keys: tp.Sequence[str], prefix_length: int, memory_limit: int = DEFAULT_MEMORY_LIMIT,
+                 tmp_dir: str | None = None) -> None:
+        """
+        :param keys: sorting keys
+        :param prefix_length: number of leading keys rows are already sorted by
+        :param memory_limit: budget for one group in memory (in bytes, estimated by sys.getsizeof)
+        :param tmp_dir: directory for temporary run files, system default if None
+        """
+        assert 0 < prefix_length < len(keys)
+        self.keys = keys
+        self.prefix_length = prefix_length
+        self.memory_limit = memory_limit
+        self.tmp_dir = tmp_dir
+
+    def __call__(self, rows: ops.TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> ops.TRowsGenerator:
+        for _, group in itertools.groupby(rows, key=key_function(self.keys[:self.prefix_length])):
+            sized_rows = ((row, sys.getsizeof(row)) for row in group)
+            yield from sort_rows(sized_rows, self.keys, self.memory_limit, self.tmp_dir)
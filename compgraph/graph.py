@@ -2,85 +2,226 @@
 
 from __future__ import annotations
 
+import asyncio
 import typing as tp
+from . import aio
 from . import operations as ops
-from .external_sort import ExternalSort
+from . import dag
+from . import optimizer
+from .external_sort import ExternalSort, ParallelSort, SortWorkerPool, DEFAULT_MEMORY_LIMIT, DEFAULT_BATCH_SIZE
+from .parallel import (ParallelMap, ParallelRead, ParallelReduce, ParallelJoin, DEFAULT_MAP_BATCH_SIZE,
+                       DEFAULT_READ_CHUNK_SIZE)
+from .distributed import Cluster
 
 
 class Graph:
     """Computational graph implementation"""
 
-    def __init__(self, operations: tp.List[ops.Operation], graphs_to_join: tp.List[Graph] | None = None) -> None:
+    def __init__(self, operations: tp.List[ops.Operation], graphs_to_join: tp.List[Graph] | None = None,
+                 sort_pool: SortWorkerPool | None = None, optimize: bool = True, columnar: bool = False,
+                 compact_rows: bool = False, cluster: Cluster | None = None,
+                 tee_memory_limit: int = DEFAULT_MEMORY_LIMIT, tee_tmp_dir: str | None = None) -> None:
         """
+        Settings (sort_pool, optimize, columnar, compact_rows, cluster, tee_memory_limit, tee_tmp_dir)
+        of the graph which is run are applied to joined graphs as well.
         :param operations: operations that graph need to do in run
         :param graphs_to_join: graphs that current graph will join with
+        :param sort_pool: processes used by all sorts when this graph is run
+        :param optimize: whether operations are rewritten by optimizer before run, turn off for debugging
+        :param columnar: whether chains of operations having batch implementation (see columnar.kernel)
+            are done on batches of column arrays, requires numpy
+        :param compact_rows: whether rows read by sources are stored as ops.CompactRow (tuple of values
+            over a shared schema); schema is declared in graph_from_iter/graph_from_file or inferred from rows.
+            Rows yielded by run are plain dicts in any case
+        :param cluster: nodes (see distributed.LocalCluster and distributed.serve) which run reduces and joins
+            by keys on hash partitions of their inputs; the rest of the graph runs in this process
+        :param tee_memory_limit: every stream shared by several graphs (see dag.Plan) spills rows to disk
+            above this budget (in bytes)
+        :param tee_tmp_dir: directory for spilled rows of shared streams, system default if None
         """
         self.operations = operations
         if graphs_to_join is None:
             self.graphs_to_join: tp.List[Graph] = []
         else:
             self.graphs_to_join = graphs_to_join
+        self.sort_pool = sort_pool
+        self.optimize = optimize
+        self.columnar = columnar
+        self.compact_rows = compact_rows
+        self.cluster = cluster
+        self.tee_memory_limit = tee_memory_limit
+        self.tee_tmp_dir = tee_tmp_dir
+
+    def start_sort_pool(self, max_workers: int | None = None, warm_workers: int | None = None) -> SortWorkerPool:
+        """Create sort worker pool owned by this graph, it is reused by all following runs
+        :param max_workers: number of sorting processes kept alive, number of CPUs if None
+        :param warm_workers: number of processes to start right now, max_workers if None
+        """
+        self.shutdown()
+        self.sort_pool = SortWorkerPool(max_workers).start(warm_workers)
+        return self.sort_pool
+
+    def shutdown(self) -> None:
+        """Stop processes of the sort worker pool"""
+        if self.sort_pool is not None:
+            self.sort_pool.shutdown()
+            self.sort_pool = None
+
+    def __enter__(self) -> Graph:
+        return self
+
+    def __exit__(self, *args: tp.Any) -> None:
+        self.shutdown()
+
+    def _extend(self, operation: ops.Operation, join_graph: Graph | None = None) -> Graph:
+        """New graph with operation appended, settings of this graph are kept
+        :param operation: operation to append
+        :param join_graph: graph joined by operation
+        """
+        graphs_to_join = self.graphs_to_join if join_graph is None else self.graphs_to_join + [join_graph]
+        return Graph(self.operations + [operation], graphs_to_join, sort_pool=self.sort_pool, optimize=self.optimize,
+                     columnar=self.columnar, compact_rows=self.compact_rows, cluster=self.cluster,
+                     tee_memory_limit=self.tee_memory_limit, tee_tmp_dir=self.tee_tmp_dir)
 
     @staticmethod
-    def graph_from_iter(name: str) -> Graph:
+    def graph_from_iter(name: str, schema: tp.Sequence[str] | None = None) -> Graph:
         """Construct new graph which reads data from row iterator (in form of sequence of Rows
         from 'kwargs' passed to 'run' method) into graph data-flow
         Use ops.ReadIterFactory
         :param name: name of kwarg to use as data source
+        :param schema: declared columns of all rows, rows are stored as ops.CompactRow if given
         """
-        operation = ops.ReadIterFactory(name)
+        operation = ops.ReadIterFactory(name, None if schema is None else ops.Schema(schema))
         return Graph([operation])
 
     @staticmethod
-    def graph_from_file(filename: str, parser: tp.Callable[[str], ops.TRow]) -> Graph:
+    def graph_from_file(filename: str, parser: tp.Callable[[str], ops.TRow],
+                        schema: tp.Sequence[str] | None = None, workers: int = 1, bulk: bool = False,
+                        ordered: bool = True, chunk_size: int = DEFAULT_READ_CHUNK_SIZE) -> Graph:
         """Construct new graph extended with operation for reading rows from file
         Use ops.Read
         :param filename: filename to read from
         :param parser: parser from string to Row
+        :param schema: declared columns of all rows, rows are stored as ops.CompactRow if given
+        :param workers: number of parsing processes, values above 1 enable ParallelRead for large files
+        :param bulk: parser takes a list of lines and returns iterable of their rows
+        :param ordered: whether parallel read keeps the order of lines
+        :param chunk_size: number of bytes in one task of parallel read
         """
-        operation = ops.Read(filename, parser)
+        operation: ops.Operation
+        row_schema = None if schema is None else ops.Schema(schema)
+        if workers > 1:
+            operation = ParallelRead(filename, parser, workers, chunk_size, ordered, bulk, schema=row_schema)
+        else:
+            operation = ops.Read(filename, parser, row_schema, bulk)
         return Graph([operation])
 
-    def map(self, mapper: ops.Mapper) -> Graph:
+    def map(self, mapper: ops.Mapper, workers: int = 1, ordered: bool = True,
+            batch_size: int = DEFAULT_MAP_BATCH_SIZE, max_in_flight: int | None = None) -> Graph:
         """Construct new graph extended with map operation with particular mapper
         :param mapper: mapper to use
+        :param workers: number of mapping processes, values above 1 enable ParallelMap for CPU-heavy mappers
+        :param ordered: whether parallel map keeps the order of rows
+        :param batch_size: number of rows in one task of parallel map
+        :param max_in_flight: number of batches mapped at the same time, twice the workers if None
+        Async mappers (see ops.AsyncMapper) are run by aio.AsyncMap with their own concurrency, workers
+        and settings of parallel map do not apply to them.
         """
-        operation = ops.Map(mapper)
-        return Graph(self.operations + [operation], self.graphs_to_join)  # type: ignore
+        operation: ops.Operation
+        if isinstance(mapper, ops.AsyncMapper):
+            operation = aio.AsyncMap(mapper)
+        elif workers > 1:
+            operation = ParallelMap(mapper, workers, batch_size, ordered, max_in_flight)
+        else:
+            operation = ops.Map(mapper)
+        return self._extend(operation)
 
-    def reduce(self, reducer: ops.Reducer, keys: tp.Sequence[str]) -> Graph:
+    def reduce(self, reducer: ops.Reducer, keys: tp.Sequence[str], hash_grouping: bool = False,
+               memory_limit: int = DEFAULT_MEMORY_LIMIT, tmp_dir: str | None = None, workers: int = 1) -> Graph:
         """Construct new graph extended with reduce operation with particular reducer
         :param reducer: reducer to use
         :param keys: keys for grouping
+        :param hash_grouping: group rows in hash table, so rows need not be sorted by keys;
+            see ops.HashReduce for output order
+        :param memory_limit: hash grouping spills rows to disk above this budget (in bytes)
+        :param tmp_dir: directory for spilled rows, system default if None
+        :param workers: number of reducing processes, values above 1 enable ParallelReduce on hash partitions
         """
-        operation = ops.Reduce(reducer, keys)
-        return Graph(self.operations + [operation], self.graphs_to_join)  # type: ignore
+        operation: ops.Operation
+        if workers > 1:
+            operation = ParallelReduce(reducer, keys, workers, hash_grouping, memory_limit, tmp_dir)
+        elif hash_grouping:
+            operation = ops.HashReduce(reducer, keys, memory_limit, tmp_dir=tmp_dir)
+        else:
+            operation = ops.Reduce(reducer, keys)
+        return self._extend(operation)
 
-    def sort(self, keys: tp.Sequence[str]) -> Graph:
+    def sort(self, keys: tp.Sequence[str], memory_limit: int = DEFAULT_MEMORY_LIMIT,
+             tmp_dir: str | None = None, batch_size: int = DEFAULT_BATCH_SIZE, workers: int = 1) -> Graph:
         """Construct new graph extended with sort operation
         :param keys: sorting keys (typical is tuple of strings)
+        :param memory_limit: rows above this budget (in bytes) are spilled to disk during sorting
+        :param tmp_dir: directory for spilled sorted runs, system default if None
+        :param batch_size: number of rows in one message exchanged with sorting process
+        :param workers: number of sorting processes, values above 1 enable range-partitioned parallel sort
         """
-        operation = ExternalSort(keys)
-        return Graph(self.operations + [operation], self.graphs_to_join)
+        operation: ExternalSort
+        if workers > 1:
+            operation = ParallelSort(keys, workers, memory_limit, tmp_dir, batch_size)
+        else:
+            operation = ExternalSort(keys, memory_limit, tmp_dir, batch_size)
+        return self._extend(operation)
 
-    def join(self, joiner: ops.Joiner, join_graph: Graph, keys: tp.Sequence[str]) -> Graph:
+    def join(self, joiner: ops.Joiner, join_graph: Graph, keys: tp.Sequence[str], hash_join: bool = False,
+             memory_limit: int = DEFAULT_MEMORY_LIMIT, tmp_dir: str | None = None, workers: int = 1) -> Graph:
         """Construct new graph extended with join operation with another graph
         :param joiner: join strategy to use
         :param join_graph: other graph to join with
         :param keys: keys for grouping
+        :param hash_join: build hash table of the smaller input instead of merging, so inputs need not be
+            sorted by keys; see ops.HashJoin for output order
+        :param memory_limit: hash join spills both inputs to disk when they exceed this budget (in bytes)
+        :param tmp_dir: directory for spilled rows, system default if None
+        :param workers: number of joining processes, values above 1 enable ParallelJoin on hash partitions
+        """
+        operation: ops.Operation
+        if workers > 1:
+            operation = ParallelJoin(joiner, keys, workers, hash_join, memory_limit, tmp_dir)
+        elif hash_join:
+            operation = ops.HashJoin(joiner, keys, memory_limit, tmp_dir=tmp_dir)
+        else:
+            operation = ops.Join(joiner, keys)
+        return self._extend(operation, join_graph)
+
+    def plan(self, optimize: bool | None = None,
+             report: tp.List[optimizer.SortRewrite] | None = None) -> tp.List[ops.Operation]:
+        """Operations which are actually done in run
+        :param optimize: whether to apply optimizer, graph setting is used if None
+        :param report: list to append records about sorts removed or weakened by optimizer
         """
-        operation = ops.Join(joiner, keys)
-        return Graph(self.operations + [operation], self.graphs_to_join + [join_graph])  # type: ignore
+        if optimize is None:
+            optimize = self.optimize
+        return optimizer.optimize(self.operations, report) if optimize else self.operations
+
+    def sort_report(self) -> tp.List[optimizer.SortRewrite]:
+        """Sorts which optimizer removes or weakens in this graph and all joined graphs,
+        operations shared by several graphs are reported once"""
+        report: tp.List[optimizer.SortRewrite] = []
+        dag.Plan(self, self.optimize, report, self.columnar)
+        return report
 
     def run(self, **kwargs: tp.Any) -> ops.TRowsIterable:
-        """Single method to start execution; data sources passed as kwargs"""
-        index_with_data, join_index = 0, 0
-        passed_data = self.operations[index_with_data](**kwargs)
-        for do_operation in self.operations[index_with_data + 1:]:
-            if not isinstance(do_operation, ops.Join):
-                passed_data = do_operation(passed_data)
-            else:
-                data_to_join = self.graphs_to_join[join_index].run(**kwargs)
-                passed_data = do_operation(passed_data, data_to_join)
-                join_index += 1
-        yield from passed_data
+        """Single method to start execution; data sources passed as kwargs.
+        Operations shared by this graph and joined graphs (e.g. common prefix of branches) are done once."""
+        plan = dag.Plan(self, self.optimize, columnar=self.columnar, compact_rows=self.compact_rows)
+        yield from plan.run(kwargs, self.sort_pool, self.tee_memory_limit, self.tee_tmp_dir, cluster=self.cluster)
+
+    async def run_async(self, **kwargs: tp.Any) -> tp.AsyncGenerator[ops.TRow, None]:
+        """Async version of run: rows are yielded by async generator, so the graph can be used inside
+        an event loop. Sources may be async iterables of rows or factories returning them, as well as
+        sources accepted by run. Operations (sorts, reduces, joins) are done in a thread of the default
+        executor, so the event loop stays responsive; async sources are pulled by the event loop."""
+        loop = asyncio.get_running_loop()
+        sources = {name: aio.blocking_source(source, loop) for name, source in kwargs.items()}
+        async for row in aio.run_in_thread(lambda: self.run(**sources)):
+            yield row
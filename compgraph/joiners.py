@@ -1,12 +1,22 @@
+import contextlib
 import itertools
+import sys
+import tempfile
 import typing as tp
 from abc import abstractmethod, ABC
 
+from .rows import as_dict, key_function
+from .spill import partition_rows, read_spilled
+
 TKey = tp.Tuple[tp.Any, ...]
 TRow = dict[str, tp.Any]
 TRowsIterable = tp.Iterable[TRow]
 TRowsGenerator = tp.Generator[TRow, None, None]
 
+DEFAULT_HASH_JOIN_MEMORY_LIMIT = 64 * 1024 * 1024
+DEFAULT_HASH_JOIN_PARTITIONS = 16
+MAX_JOIN_SPILL_DEPTH = 4
+
 
 class Operation(ABC):
     @abstractmethod
@@ -37,15 +47,12 @@ class Join(Operation):  # type ignore
         self.keys = keys
         self.joiner = joiner
 
-    def _keyfunc(self, row: TRow) -> TKey:  # type ignore
-        """Generate a tuple key for grouping rows by specified keys."""
-        return tuple(row[key] for key in self.keys)
-
     def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:  # type ignore
         rows_b = args[0] if args else []
 
-        iter_a = itertools.groupby(rows, key=self._keyfunc)
-        iter_b = itertools.groupby(rows_b, key=self._keyfunc)
+        keyfunc = key_function(self.keys)
+        iter_a = itertools.groupby(rows, key=keyfunc)
+        iter_b = itertools.groupby(rows_b, key=keyfunc)
         key_a, group_a = next(iter_a, (None, None))
         key_b, group_b = next(iter_b, (None, None))
         while key_a is not None or key_b is not None:
@@ -63,14 +70,135 @@ class Join(Operation):  # type ignore
                 key_b, group_b = next(iter_b, (None, None))
 
 
+class HashJoin(Operation):
+    """
+    Join which does not need sorted inputs.
+    Both inputs are read in turns until one of them ends: the finished (smaller) side becomes
+    the build side kept in a hash table, the other side is streamed through it.
+    If both sides exceed memory_limit before one ends, they are spilled to partition files
+    by hash of keys and partitions are joined pairwise.
+    Joiner semantics are the same as in Join: joiner is called with rows of one key;
+    output order: matches in order of streamed side, then unmatched rows of build side.
+    """
+
+    def __init__(self, joiner: Joiner, keys: tp.Sequence[str], memory_limit: int = DEFAULT_HASH_JOIN_MEMORY_LIMIT,
+                 partitions: int = DEFAULT_HASH_JOIN_PARTITIONS, tmp_dir: str | None = None) -> None:
+        """
+        :param joiner: join strategy to use
+        :param keys: join keys
+        :param memory_limit: budget for rows of each side (in bytes, estimated by sys.getsizeof)
+        :param partitions: number of partition files of each side when spilling
+        :param tmp_dir: directory for partition files, system default if None
+        """
+        assert partitions >= 2
+        self.joiner = joiner
+        self.keys = keys
+        self.memory_limit = memory_limit
+        self.partitions = partitions
+        self.tmp_dir = tmp_dir
+
+    def _build_and_probe(self, build_rows: TRowsIterable, probe_rows: TRowsIterable,
+                         build_is_left: bool) -> TRowsGenerator:
+        keyfunc = key_function(self.keys)
+        table: tp.Dict[TKey, tp.List[TRow]] = {}
+        for row in build_rows:
+            table.setdefault(keyfunc(row), []).append(row)
+
+        keep_unmatched_build = isinstance(self.joiner, (LeftJoiner, OuterJoiner) if build_is_left
+                                          else (RightJoiner, OuterJoiner))
+        keep_unmatched_probe = isinstance(self.joiner, (RightJoiner, OuterJoiner) if build_is_left
+                                          else (LeftJoiner, OuterJoiner))
+        matched: tp.Set[TKey] = set()
+        for row in probe_rows:
+            key = keyfunc(row)
+            group = table.get(key)
+            if group is None and not keep_unmatched_probe:
+                continue
+            if group is not None and keep_unmatched_build:
+                matched.add(key)
+            if build_is_left:
+                yield from self.joiner(self.keys, group or [], [row])
+            else:
+                yield from self.joiner(self.keys, [row], group or [])
+
+        if keep_unmatched_build:
+            for key, group in table.items():
+                if key not in matched:
+                    if build_is_left:
+                        yield from self.joiner(self.keys, group, [])
+                    else:
+                        yield from self.joiner(self.keys, [], group)
+
+    def _join(self, rows_a: TRowsIterable, rows_b: TRowsIterable, depth: int,
+              stack: contextlib.ExitStack) -> TRowsGenerator:
+        iter_a, iter_b = iter(rows_a), iter(rows_b)
+        buffer_a: tp.List[TRow] = []
+        buffer_b: tp.List[TRow] = []
+        size = 0
+        end = object()
+        while True:
+            row_a = next(iter_a, end)
+            if row_a is end:
+                yield from self._build_and_probe(buffer_a, itertools.chain(buffer_b, iter_b), True)
+                return
+            buffer_a.append(row_a)
+            row_b = next(iter_b, end)
+            if row_b is end:
+                yield from self._build_and_probe(buffer_b, itertools.chain(buffer_a, iter_a), False)
+                return
+            buffer_b.append(row_b)
+            size += min(sys.getsizeof(row_a), sys.getsizeof(row_b))
+            if size > self.memory_limit and depth < MAX_JOIN_SPILL_DEPTH:
+                break
+
+        run_dir = stack.enter_context(tempfile.TemporaryDirectory(prefix='compgraph_join_', dir=self.tmp_dir))
+        paths_a = partition_rows(itertools.chain(buffer_a, iter_a), self.keys, self.partitions, depth, run_dir, 'a')
+        buffer_a.clear()
+        paths_b = partition_rows(itertools.chain(buffer_b, iter_b), self.keys, self.partitions, depth, run_dir, 'b')
+        buffer_b.clear()
+        for path_a, path_b in zip(paths_a, paths_b):
+            yield from self._join(read_spilled(path_a), read_spilled(path_b), depth + 1, stack)
+
+    def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
+        rows_b = args[0] if args else []
+        with contextlib.ExitStack() as stack:
+            yield from self._join(rows, rows_b, 0, stack)
+
+
+class BroadcastJoin(Operation):
+    """
+    Key-less join with a small (often single-row) right side: right rows are read once into memory
+    and every left row is joined with all of them, so memory does not depend on the left side size.
+    Output order is the same as of Join with empty keys for inner, left and outer joiners;
+    right joiner gives the same rows in order of left side.
+    """
+
+    def __init__(self, joiner: Joiner) -> None:
+        """
+        :param joiner: join strategy to use
+        """
+        self.joiner = joiner
+        self.keys: tp.Sequence[str] = []
+
+    def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
+        # right rows are converted once, so joiners get them as dicts for every left row
+        rows_b = list(map(as_dict, args[0])) if args else []
+        left_is_empty = True
+        for row in rows:
+            left_is_empty = False
+            yield from self.joiner(self.keys, [row], rows_b)
+        if left_is_empty and rows_b and isinstance(self.joiner, (RightJoiner, OuterJoiner)):
+            yield from self.joiner(self.keys, [], rows_b)
+
+
 class InnerJoiner(Joiner):
     """Join with inner strategy"""
 
     def __call__(
             self, keys: tp.Sequence[str], rows_a: TRowsIterable, rows_b: TRowsIterable
     ) -> TRowsGenerator:
-        rows_b_list = list(rows_b)
-        for row_a in rows_a:
+        rows_b_list = list(map(as_dict, rows_b))
+        for row_a in map(as_dict, rows_a):
             for row_b in rows_b_list:
                 yield self._merge_rows(row_a, row_b, keys)
 
@@ -97,8 +225,8 @@ class OuterJoiner(Joiner):
     """Join with outer strategy"""
 
     def __call__(self, keys: tp.Sequence[str], rows_a: TRowsIterable, rows_b: TRowsIterable) -> TRowsGenerator:
-        rows_a_list = list(rows_a)
-        rows_b_list = list(rows_b)
+        rows_a_list = list(map(as_dict, rows_a))
+        rows_b_list = list(map(as_dict, rows_b))
         matched_b = set()
 
         for row_a in rows_a_list:
@@ -120,8 +248,8 @@ class LeftJoiner(Joiner):
     """Join with left strategy"""
 
     def __call__(self, keys: tp.Sequence[str], rows_a: TRowsIterable, rows_b: TRowsIterable) -> TRowsGenerator:
-        rows_b_list = list(rows_b)
-        for row_a in rows_a:
+        rows_b_list = list(map(as_dict, rows_b))
+        for row_a in map(as_dict, rows_a):
             matched = False
             for row_b in rows_b_list:
                 if all(row_a[key] == row_b[key] for key in keys):
@@ -135,8 +263,8 @@ class RightJoiner(Joiner):
     """Join with right strategy"""
 
     def __call__(self, keys: tp.Sequence[str], rows_a: TRowsIterable, rows_b: TRowsIterable) -> TRowsGenerator:
-        rows_a_list = list(rows_a)
-        for row_b in rows_b:
+        rows_a_list = list(map(as_dict, rows_a))
+        for row_b in map(as_dict, rows_b):
             matched = False
             for row_a in rows_a_list:
                 if all(row_b[key] == row_a[key] for key in keys):
@@ -1,11 +1,21 @@
+import asyncio
 import datetime
+import functools
 import re
 import string
+import sys
+import threading
 import typing as tp
 from abc import abstractmethod, ABC
-from copy import deepcopy, copy
 from math import log, radians, asin, sin, pow, sqrt, cos
 
+from .rows import OverlayRow
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
 TRow = dict[str, tp.Any]
 TRowsIterable = tp.Iterable[TRow]
 TRowsGenerator = tp.Generator[TRow, None, None]
@@ -17,6 +27,16 @@ class Operation(ABC):
         pass
 
 
+def unchanged_prefix(keys: tp.Sequence[str], changed_columns: tp.Container[str]) -> tp.Tuple[str, ...]:
+    """Leading keys up to the first changed column"""
+    prefix: tp.List[str] = []
+    for key in keys:
+        if key in changed_columns:
+            break
+        prefix.append(key)
+    return tuple(prefix)
+
+
 class Mapper(ABC):
     """Base class for mappers"""
 
@@ -27,6 +47,39 @@ class Mapper(ABC):
         """
         pass
 
+    def ordered_by(self, keys: tp.Sequence[str]) -> tp.Tuple[str, ...]:
+        """Used by optimizer to track sortedness: if input rows are sorted by keys,
+        output rows are sorted by returned prefix of keys. Unknown mappers break any order.
+        :param keys: keys input rows are sorted by
+        """
+        return ()
+
+
+class RowUpdater(Mapper):
+    """Base class for mappers yielding exactly one row: a copy-on-write overlay of the passed row
+    with some columns changed"""
+
+    @abstractmethod
+    def update(self, row: TRow) -> None:
+        """Change row in place
+        :param row: row owned by caller
+        """
+        pass
+
+    def __call__(self, row: TRow) -> TRowsGenerator:
+        row_copy = OverlayRow(row)
+        self.update(row_copy)
+        yield row_copy
+
+    @property
+    @abstractmethod
+    def changed_columns(self) -> tp.Tuple[str, ...]:
+        """Columns which update may change"""
+        pass
+
+    def ordered_by(self, keys: tp.Sequence[str]) -> tp.Tuple[str, ...]:
+        return unchanged_prefix(keys, self.changed_columns)
+
 
 class Map(Operation):
     def __init__(self, mapper: Mapper) -> None:
@@ -38,14 +91,62 @@ class Map(Operation):
                 yield mapped_row
 
 
+class FusedMap(Operation):
+    """
+    Several consecutive maps done in one pass over rows.
+    Filters are checked in place and row updaters change one shared overlay of the row,
+    other mappers are called as usual.
+    """
+
+    def __init__(self, mappers: tp.Sequence[Mapper]) -> None:
+        self.mappers = list(mappers)
+
+    def _apply(self, row: TRow, start: int, owned: bool) -> TRowsGenerator:
+        """
+        :param row: row to pass through mappers
+        :param start: index of the first mapper to apply
+        :param owned: whether row is a private copy which may be changed in place
+        """
+        for index in range(start, len(self.mappers)):
+            mapper = self.mappers[index]
+            if isinstance(mapper, Filter):
+                if not mapper.condition(row):
+                    return
+            elif isinstance(mapper, RowUpdater):
+                if not owned:
+                    row = OverlayRow(row)
+                    owned = True
+                mapper.update(row)
+            else:
+                fresh_rows = isinstance(mapper, (Split, Project))
+                for mapped_row in mapper(row):
+                    yield from self._apply(mapped_row, index + 1, fresh_rows)
+                return
+        yield row
+
+    def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
+        for row in rows:
+            yield from self._apply(row, 0, False)
+
+    def ordered_by(self, keys: tp.Sequence[str]) -> tp.Tuple[str, ...]:
+        """Sortedness of output rows, see Mapper.ordered_by"""
+        ordering = tuple(keys)
+        for mapper in self.mappers:
+            ordering = mapper.ordered_by(ordering)
+        return ordering
+
+
 class DummyMapper(Mapper):
     """Yield exactly the row passed"""
 
     def __call__(self, row: TRow) -> TRowsGenerator:
         yield row
 
+    def ordered_by(self, keys: tp.Sequence[str]) -> tp.Tuple[str, ...]:
+        return tuple(keys)
 
-class FilterPunctuation(Mapper):  # type ignore
+
+class FilterPunctuation(RowUpdater):  # type ignore
     """Left only non-punctuation symbols"""
 
     def __init__(self, column: str):  # type ignore
@@ -54,16 +155,16 @@ class FilterPunctuation(Mapper):  # type ignore
         """
         self.column = column
 
-    def __call__(self, row: TRow) -> TRowsGenerator:  # type ignore
-        row_copy = row.copy()
-        if self.column in row_copy:
-            row_copy[self.column] = ''.join(
-                char for char in str(row_copy[self.column]) if char not in string.punctuation
-            )
-        yield row_copy
+    def update(self, row: TRow) -> None:
+        if self.column in row:
+            row[self.column] = str(row[self.column]).translate(PUNCTUATION_TABLE)
+
+    @property
+    def changed_columns(self) -> tp.Tuple[str, ...]:
+        return self.column,
 
 
-class LowerCase(Mapper):  # type ignore
+class LowerCase(RowUpdater):  # type ignore
     """Replace column value with value in lower case"""
 
     def __init__(self, column: str):  # type ignore
@@ -76,50 +177,237 @@ class LowerCase(Mapper):  # type ignore
     def _lower_case(txt: str) -> str:
         return txt.lower()
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
-        row_copy = row.copy()
-        if self.column in row_copy:
-            row_copy[self.column] = str(row_copy[self.column]).lower()
-        yield row_copy
+    def update(self, row: TRow) -> None:
+        if self.column in row:
+            row[self.column] = str(row[self.column]).lower()
+
+    @property
+    def changed_columns(self) -> tp.Tuple[str, ...]:
+        return self.column,
 
 
-class Calculate(Mapper):
-    def __init__(self, operation: tp.Callable, params: tp.Dict[str, str], result_column: str) -> None:  # type: ignore
+class Calculate(RowUpdater):
+    def __init__(self, operation: tp.Callable, params: tp.Dict[str, str], result_column: str,  # type: ignore
+                 vectorized: bool = False) -> None:
+        """
+        :param operation: function of row and params returning value of result_column
+        :param params: keyword arguments of operation
+        :param result_column: column to save result in
+        :param vectorized: operation is NumPy-aware: it gives array of results when columns of row are arrays,
+            which lets columnar mode compute it for a whole batch at once
+        """
         self.operation = operation
         self.params = params
         self.result_column = result_column
+        self.vectorized = vectorized
+
+    def update(self, row: TRow) -> None:
+        row[self.result_column] = self.operation(row, **self.params)
+
+    @property
+    def changed_columns(self) -> tp.Tuple[str, ...]:
+        return self.result_column,
+
+
+DEFAULT_ASYNC_CONCURRENCY = 16
+
+
+class AsyncMapper(Mapper):
+    """
+    Base class for mappers awaiting a coroutine for every row, e.g. a request to a service.
+    Graph.map runs them by aio.AsyncMap, which maps up to concurrency rows at the same time;
+    called as a plain mapper, it maps rows one by one in a new event loop.
+    """
+
+    def __init__(self, concurrency: int = DEFAULT_ASYNC_CONCURRENCY, ordered: bool = True,
+                 timeout: float | None = None) -> None:
+        """
+        :param concurrency: number of rows being mapped at the same time
+        :param ordered: whether output keeps the order of input rows, otherwise rows follow as they are done
+        :param timeout: seconds given to mapping of one row, TimeoutError is raised when it is exceeded
+        """
+        assert concurrency >= 1
+        self.concurrency = concurrency
+        self.ordered = ordered
+        self.timeout = timeout
+
+    @abstractmethod
+    async def map_async(self, row: TRow) -> tp.List[TRow]:
+        """
+        :param row: one table row
+        :return: rows the row is mapped to
+        """
+        pass
+
+    async def map_row(self, row: TRow) -> tp.List[TRow]:
+        """map_async limited by timeout"""
+        return await asyncio.wait_for(self.map_async(row), self.timeout)
 
     def __call__(self, row: TRow) -> TRowsGenerator:
-        result = self.operation(row, **self.params)
-        copied_row = deepcopy(row)
-        copied_row[self.result_column] = result
-        yield copied_row
+        yield from asyncio.run(self.map_row(row))
+
+
+class AsyncCalculate(AsyncMapper):
+    """Calculate with a coroutine function"""
+
+    def __init__(self, operation: tp.Callable[..., tp.Awaitable[tp.Any]], params: tp.Dict[str, str],
+                 result_column: str, concurrency: int = DEFAULT_ASYNC_CONCURRENCY, ordered: bool = True,
+                 timeout: float | None = None) -> None:
+        """
+        :param operation: coroutine function of row and params returning value of result_column
+        :param params: keyword arguments of operation
+        :param result_column: column to save result in
+        :param concurrency: number of rows being calculated at the same time
+        :param ordered: whether output keeps the order of input rows
+        :param timeout: seconds given to one call of operation
+        """
+        super().__init__(concurrency, ordered, timeout)
+        self.operation = operation
+        self.params = params
+        self.result_column = result_column
+
+    async def map_async(self, row: TRow) -> tp.List[TRow]:
+        row_copy = OverlayRow(row)
+        row_copy[self.result_column] = await self.operation(row_copy, **self.params)
+        return [row_copy]  # type: ignore[list-item]
+
+    def ordered_by(self, keys: tp.Sequence[str]) -> tp.Tuple[str, ...]:
+        return unchanged_prefix(keys, (self.result_column,))
+
+
+TIMESTAMP_FORMAT = "%Y%m%dT%H%M%S.%f"
+TIMESTAMP_CACHE_SIZE = 4096
+EARTH_RADIUS = 6373.0
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+WHITESPACE_SEPARATOR = r'\s+'
+REGEX_SPECIAL_CHARACTERS = frozenset('.^$*+?{}[]\\|()')
+SPLIT_FAST_PATH_LENGTH = 16 * 1024
+SPLIT_BATCH_ROWS = 256
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+# ascii texts are cleaned from punctuation and lower-cased by one translate pass
+ASCII_NORMALIZATION_TABLE = str.maketrans(string.ascii_uppercase, string.ascii_lowercase, string.punctuation)
+
+
+def _is_column(value: tp.Any) -> bool:
+    """Whether value is a column of a batch in columnar mode rather than a value of one row"""
+    return np is not None and isinstance(value, np.ndarray)
+
+
+def _number(digits: tp.Any, start: int, stop: int) -> tp.Any:
+    return digits[:, start:stop] @ 10 ** np.arange(stop - start - 1, -1, -1)
+
+
+def parse_timestamps(values: tp.Any) -> tp.Any:
+    """Vectorized datetime.strptime with TIMESTAMP_FORMAT
+    :param values: array of strings
+    :return: array of datetime64[us]
+    """
+    text = np.asarray(values).astype('S')
+    width = text.dtype.itemsize
+    if len(text) == 0 or not 17 <= width <= 22:
+        return np.array([datetime.datetime.strptime(value, TIMESTAMP_FORMAT) for value in values], dtype='M8[us]')
+    chars = text.view(np.uint8).reshape(len(text), width)
+    digits = chars.astype(np.int64) - ord('0')
+    fraction = digits[:, 16:]
+    padding = chars[:, 16:] == 0
+    is_digit = (digits >= 0) & (digits <= 9)
+    year, month, day = _number(digits, 0, 4), _number(digits, 4, 6), _number(digits, 6, 8)
+    hours, minutes, seconds = _number(digits, 9, 11), _number(digits, 11, 13), _number(digits, 13, 15)
+    months = ((year - 1970) * 12 + month - 1).astype('M8[M]')
+    dates = months.astype('M8[D]') + (day - 1).astype('m8[D]')
+    valid = is_digit[:, :8].all() and is_digit[:, 9:15].all() and (chars[:, 8] == ord('T')).all() \
+        and (chars[:, 15] == ord('.')).all() and (is_digit[:, 16:] | padding).all() and not padding[:, 0].any() \
+        and ((month >= 1) & (month <= 12) & (day >= 1) & (dates.astype('M8[M]') == months)).all() \
+        and ((hours < 24) & (minutes < 60) & (seconds < 60)).all()
+    if not valid:
+        # let strptime raise the same error as in row mode
+        return np.array([datetime.datetime.strptime(value, TIMESTAMP_FORMAT) for value in values], dtype='M8[us]')
+    fraction = np.where(padding, 0, fraction) @ 10 ** np.arange(5, 5 - fraction.shape[1], -1)
+    offsets = ((hours * 60 + minutes) * 60 + seconds) * 1000000 + fraction
+    return dates.astype('M8[us]') + offsets.astype('m8[us]')
+
+
+@functools.lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def parse_timestamp(value: str) -> datetime.datetime:
+    """datetime.strptime with TIMESTAMP_FORMAT, recently parsed strings are cached"""
+    return datetime.datetime.strptime(value, TIMESTAMP_FORMAT)
+
+
+def _timestamp(value: tp.Any) -> datetime.datetime:
+    """Value of a timestamp column: either already parsed or a string"""
+    return value if isinstance(value, datetime.datetime) else parse_timestamp(value)
+
+
+def timestamp_column(values: tp.Any) -> tp.Any:
+    """Batch column of timestamps: either already parsed (datetime64) or strings"""
+    return values.astype('M8[us]') if values.dtype.kind == 'M' else parse_timestamps(values)
+
+
+class ParseTimestamp(RowUpdater):
+    """
+    Parse string column with TIMESTAMP_FORMAT into datetime once, so that following road_time, hour,
+    weekday and user functions do not parse it again. In columnar mode the column becomes datetime64 array.
+    """
+
+    def __init__(self, column: str, result_column: str | None = None) -> None:
+        """
+        :param column: name of column with timestamp strings
+        :param result_column: column to save parsed value in, column itself if None
+        """
+        self.column = column
+        self.result_column = column if result_column is None else result_column
+
+    def update(self, row: TRow) -> None:
+        row[self.result_column] = _timestamp(row[self.column])
+
+    @property
+    def changed_columns(self) -> tp.Tuple[str, ...]:
+        return self.result_column,
 
 
 def haversine_distance(row: TRow, start_coords: str, end_coords: str) -> float:
-    R = 6373.0
+    """NumPy-aware: columns of [lon, lat] pairs give array of distances in km"""
+    if _is_column(row[start_coords]):
+        start_lon, start_lat = np.radians(np.array(row[start_coords].tolist(), dtype=float)).T
+        end_lon, end_lat = np.radians(np.array(row[end_coords].tolist(), dtype=float)).T
+        return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(
+            np.sin((end_lat - start_lat) / 2) ** 2 + np.cos(start_lat) * np.cos(end_lat) *
+            np.sin((end_lon - start_lon) / 2) ** 2))
+
     start_lon, start_lat = [radians(coord) for coord in row[start_coords]]
     end_lon, end_lat = [radians(coord) for coord in row[end_coords]]
 
     archaversine = asin(sqrt(
         pow(sin((end_lat - start_lat) / 2), 2) + cos(start_lat) * cos(end_lat) * pow(sin((end_lon - start_lon) / 2),
                                                                                      2)))
-    return 2 * R * archaversine
+    return 2 * EARTH_RADIUS * archaversine
 
 
 def road_time(row: TRow, enter_time: str, leave_time: str) -> float:
-    formatted_enter_time = datetime.datetime.strptime(row[enter_time], "%Y%m%dT%H%M%S.%f")
-    formatted_leave_time = datetime.datetime.strptime(row[leave_time], "%Y%m%dT%H%M%S.%f")
-    return (formatted_leave_time - formatted_enter_time).total_seconds()
+    """Columns are timestamp strings or values parsed by ParseTimestamp.
+    NumPy-aware: batch columns give array of seconds"""
+    if _is_column(row[enter_time]):
+        return (timestamp_column(row[leave_time]) - timestamp_column(row[enter_time])) / np.timedelta64(1, 's')
+    return (_timestamp(row[leave_time]) - _timestamp(row[enter_time])).total_seconds()
 
 
 def weekday(row: TRow, datetime_column: str) -> str:
-    all_weekdays = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
-    return all_weekdays[datetime.datetime.strptime(row[datetime_column], "%Y%m%dT%H%M%S.%f").weekday()]
+    """Column is timestamp string or value parsed by ParseTimestamp.
+    NumPy-aware: batch column gives array of weekday names"""
+    if _is_column(row[datetime_column]):
+        days = timestamp_column(row[datetime_column]).astype('M8[D]').astype(np.int64)
+        # 1970-01-01 is Thursday
+        return np.array(WEEKDAYS)[(days + 3) % 7]
+    return WEEKDAYS[_timestamp(row[datetime_column]).weekday()]
 
 
 def hour(row: TRow, datetime_column: str) -> int:
-    return datetime.datetime.strptime(row[datetime_column], "%Y%m%dT%H%M%S.%f").hour
+    """Column is timestamp string or value parsed by ParseTimestamp.
+    NumPy-aware: batch column gives array of hours"""
+    if _is_column(row[datetime_column]):
+        timestamps = timestamp_column(row[datetime_column])
+        return (timestamps - timestamps.astype('M8[D]')) // np.timedelta64(1, 'h')
+    return _timestamp(row[datetime_column]).hour
 
 
 def speed(row: TRow, distance: str, time: str) -> float:
@@ -127,31 +415,189 @@ def speed(row: TRow, distance: str, time: str) -> float:
     return row[distance] / row[time] * from_meters_per_second
 
 
-class Split(Mapper):
-    """Split row on multiple rows by separator"""
+class ValueDictionary:
+    """
+    Integer codes of column values, given in order of first appearance: equal values get equal codes,
+    so rows may be sorted, grouped and joined by codes, but the order of codes is not the order of values.
+    One dictionary is shared by the encoding mappers (EncodeColumn, Split) and DecodeColumn of a graph
+    and grows with every run; it lives in the process running the graph, so these mappers must not be run
+    by ParallelMap.
+    """
+
+    def __init__(self) -> None:
+        self.codes: tp.Dict[tp.Any, int] = {}
+        self.values: tp.List[tp.Any] = []
+        self._lock = threading.Lock()
+
+    def encode(self, value: tp.Any) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            with self._lock:
+                code = self.codes.get(value)
+                if code is None:
+                    code = len(self.values)
+                    self.values.append(value)
+                    self.codes[value] = code
+        return code
+
+    def encode_all(self, values: tp.Iterable[tp.Any]) -> tp.List[int]:
+        codes = self.codes
+        return [codes[value] if value in codes else self.encode(value) for value in values]
+
+    def decode(self, code: int) -> tp.Any:
+        return self.values[code]
+
+    def __len__(self) -> int:
+        return len(self.values)
 
-    def __init__(self, column: str, separator: str = r'\s+') -> None:
+
+class Split(Mapper):
+    """
+    Split row on multiple rows by separator.
+    Texts up to SPLIT_FAST_PATH_LENGTH split by whitespace or a literal separator are cut with str.split
+    and their rows are emitted in batches, other texts are scanned by the precompiled pattern;
+    rows are the same in both cases.
+    """
+
+    def __init__(self, column: str, separator: str = WHITESPACE_SEPARATOR, intern_tokens: bool = False,
+                 dictionary: ValueDictionary | None = None) -> None:
         """
         :param column: name of column to split
-        :param separator: string to separate by
+        :param separator: regular expression to separate by
+        :param intern_tokens: whether to intern emitted tokens (sys.intern), so repeated words share one string
+            object in rows of this process. Pickling (sort workers, spill files, other processes) writes
+            a repeated word once per pickled batch, but unpickled rows share it only within that batch
+        :param dictionary: emit integer codes of tokens in this dictionary instead of tokens (see ValueDictionary),
+            intern_tokens is not needed then
         """
         self.column = column
         self.separator = separator
+        self.intern_tokens = intern_tokens
+        self.dictionary = dictionary
+        self._pattern = re.compile(separator)
+        self._literal: str | None = None
+        if separator and not any(char in REGEX_SPECIAL_CHARACTERS for char in separator):
+            self._literal = separator
+
+    def tokens(self, text: str) -> tp.Iterable[str]:
+        """Parts of text between separators: leading empty part is kept, trailing one is not"""
+        if len(text) <= SPLIT_FAST_PATH_LENGTH:
+            if self.separator == WHITESPACE_SEPARATOR:
+                tokens = text.split()
+                if text[:1].isspace():
+                    tokens.insert(0, '')
+                return tokens
+            if self._literal is not None:
+                tokens = text.split(self._literal)
+                if not tokens[-1]:
+                    tokens.pop()
+                return tokens
+        return self._scan(text)
+
+    def _scan(self, text: str) -> tp.Iterator[str]:
+        last_split_index = 0
+        for separator_match in self._pattern.finditer(text):
+            yield text[last_split_index:separator_match.start()]
+            last_split_index = separator_match.end()
+        if len(text) != last_split_index:
+            yield text[last_split_index:]
 
     def __call__(self, row: TRow) -> TRowsGenerator:
-        last_split_index: int = 0
-        for separator_match in re.finditer(re.compile(self.separator), row[self.column]):
-            new_row = copy(row)
-            new_row.update({self.column: row[self.column][last_split_index:separator_match.start()]})
-            last_split_index = separator_match.end()
-            yield new_row
-        if len(row[self.column]) != last_split_index:
-            new_row = copy(row)
-            new_row.update({self.column: row[self.column][last_split_index:len(row[self.column])]})
-            yield new_row
+        return self._emit(row, self.tokens(row[self.column]))
+
+    def _emit(self, row: TRow, tokens: tp.Iterable[str]) -> TRowsGenerator:
+        column = self.column
+        values: tp.Iterable[tp.Any] = tokens
+        if not isinstance(tokens, list):
+            if self.dictionary is not None:
+                values = map(self.dictionary.encode, tokens)
+            elif self.intern_tokens:
+                values = map(sys.intern, tokens)
+            for value in values:
+                yield OverlayRow(row, {column: value})
+            return
+        batch: tp.List[tp.Any] = tokens
+        if self.dictionary is not None:
+            batch = self.dictionary.encode_all(tokens)
+        elif self.intern_tokens:
+            batch = list(map(sys.intern, tokens))
+        for start in range(0, len(batch), SPLIT_BATCH_ROWS):
+            yield from [OverlayRow(row, {column: value}) for value in batch[start:start + SPLIT_BATCH_ROWS]]
+
+    def ordered_by(self, keys: tp.Sequence[str]) -> tp.Tuple[str, ...]:
+        return unchanged_prefix(keys, (self.column,))
+
+
+class NormalizeText(Split):
+    """
+    FilterPunctuation, LowerCase and Split of one column in one mapper: the text is cleaned and
+    lower-cased by str.translate (one pass for ascii texts), then split; every token row is the only
+    copy of the input row. Rows are the same as of the three mappers in a row, in any order of
+    the first two.
+    """
+
+    def __init__(self, column: str, separator: str = WHITESPACE_SEPARATOR, intern_tokens: bool = False,
+                 dictionary: ValueDictionary | None = None) -> None:
+        """
+        :param column: name of column to normalize and split
+        :param separator: regular expression to separate by, applied to normalized text
+        :param intern_tokens: whether to intern emitted tokens, see Split
+        :param dictionary: emit integer codes of tokens in this dictionary, see Split
+        """
+        super().__init__(column, separator, intern_tokens, dictionary)
 
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Text without punctuation in lower case"""
+        if text.isascii():
+            return text.translate(ASCII_NORMALIZATION_TABLE)
+        return text.translate(PUNCTUATION_TABLE).lower()
+
+    def __call__(self, row: TRow) -> TRowsGenerator:
+        return self._emit(row, self.tokens(self.normalize(str(row[self.column]))))
+
+
+class EncodeColumn(RowUpdater):
+    """Replace column value with its integer code in dictionary, see ValueDictionary"""
+
+    def __init__(self, column: str, dictionary: ValueDictionary) -> None:
+        """
+        :param column: name of column to encode
+        :param dictionary: dictionary shared with DecodeColumn
+        """
+        self.column = column
+        self.dictionary = dictionary
+
+    def update(self, row: TRow) -> None:
+        if self.column in row:
+            row[self.column] = self.dictionary.encode(row[self.column])
+
+    @property
+    def changed_columns(self) -> tp.Tuple[str, ...]:
+        return self.column,
 
-class ReverseFreq(Mapper):
+
+class DecodeColumn(RowUpdater):
+    """Replace integer code in column with the value it was given for by EncodeColumn or Split"""
+
+    def __init__(self, column: str, dictionary: ValueDictionary) -> None:
+        """
+        :param column: name of column to decode
+        :param dictionary: dictionary the codes were given in
+        """
+        self.column = column
+        self.dictionary = dictionary
+
+    def update(self, row: TRow) -> None:
+        if self.column in row:
+            row[self.column] = self.dictionary.decode(row[self.column])
+
+    @property
+    def changed_columns(self) -> tp.Tuple[str, ...]:
+        return self.column,
+
+
+class ReverseFreq(RowUpdater):
     """Calculates inversion of the frequency with which a certain word occurs in the collection documents"""
 
     def __init__(self, total_docs_column: str, docs_column: str, result_column: str = 'idf') -> None:
@@ -164,13 +610,15 @@ class ReverseFreq(Mapper):
         self.total_docs_column = total_docs_column
         self.result_column = result_column
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
-        copied_row: TRow = deepcopy(row)
-        copied_row[self.result_column] = log(row[self.total_docs_column]) - log(row[self.docs_column])
-        yield copied_row
+    def update(self, row: TRow) -> None:
+        row[self.result_column] = log(row[self.total_docs_column]) - log(row[self.docs_column])
 
+    @property
+    def changed_columns(self) -> tp.Tuple[str, ...]:
+        return self.result_column,
 
-class Product(Mapper):  # type ignore
+
+class Product(RowUpdater):  # type ignore
     """Calculates product of multiple columns"""
 
     def __init__(self, columns: tp.Sequence[str], result_column: str = 'product') -> None:  # type ignore
@@ -181,28 +629,36 @@ class Product(Mapper):  # type ignore
         self.columns = columns
         self.result_column = result_column
 
-    def __call__(self, row: TRow) -> TRowsGenerator:  # type ignore
-        row_copy = row.copy()
+    def update(self, row: TRow) -> None:  # type ignore
         product = 1
         for column in self.columns:
-            product *= row_copy.get(column, 1)
-        row_copy[self.result_column] = product
-        yield row_copy
+            product *= row.get(column, 1)
+        row[self.result_column] = product
+
+    @property
+    def changed_columns(self) -> tp.Tuple[str, ...]:
+        return self.result_column,
 
 
 class Filter(Mapper):  # type ignore
     """Remove records that don't satisfy some condition"""
 
-    def __init__(self, condition: tp.Callable[[TRow], bool]) -> None:  # type ignore
+    def __init__(self, condition: tp.Callable[[TRow], bool], vectorized: bool = False) -> None:  # type ignore
         """
         :param condition: if condition is not true - remove record
+        :param vectorized: condition is NumPy-aware: it gives boolean mask when columns of row are arrays,
+            which lets columnar mode filter a whole batch at once
         """
         self.condition = condition
+        self.vectorized = vectorized
 
     def __call__(self, row: TRow) -> TRowsGenerator:  # type ignore
         if self.condition(row):
             yield row
 
+    def ordered_by(self, keys: tp.Sequence[str]) -> tp.Tuple[str, ...]:
+        return tuple(keys)
+
 
 class Project(Mapper):  # type ignore
     """Leave only mentioned columns"""
@@ -215,3 +671,6 @@ class Project(Mapper):  # type ignore
 
     def __call__(self, row: TRow) -> TRowsGenerator:  # type ignore
         yield {col: row[col] for col in self.columns if col in row}
+
+    def ordered_by(self, keys: tp.Sequence[str]) -> tp.Tuple[str, ...]:
+        return unchanged_prefix(keys, set(keys) - set(self.columns))
@@ -1,16 +1,25 @@
 from abc import abstractmethod, ABC
 from math import log, radians, asin, sin, pow, sqrt, cos  # noqa: F401
+import itertools
 import typing as tp  # noqa: F401
 from .mappers import (Mapper, Project, Filter, Product, Split, LowerCase,  # noqa: F401
-                      FilterPunctuation, DummyMapper, Map, Calculate, ReverseFreq)  # noqa: F401
-from .reducers import Average, Sum, Count, TermFrequency, TopN, FirstReducer, Reduce, Reducer  # noqa: F401
-from .joiners import RightJoiner, LeftJoiner, OuterJoiner, InnerJoiner, Join, Joiner  # noqa: F401
-from .mappers import haversine_distance, road_time, hour, weekday, speed  # noqa: F401
+                      FilterPunctuation, DummyMapper, Map, Calculate, ReverseFreq,  # noqa: F401
+                      RowUpdater, FusedMap, ParseTimestamp, NormalizeText, AsyncMapper, AsyncCalculate,  # noqa: F401
+                      ValueDictionary, EncodeColumn, DecodeColumn)  # noqa: F401
+from .reducers import (Average, Sum, Count, TermFrequency, TopN, FirstReducer, Reduce, Reducer,  # noqa: F401
+                       HashReduce, CombinableReducer, Combine, MergePartials, PARTIAL_STATE_COLUMN)  # noqa: F401
+from .joiners import (RightJoiner, LeftJoiner, OuterJoiner, InnerJoiner, Join, Joiner,  # noqa: F401
+                      HashJoin, BroadcastJoin)  # noqa: F401
+from .mappers import (haversine_distance, road_time, hour, weekday, speed,  # noqa: F401
+                      parse_timestamp, parse_timestamps, TIMESTAMP_FORMAT)  # noqa: F401
+from .rows import OverlayRow, CompactRow, Schema, as_dict, compact, key_function  # noqa: F401
 
 TRow = dict[str, tp.Any]
 TRowsIterable = tp.Iterable[TRow]
 TRowsGenerator = tp.Generator[TRow, None, None]
 
+READ_BULK_LINES = 4096
+
 
 class Operation(ABC):
     @abstractmethod
@@ -19,20 +28,39 @@ class Operation(ABC):
 
 
 class Read(Operation):
-    def __init__(self, filename: str, parser: tp.Callable[[str], TRow]) -> None:
+    def __init__(self, filename: str, parser: tp.Callable[[tp.Any], tp.Any], schema: Schema | None = None,
+                 bulk: bool = False) -> None:
+        """
+        :param filename: file to read rows from, one row per line
+        :param parser: parser from line to row
+        :param schema: declared columns of rows, rows are stored as CompactRow if given
+        :param bulk: parser takes a list of up to READ_BULK_LINES lines and returns iterable of their rows
+        """
         self.filename = filename
         self.parser = parser
+        self.schema = schema
+        self.bulk = bulk
 
     def __call__(self, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
         with open(self.filename) as f:
-            for line in f:
-                yield self.parser(line)
+            rows: tp.Iterable[TRow]
+            if self.bulk:
+                rows = itertools.chain.from_iterable(
+                    map(self.parser, iter(lambda: list(itertools.islice(f, READ_BULK_LINES)), [])))
+            else:
+                rows = map(self.parser, f)
+            yield from rows if self.schema is None else compact(rows, self.schema)
 
 
 class ReadIterFactory(Operation):
-    def __init__(self, name: str) -> None:
+    def __init__(self, name: str, schema: Schema | None = None) -> None:
+        """
+        :param name: name of kwarg with factory of row iterators
+        :param schema: declared columns of rows, rows are stored as CompactRow if given
+        """
         self.name = name
+        self.schema = schema
 
     def __call__(self, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
-        for row in kwargs[self.name]():
-            yield row
+        rows = kwargs[self.name]()
+        yield from rows if self.schema is None else compact(rows, self.schema)
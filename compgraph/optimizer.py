@@ -0,0 +1,187 @@
+import copy
+import typing as tp
+
+from . import columnar
+from . import operations as ops
+from .aio import AsyncMap
+from .external_sort import ExternalSort, GroupSort
+from .parallel import ParallelMap, ParallelReduce, ParallelJoin
+
+
+class SortRewrite:
+    """Record about a sort changed by optimizer"""
+
+    REMOVED = 'removed'
+    WEAKENED = 'weakened'
+
+    def __init__(self, action: str, keys: tp.Sequence[str], ordering: tp.Sequence[str]) -> None:
+        """
+        :param action: REMOVED or WEAKENED
+        :param keys: keys of the sort
+        :param ordering: keys the stream was known to be sorted by before the sort
+        """
+        self.action = action
+        self.keys = tuple(keys)
+        self.ordering = tuple(ordering)
+
+    def __eq__(self, other: tp.Any) -> bool:
+        return isinstance(other, SortRewrite) and \
+            (self.action, self.keys, self.ordering) == (other.action, other.keys, other.ordering)
+
+    def __repr__(self) -> str:
+        return f'SortRewrite({self.action!r}, keys={list(self.keys)}, ordering={list(self.ordering)})'
+
+
+def fuse_maps(operations: tp.Sequence[ops.Operation]) -> tp.List[ops.Operation]:
+    """Replace every chain of consecutive Map operations with one FusedMap
+    :param operations: graph operations
+    :return: new list of operations, operations outside of chains are kept as is
+    """
+    result: tp.List[ops.Operation] = []
+    chain: tp.List[ops.Operation] = []
+
+    def flush() -> None:
+        if len(chain) == 1:
+            result.append(chain[0])
+        elif chain:
+            mappers: tp.List[ops.Mapper] = []
+            for operation in chain:
+                mappers.extend(operation.mappers if isinstance(operation, ops.FusedMap) else [operation.mapper])
+            result.append(ops.FusedMap(mappers))
+        chain.clear()
+
+    for operation in operations:
+        if isinstance(operation, (ops.Map, ops.FusedMap)):
+            chain.append(operation)
+        else:
+            flush()
+            result.append(operation)
+    flush()
+    return result
+
+
+def output_ordering(operation: ops.Operation, ordering: tp.Tuple[str, ...]) -> tp.Tuple[str, ...]:
+    """Keys the output of operation is sorted by
+    :param operation: graph operation
+    :param ordering: keys the input of operation is sorted by
+    """
+    if isinstance(operation, (ExternalSort, GroupSort)):
+        keys = tuple(operation.keys)
+        return ordering if ordering[:len(keys)] == keys else keys
+    if isinstance(operation, ops.Map):
+        return operation.mapper.ordered_by(ordering)
+    if isinstance(operation, (ops.FusedMap, ParallelMap, AsyncMap)):
+        return operation.ordered_by(ordering)
+    if isinstance(operation, ops.Reduce) or isinstance(operation, ParallelReduce) and not operation.hash_grouping:
+        # groups follow each other in input order and reducers keep group keys in output rows
+        prefix = []
+        for key in ordering:
+            if key not in operation.keys:
+                break
+            prefix.append(key)
+        return tuple(prefix)
+    if isinstance(operation, columnar.ColumnarStage):
+        return stream_ordering(operation.operations, ordering)
+    if isinstance(operation, ops.Join) or isinstance(operation, ParallelJoin) and not operation.hash_join:
+        # sort-merge join yields groups in ascending order of join keys
+        return tuple(operation.keys)
+    return ()
+
+
+def stream_ordering(operations: tp.Sequence[ops.Operation], ordering: tp.Tuple[str, ...] = ()) -> tp.Tuple[str, ...]:
+    """Keys the output of operations chain is sorted by
+    :param operations: graph operations
+    :param ordering: keys the input of the chain is sorted by
+    """
+    for operation in operations:
+        ordering = output_ordering(operation, ordering)
+    return ordering
+
+
+def drop_redundant_sorts(operations: tp.Sequence[ops.Operation], report: tp.List[SortRewrite] | None = None,
+                         ordering: tp.Tuple[str, ...] = ()) -> tp.List[ops.Operation]:
+    """Remove sorts by keys the stream is already sorted by; if the stream is sorted by
+    a prefix of keys, replace sort with GroupSort which sorts only inside groups of equal prefix
+    :param operations: graph operations
+    :param report: list to append records about changed sorts to
+    :param ordering: keys the input stream is sorted by
+    """
+    result: tp.List[ops.Operation] = []
+    for operation in operations:
+        if isinstance(operation, ExternalSort):
+            keys = tuple(operation.keys)
+            prefix_length = 0
+            while prefix_length < min(len(keys), len(ordering)) and keys[prefix_length] == ordering[prefix_length]:
+                prefix_length += 1
+            if prefix_length == len(keys):
+                if report is not None:
+                    report.append(SortRewrite(SortRewrite.REMOVED, keys, ordering))
+                continue
+            if prefix_length > 0:
+                if report is not None:
+                    report.append(SortRewrite(SortRewrite.WEAKENED, keys, ordering))
+                operation = GroupSort(keys, prefix_length, operation.memory_limit, operation.tmp_dir)
+        ordering = output_ordering(operation, ordering)
+        result.append(operation)
+    return result
+
+
+def insert_combiners(operations: tp.Sequence[ops.Operation]) -> tp.List[ops.Operation]:
+    """Pre-aggregate rows before a sort which feeds reduce with combinable reducer:
+    sort + reduce become Combine + sort of partial rows + reduce merging partial states.
+    Reduce keys must be a prefix of sort keys, partial rows are sorted by reduce keys only.
+    Only reducers with exact_merge are combined: merging partial sums of floats in another order
+    may change the last digits of the result.
+    :param operations: graph operations
+    """
+    result: tp.List[ops.Operation] = []
+    index = 0
+    while index < len(operations):
+        operation = operations[index]
+        following = operations[index + 1] if index + 1 < len(operations) else None
+        if isinstance(operation, ExternalSort) and isinstance(following, ops.Reduce) \
+                and isinstance(following.reducer, ops.CombinableReducer) and following.reducer.exact_merge \
+                and following.keys \
+                and tuple(operation.keys[:len(following.keys)]) == tuple(following.keys):
+            if tuple(operation.keys) != tuple(following.keys):
+                operation = copy.copy(operation)
+                operation.keys = following.keys
+            result.extend([
+                ops.Combine(following.reducer, following.keys),
+                operation,
+                ops.Reduce(ops.MergePartials(following.reducer), following.keys),
+            ])
+            index += 2
+        else:
+            result.append(operation)
+            index += 1
+    return result
+
+
+def broadcast_keyless_joins(operations: tp.Sequence[ops.Operation]) -> tp.List[ops.Operation]:
+    """Replace merge joins with empty keys by BroadcastJoin, which does not group the whole left side.
+    Right joiner is left as is, since broadcasting changes its output order.
+    :param operations: graph operations
+    """
+    return [
+        ops.BroadcastJoin(operation.joiner)
+        if isinstance(operation, ops.Join) and not operation.keys and not isinstance(operation.joiner, ops.RightJoiner)
+        else operation
+        for operation in operations
+    ]
+
+
+def optimize(operations: tp.Sequence[ops.Operation], report: tp.List[SortRewrite] | None = None,
+             ordering: tp.Tuple[str, ...] = (), vectorize: bool = False) -> tp.List[ops.Operation]:
+    """Plan-time rewriting of graph operations, result of graph run stays the same: combiners are inserted
+    only for reducers with exact merge of partial states (e.g. Count), not for float sums
+    :param operations: graph operations
+    :param report: list to append records about changed sorts to
+    :param ordering: keys the input stream is sorted by, for operations which continue a shared stream
+    :param vectorize: build columnar stages; sorts and reduces taken into stages get no combiners,
+        since batch reduce is cheap
+    """
+    operations = drop_redundant_sorts(fuse_maps(operations), report, ordering)
+    if vectorize:
+        operations = columnar.vectorize(operations)
+    return broadcast_keyless_joins(insert_combiners(operations))
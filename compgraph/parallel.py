@@ -0,0 +1,294 @@
+from __future__ import annotations
+
+import collections
+import contextlib
+import heapq
+import io
+import itertools
+import mmap
+import os
+import tempfile
+import typing as tp
+from concurrent import futures
+
+from . import operations as ops
+from .joiners import DEFAULT_HASH_JOIN_MEMORY_LIMIT
+from .reducers import DEFAULT_HASH_MEMORY_LIMIT
+from .rows import key_function
+from .spill import partition_rows, read_spilled, write_spilled
+
+if tp.TYPE_CHECKING:
+    from .distributed import Cluster
+
+DEFAULT_MAP_BATCH_SIZE = 1024
+DEFAULT_READ_CHUNK_SIZE = 8 * 1024 * 1024
+# differs from seeds used by HashReduce and HashJoin, so their spilling inside a partition splits it further
+SHUFFLE_SEED = -1
+
+_worker_mapper: ops.Mapper | None = None
+
+
+def _init_map_worker(mapper: ops.Mapper) -> None:
+    global _worker_mapper
+    _worker_mapper = mapper
+
+
+def _map_batch(rows: tp.List[ops.TRow]) -> tp.List[ops.TRow]:
+    assert _worker_mapper is not None
+    return [mapped_row for row in rows for mapped_row in _worker_mapper(row)]
+
+
+class ParallelMap(ops.Operation):
+    """
+    Map whose mapper runs in a pool of worker processes: input rows are cut into batches of batch_size rows
+    and at most max_in_flight batches are sent but not yet yielded, so memory stays bounded when
+    the consumer is slow. With ordered output rows follow in the same order as of Map, otherwise batches
+    are yielded as soon as they are done.
+    The mapper is passed to every worker once when the pool starts, so it must be picklable
+    (any mapper works with the default fork start method on Linux).
+    """
+
+    def __init__(self, mapper: ops.Mapper, workers: int | None = None, batch_size: int = DEFAULT_MAP_BATCH_SIZE,
+                 ordered: bool = True, max_in_flight: int | None = None) -> None:
+        """
+        :param mapper: mapper to use
+        :param workers: number of processes, number of CPUs if None
+        :param batch_size: number of input rows in one task, larger batches pay less for transport
+            but need more memory
+        :param ordered: whether output keeps the order of input rows
+        :param max_in_flight: number of batches being mapped at the same time, twice the workers if None
+        """
+        self.mapper = mapper
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.batch_size = batch_size
+        self.ordered = ordered
+        self.max_in_flight = max_in_flight if max_in_flight is not None else 2 * self.workers
+        assert self.workers >= 1 and self.batch_size >= 1 and self.max_in_flight >= 1
+
+    def ordered_by(self, keys: tp.Sequence[str]) -> tp.Tuple[str, ...]:
+        """Sortedness of output rows, see Mapper.ordered_by"""
+        return self.mapper.ordered_by(keys) if self.ordered else ()
+
+    def __call__(self, rows: ops.TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> ops.TRowsGenerator:
+        rows = iter(rows)
+        batches = iter(lambda: list(itertools.islice(rows, self.batch_size)), [])
+        with futures.ProcessPoolExecutor(self.workers, initializer=_init_map_worker, initargs=(self.mapper,)) as pool:
+            yield from _bounded_results(pool, _map_batch, batches, self.max_in_flight, self.ordered)
+
+
+def _bounded_results(pool: futures.Executor, function: tp.Callable[..., tp.List[ops.TRow]],
+                     tasks: tp.Iterable[tp.Any], max_in_flight: int, ordered: bool) -> ops.TRowsGenerator:
+    """Rows of function applied to tasks in pool: at most max_in_flight tasks are submitted
+    but not yet yielded; with ordered results follow in order of tasks, otherwise as they are done.
+    Tasks not yielded are cancelled when the generator is closed."""
+    in_flight: tp.Deque[futures.Future[tp.List[ops.TRow]]] = collections.deque()
+    try:
+        for task in itertools.chain(tasks, [None]):
+            if task is not None:
+                in_flight.append(pool.submit(function, task))
+                if len(in_flight) < max_in_flight:
+                    continue
+            while in_flight and (task is None or len(in_flight) >= max_in_flight):
+                if ordered:
+                    done = in_flight.popleft()
+                else:
+                    done = next(iter(futures.wait(in_flight, return_when=futures.FIRST_COMPLETED).done))
+                    in_flight.remove(done)
+                yield from done.result()
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+
+_worker_file: mmap.mmap | None = None
+_worker_parser: tp.Callable[[tp.Any], tp.Any] | None = None
+_worker_bulk = False
+
+
+def _init_read_worker(filename: str, parser: tp.Callable[[tp.Any], tp.Any], bulk: bool) -> None:
+    global _worker_file, _worker_parser, _worker_bulk
+    with open(filename, 'rb') as f:
+        _worker_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _worker_parser = parser
+    _worker_bulk = bulk
+
+
+def _parse_chunk(chunk: tp.Tuple[int, int]) -> tp.List[ops.TRow]:
+    assert _worker_file is not None and _worker_parser is not None
+    start, end = chunk
+    # lines are decoded as by open() in text mode, so parser gets the same lines as of ops.Read
+    lines = io.TextIOWrapper(io.BytesIO(_worker_file[start:end]))
+    return list(_worker_parser(list(lines))) if _worker_bulk else list(map(_worker_parser, lines))
+
+
+def line_chunks(data: mmap.mmap, chunk_size: int) -> tp.Generator[tp.Tuple[int, int], None, None]:
+    """Bounds of consecutive chunks of data of about chunk_size bytes, every chunk ends after a newline
+    (except the last one) so no line is cut; only pages around the bounds are touched"""
+    start, size = 0, len(data)
+    while start < size:
+        end = start + chunk_size
+        if end < size:
+            newline = data.find(b'\n', end - 1)
+            end = size if newline == -1 else newline + 1
+        else:
+            end = size
+        yield start, end
+        start = end
+
+
+class ParallelRead(ops.Operation):
+    """
+    Read whose parsing is done in a pool of worker processes: the file is memory-mapped and cut into chunks
+    of about chunk_size bytes at line ends, every worker parses whole chunks, so lines are not sent to workers.
+    At most max_in_flight chunks are parsed but not yet yielded. With ordered output rows follow in the same
+    order as of Read, otherwise chunks are yielded as soon as they are parsed.
+    """
+
+    def __init__(self, filename: str, parser: tp.Callable[[tp.Any], tp.Any], workers: int | None = None,
+                 chunk_size: int = DEFAULT_READ_CHUNK_SIZE, ordered: bool = True, bulk: bool = False,
+                 max_in_flight: int | None = None, schema: ops.Schema | None = None) -> None:
+        """
+        :param filename: file to read rows from, one row per line
+        :param parser: parser from line to row, must be picklable with spawn start method
+        :param workers: number of processes, number of CPUs if None
+        :param chunk_size: number of bytes parsed in one task
+        :param ordered: whether output keeps the order of lines
+        :param bulk: parser takes a list of lines of a chunk and returns iterable of their rows,
+            e.g. to parse them all with one call of a vectorized parser
+        :param max_in_flight: number of chunks being parsed at the same time, twice the workers if None
+        :param schema: declared columns of rows, rows are stored as CompactRow if given
+        """
+        self.filename = filename
+        self.parser = parser
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.chunk_size = chunk_size
+        self.ordered = ordered
+        self.bulk = bulk
+        self.max_in_flight = max_in_flight if max_in_flight is not None else 2 * self.workers
+        self.schema = schema
+        assert self.workers >= 1 and self.chunk_size >= 1 and self.max_in_flight >= 1
+
+    def _rows(self) -> ops.TRowsGenerator:
+        with open(self.filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return  # empty file can not be mapped
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+                    futures.ProcessPoolExecutor(self.workers, initializer=_init_read_worker,
+                                                initargs=(self.filename, self.parser, self.bulk)) as pool:
+                yield from _bounded_results(pool, _parse_chunk, line_chunks(data, self.chunk_size),
+                                            self.max_in_flight, self.ordered)
+
+    def __call__(self, *args: tp.Any, **kwargs: tp.Any) -> ops.TRowsGenerator:
+        yield from self._rows() if self.schema is None else ops.compact(self._rows(), self.schema)
+
+
+def _run_partition(operation: ops.Operation, paths: tp.List[str], output_path: str) -> str:
+    """Task of shuffle worker: run operation on spilled inputs of one partition and spill its output"""
+    write_spilled(operation(*map(read_spilled, paths)), output_path)
+    return output_path
+
+
+def shuffle(operation: ops.Operation, inputs: tp.Sequence[ops.TRowsIterable], keys: tp.Sequence[str],
+            workers: int, ordered: bool, tmp_dir: str | None = None,
+            cluster: Cluster | None = None) -> ops.TRowsGenerator:
+    """
+    Hash-partitioned run of operation: every input is spilled to workers partition files by hash of keys,
+    so rows with equal keys of all inputs get into one partition and keep their order; then operation
+    is run on every partition in a pool of processes or on cluster nodes.
+    :param operation: picklable operation taking inputs as positional arguments, e.g. Reduce or Join
+    :param inputs: streams to partition
+    :param keys: keys to partition by, output rows of operation must have them if ordered
+    :param workers: number of partitions and processes
+    :param ordered: merge outputs of partitions by keys, this keeps the output order of Reduce or Join
+        of inputs sorted by keys; otherwise partitions are yielded as they are done
+    :param tmp_dir: directory for partition files, system default if None
+    :param cluster: nodes to run partitions on instead of local processes
+    """
+    with tempfile.TemporaryDirectory(prefix='compgraph_shuffle_', dir=tmp_dir) as run_dir:
+        input_paths = [partition_rows(rows, keys, workers, SHUFFLE_SEED, run_dir, f'input_{index}')
+                       for index, rows in enumerate(inputs)]
+        with contextlib.ExitStack() as stack:
+            if cluster is None:
+                pool = stack.enter_context(futures.ProcessPoolExecutor(workers))
+                submit = lambda *task: pool.submit(_run_partition, *task)  # noqa: E731
+            else:
+                submit = cluster.submit
+            tasks = [submit(operation, list(paths), os.path.join(run_dir, f'output_{index}'))
+                     for index, paths in enumerate(zip(*input_paths))]
+            if not ordered:
+                for task in futures.as_completed(tasks):
+                    yield from read_spilled(task.result())
+                return
+            output_paths = [task.result() for task in tasks]
+        yield from heapq.merge(*map(read_spilled, output_paths), key=key_function(keys))
+
+
+class ParallelReduce(ops.Operation):
+    """
+    Reduce done by several processes on hash partitions of rows, see shuffle.
+    With sorted grouping rows must be sorted by keys, as for Reduce, and the output is the same as of Reduce.
+    With hash grouping every partition is grouped by HashReduce, groups follow in no particular order.
+    Rows are spilled to disk before reducing starts.
+    """
+
+    def __init__(self, reducer: ops.Reducer, keys: tp.Sequence[str], workers: int | None = None,
+                 hash_grouping: bool = False, memory_limit: int = DEFAULT_HASH_MEMORY_LIMIT,
+                 tmp_dir: str | None = None) -> None:
+        """
+        :param reducer: picklable reducer to use
+        :param keys: keys for grouping
+        :param workers: number of partitions and processes, number of CPUs if None
+        :param hash_grouping: group rows of every partition in hash table, so rows need not be sorted
+        :param memory_limit: hash grouping of one partition spills rows to disk above this budget (in bytes)
+        :param tmp_dir: directory for partition files, system default if None
+        """
+        self.reducer = reducer
+        self.keys = keys
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.hash_grouping = hash_grouping
+        self.memory_limit = memory_limit
+        self.tmp_dir = tmp_dir
+
+    def __call__(self, rows: ops.TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> ops.TRowsGenerator:
+        operation: ops.Operation
+        if self.hash_grouping:
+            operation = ops.HashReduce(self.reducer, self.keys, self.memory_limit, tmp_dir=self.tmp_dir)
+        else:
+            operation = ops.Reduce(self.reducer, self.keys)
+        yield from shuffle(operation, [rows], self.keys, self.workers, not self.hash_grouping, self.tmp_dir)
+
+
+class ParallelJoin(ops.Operation):
+    """
+    Join done by several processes on hash partitions of both inputs, see shuffle.
+    With merge join inputs must be sorted by keys, as for Join, and the output is the same as of Join.
+    With hash join every partition is joined by HashJoin, keys follow in no particular order.
+    Both inputs are spilled to disk before joining starts.
+    """
+
+    def __init__(self, joiner: ops.Joiner, keys: tp.Sequence[str], workers: int | None = None,
+                 hash_join: bool = False, memory_limit: int = DEFAULT_HASH_JOIN_MEMORY_LIMIT,
+                 tmp_dir: str | None = None) -> None:
+        """
+        :param joiner: join strategy to use
+        :param keys: join keys
+        :param workers: number of partitions and processes, number of CPUs if None
+        :param hash_join: join every partition with HashJoin, so inputs need not be sorted
+        :param memory_limit: hash join of one partition spills rows to disk above this budget (in bytes)
+        :param tmp_dir: directory for partition files, system default if None
+        """
+        self.joiner = joiner
+        self.keys = keys
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.hash_join = hash_join
+        self.memory_limit = memory_limit
+        self.tmp_dir = tmp_dir
+
+    def __call__(self, rows: ops.TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> ops.TRowsGenerator:
+        rows_b = args[0] if args else []
+        operation: ops.Operation
+        if self.hash_join:
+            operation = ops.HashJoin(self.joiner, self.keys, self.memory_limit, tmp_dir=self.tmp_dir)
+        else:
+            operation = ops.Join(self.joiner, self.keys)
+        yield from shuffle(operation, [rows, rows_b], self.keys, self.workers, not self.hash_join, self.tmp_dir)
@@ -1,13 +1,25 @@
+import contextlib
 import heapq
 import itertools
+import sys
+import tempfile
 import typing as tp
 from abc import abstractmethod, ABC
 from collections import defaultdict
 
+from .rows import key_function
+from .spill import partition_rows, read_spilled
+
 TRow = dict[str, tp.Any]
 TRowsIterable = tp.Iterable[TRow]
 TRowsGenerator = tp.Generator[TRow, None, None]
 
+DEFAULT_HASH_MEMORY_LIMIT = 64 * 1024 * 1024
+DEFAULT_HASH_PARTITIONS = 16
+MAX_SPILL_DEPTH = 4
+DEFAULT_COMBINE_GROUPS = 10000
+PARTIAL_STATE_COLUMN = '__partial_state__'
+
 
 class Operation(ABC):
     @abstractmethod
@@ -26,16 +38,161 @@ class Reducer(ABC):
         pass
 
 
+class CombinableReducer(Reducer):
+    """
+    Base class for reducers whose result may be computed from partial states of parts of a group,
+    which lets optimizer pre-aggregate rows before the sort (see Combine and MergePartials).
+    Partial states are merged in arbitrary order, so float results may differ in last digits;
+    optimizer inserts combiners only for reducers with exact_merge, whose results do not depend on the order.
+    """
+    exact_merge = False
+
+    @abstractmethod
+    def add(self, state: tp.Any, row: TRow) -> tp.Any:
+        """Account one row in partial state
+        :param state: current state, None for the first row of the group
+        :param row: row of the group
+        :return: new state
+        """
+        pass
+
+    @abstractmethod
+    def merge(self, state: tp.Any, other: tp.Any) -> tp.Any:
+        """Combine partial states of two parts of a group"""
+        pass
+
+    @abstractmethod
+    def result(self, group_key: tp.Tuple[str, ...], key_values: tp.Tuple[tp.Any, ...], state: tp.Any) -> TRow:
+        """Build output row of the group from its full state"""
+        pass
+
+
+class Combine(Operation):
+    """
+    Local pre-aggregation: rows with equal keys are folded into partial state rows
+    {key columns..., PARTIAL_STATE_COLUMN: state}. At most max_groups states are kept in memory,
+    when there are more, all of them are yielded and folding starts over,
+    so one group may produce several partial rows.
+    """
+
+    def __init__(self, reducer: CombinableReducer, keys: tp.Sequence[str],
+                 max_groups: int = DEFAULT_COMBINE_GROUPS) -> None:
+        """
+        :param reducer: reducer to build partial states with
+        :param keys: keys for grouping
+        :param max_groups: number of groups kept in memory
+        """
+        self.reducer = reducer
+        self.keys = keys
+        self.max_groups = max_groups
+
+    def _flush(self, states: tp.Dict[tp.Tuple[tp.Any, ...], tp.Any]) -> TRowsGenerator:
+        for key_values, state in states.items():
+            partial_row = dict(zip(self.keys, key_values))
+            partial_row[PARTIAL_STATE_COLUMN] = state
+            yield partial_row
+        states.clear()
+
+    def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
+        states: tp.Dict[tp.Tuple[tp.Any, ...], tp.Any] = {}
+        row_key = key_function(self.keys)
+        for row in rows:
+            key_values = row_key(row)
+            states[key_values] = self.reducer.add(states.get(key_values), row)
+            if len(states) >= self.max_groups:
+                yield from self._flush(states)
+        yield from self._flush(states)
+
+
+class MergePartials(Reducer):
+    """Reducer merging partial state rows made by Combine into final result of combinable reducer"""
+
+    def __init__(self, reducer: CombinableReducer) -> None:
+        """
+        :param reducer: reducer which built partial states
+        """
+        self.reducer = reducer
+
+    def __call__(self, group_key: tp.Tuple[str, ...], rows: TRowsIterable) -> TRowsGenerator:
+        state = None
+        key_values = None
+        for row in rows:
+            if key_values is None:
+                key_values = tuple(row[key] for key in group_key)
+                state = row[PARTIAL_STATE_COLUMN]
+            else:
+                state = self.reducer.merge(state, row[PARTIAL_STATE_COLUMN])
+        if key_values is not None:
+            yield self.reducer.result(group_key, key_values, state)
+
+
 class Reduce(Operation):  # type ignore
     def __init__(self, reducer: Reducer, keys: tp.Sequence[str]) -> None:  # type ignore
         self.reducer = reducer
         self.keys = keys
 
     def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:  # type ignore
-        for key_values, group_rows in itertools.groupby(rows, key=lambda row: tuple(row[key] for key in self.keys)):
+        for key_values, group_rows in itertools.groupby(rows, key=key_function(self.keys)):
             yield from self.reducer(tuple(self.keys), group_rows)
 
 
+class HashReduce(Operation):
+    """
+    Reduce which does not need rows sorted by keys: rows are grouped in a hash table.
+    When estimated size of grouped rows exceeds memory_limit, they are spilled to partition files
+    by hash of their keys, then every partition is grouped separately.
+    Output order: if nothing is spilled, groups follow in order of first appearance of their keys.
+    Otherwise groups of one partition follow in that order and partitions follow each other,
+    so the order is not stable between runs; sort the result if order matters.
+    Rows of every group are passed to reducer in input order, as in Reduce.
+    """
+
+    def __init__(self, reducer: Reducer, keys: tp.Sequence[str], memory_limit: int = DEFAULT_HASH_MEMORY_LIMIT,
+                 partitions: int = DEFAULT_HASH_PARTITIONS, tmp_dir: str | None = None) -> None:
+        """
+        :param reducer: reducer to use
+        :param keys: keys for grouping
+        :param memory_limit: budget for grouped rows (in bytes, estimated by sys.getsizeof)
+        :param partitions: number of partition files rows are spilled to
+        :param tmp_dir: directory for partition files, system default if None
+        """
+        assert partitions >= 2
+        self.reducer = reducer
+        self.keys = keys
+        self.memory_limit = memory_limit
+        self.partitions = partitions
+        self.tmp_dir = tmp_dir
+
+    def _group(self, rows: TRowsIterable, depth: int, stack: contextlib.ExitStack) -> TRowsGenerator:
+        rows = iter(rows)
+        groups: tp.Dict[tp.Tuple[tp.Any, ...], tp.List[TRow]] = {}
+        size = 0
+        row_key = key_function(self.keys)
+        for row in rows:
+            key = row_key(row)
+            group = groups.get(key)
+            if group is None:
+                groups[key] = group = []
+            group.append(row)
+            size += sys.getsizeof(row)
+            if size > self.memory_limit and depth < MAX_SPILL_DEPTH:
+                run_dir = stack.enter_context(tempfile.TemporaryDirectory(prefix='compgraph_hash_',
+                                                                          dir=self.tmp_dir))
+                grouped_rows = itertools.chain.from_iterable(groups.values())
+                paths = partition_rows(itertools.chain(grouped_rows, rows), self.keys, self.partitions, depth,
+                                       run_dir, 'partition')
+                groups.clear()
+                for path in paths:
+                    yield from self._group(read_spilled(path), depth + 1, stack)
+                return
+        for group in groups.values():
+            yield from self.reducer(tuple(self.keys), group)
+
+    def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
+        with contextlib.ExitStack() as stack:
+            yield from self._group(rows, 0, stack)
+
+
 class FirstReducer(Reducer):  # type ignore
     def __call__(self, group_key: tuple[str, ...], rows: TRowsIterable) -> TRowsGenerator:  # type ignore
         for row in rows:
@@ -90,10 +247,23 @@ class TermFrequency(Reducer):
                 yield new_row
 
 
-class Count(Reducer):
+class Count(CombinableReducer):
+    exact_merge = True
+
     def __init__(self, column: str) -> None:
         self.column = column
 
+    def add(self, state: int | None, row: TRow) -> int:
+        return 1 if state is None else state + 1
+
+    def merge(self, state: int, other: int) -> int:
+        return state + other
+
+    def result(self, group_key: tp.Tuple[str, ...], key_values: tp.Tuple[tp.Any, ...], state: int) -> TRow:
+        new_row = dict(zip(group_key, key_values))
+        new_row[self.column] = state
+        return new_row
+
     def __call__(self, group_key: tp.Tuple[str, ...], rows: TRowsIterable) -> TRowsGenerator:
         count = 0
         key_values = None
@@ -107,10 +277,21 @@ class Count(Reducer):
             yield new_row
 
 
-class Sum(Reducer):
+class Sum(CombinableReducer):
     def __init__(self, column: str) -> None:
         self.column = column
 
+    def add(self, state: tp.Any, row: TRow) -> tp.Any:
+        return row.get(self.column, 0) if state is None else state + row.get(self.column, 0)
+
+    def merge(self, state: tp.Any, other: tp.Any) -> tp.Any:
+        return state + other
+
+    def result(self, group_key: tp.Tuple[str, ...], key_values: tp.Tuple[tp.Any, ...], state: tp.Any) -> TRow:
+        new_row = dict(zip(group_key, key_values))
+        new_row[self.column] = state
+        return new_row
+
     def __call__(self, group_key: tp.Tuple[str, ...], rows: TRowsIterable) -> TRowsGenerator:
         total = 0
         key_values = None
@@ -124,7 +305,7 @@ class Sum(Reducer):
             yield new_row
 
 
-class Average(Reducer):
+class Average(CombinableReducer):
     """
         Average values aggregated by key
         Example for key=('a',) and column='b'
@@ -140,6 +321,20 @@ class Average(Reducer):
         """
         self.column = column
 
+    def add(self, state: tp.Tuple[tp.Any, int] | None, row: TRow) -> tp.Tuple[tp.Any, int]:
+        if state is None:
+            return row[self.column], 1
+        return state[0] + row[self.column], state[1] + 1
+
+    def merge(self, state: tp.Tuple[tp.Any, int], other: tp.Tuple[tp.Any, int]) -> tp.Tuple[tp.Any, int]:
+        return state[0] + other[0], state[1] + other[1]
+
+    def result(self, group_key: tp.Tuple[str, ...], key_values: tp.Tuple[tp.Any, ...],
+               state: tp.Tuple[tp.Any, int]) -> TRow:
+        new_row = dict(zip(group_key, key_values))
+        new_row[self.column] = state[0] / state[1]
+        return new_row
+
     def __call__(self, group_key: tuple[str, ...], rows: TRowsIterable) -> TRowsGenerator:
         grouped_data: tp.DefaultDict[tp.Tuple[tp.Any, ...], int] = defaultdict(int)
         group_count: tp.DefaultDict[tp.Tuple[tp.Any, ...], int] = defaultdict(int)
@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+import sys
+import typing as tp
+from operator import itemgetter
+
+TRow = dict[str, tp.Any]
+
+
+class _Deleted:
+    """Marker of a column deleted in overlay, pickled by reference so it stays the same object"""
+
+    def __reduce__(self) -> str:
+        return '_DELETED'
+
+
+_DELETED = _Deleted()
+
+
+class OverlayRow(tp.MutableMapping[str, tp.Any]):
+    """
+    Copy-on-write row: changed columns are kept in a small dict over a shared parent row,
+    which is never changed. Behaves as a dict of all columns (same column order, equality to dicts).
+    Overlay of an overlay shares the same parent, so lookups never go deeper than one level.
+    Pickling keeps the parent shared: overlays of one row pickled together (e.g. in one batch sent
+    to sorting process) carry the parent once.
+    """
+
+    __slots__ = ('_parent', '_changes')
+
+    def __init__(self, parent: tp.Mapping[str, tp.Any], changes: TRow | None = None) -> None:
+        """
+        :param parent: row to overlay, it must not be changed while overlay is alive
+        :param changes: initial changed columns, the dict is owned by overlay
+        """
+        if isinstance(parent, OverlayRow):
+            changes = {**parent._changes, **changes} if changes else dict(parent._changes)
+            parent = parent._parent
+        self._parent = parent
+        self._changes = {} if changes is None else changes
+
+    def __getitem__(self, key: str) -> tp.Any:
+        changes = self._changes
+        if key in changes:
+            value = changes[key]
+            if value is _DELETED:
+                raise KeyError(key)
+            return value
+        return self._parent[key]
+
+    def get(self, key: str, default: tp.Any = None) -> tp.Any:
+        value = self._changes.get(key, self._parent.get(key, default))
+        return default if value is _DELETED else value
+
+    def __contains__(self, key: tp.Any) -> bool:
+        changes = self._changes
+        if key in changes:
+            return changes[key] is not _DELETED
+        return key in self._parent
+
+    def __setitem__(self, key: str, value: tp.Any) -> None:
+        self._changes[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self._changes[key] = _DELETED
+
+    def to_dict(self) -> TRow:
+        """Plain dict with all columns"""
+        merged = {**as_dict(self._parent), **self._changes}
+        if any(value is _DELETED for value in self._changes.values()):
+            return {key: value for key, value in merged.items() if value is not _DELETED}
+        return merged
+
+    def copy(self) -> OverlayRow:
+        return OverlayRow(self._parent, dict(self._changes))
+
+    def __iter__(self) -> tp.Iterator[str]:
+        return iter(self.to_dict())
+
+    def __len__(self) -> int:
+        return len(self.to_dict())
+
+    def __eq__(self, other: tp.Any) -> bool:
+        if isinstance(other, OverlayRow):
+            other = other.to_dict()
+        return self.to_dict() == other if isinstance(other, tp.Mapping) else NotImplemented
+
+    def __repr__(self) -> str:
+        return repr(self.to_dict())
+
+    def __reduce__(self) -> tp.Tuple[tp.Any, ...]:
+        return OverlayRow, (self._parent, self._changes)
+
+    def __sizeof__(self) -> int:
+        # parent is counted in full: memory budgets based on sys.getsizeof stay on the safe side
+        return object.__sizeof__(self) + sys.getsizeof(self._changes) + sys.getsizeof(self._parent)
+
+
+def _tuple_getter(items: tp.Sequence[tp.Any]) -> tp.Callable[[tp.Any], tp.Tuple[tp.Any, ...]]:
+    """itemgetter which gives a tuple for any number of items"""
+    if len(items) > 1:
+        return itemgetter(*items)
+    if items:
+        item = items[0]
+        return lambda container: (container[item],)
+    return lambda container: ()
+
+
+class Schema:
+    """Column names of compact rows in their order; column lookups are compiled to tuple indices"""
+
+    __slots__ = ('columns', 'index', '_getters')
+
+    def __init__(self, columns: tp.Sequence[str]) -> None:
+        """
+        :param columns: column names, unique
+        """
+        self.columns = tuple(columns)
+        self.index = {column: position for position, column in enumerate(self.columns)}
+        assert len(self.index) == len(self.columns), 'column names must be unique'
+        self._getters: tp.Dict[tp.Tuple[str, ...], tp.Callable[[tp.Tuple[tp.Any, ...]], tp.Tuple[tp.Any, ...]]] = {}
+
+    def getter(self, keys: tp.Tuple[str, ...]) -> tp.Callable[[tp.Tuple[tp.Any, ...]], tp.Tuple[tp.Any, ...]]:
+        """Function taking tuple of values of a compact row to tuple of values of keys"""
+        getter = self._getters.get(keys)
+        if getter is None:
+            getter = self._getters[keys] = _tuple_getter([self.index[key] for key in keys])
+        return getter
+
+    def record(self, row: tp.Mapping[str, tp.Any]) -> CompactRow:
+        """Compact row with values of row, row must have exactly the columns of schema"""
+        if len(row) != len(self.columns):
+            raise ValueError(f'row columns {list(row)} do not match schema {list(self.columns)}')
+        return CompactRow(self, tuple([row[column] for column in self.columns]))
+
+    def __reduce__(self) -> tp.Tuple[tp.Any, ...]:
+        return Schema, (self.columns,)
+
+    def __repr__(self) -> str:
+        return f'Schema({list(self.columns)})'
+
+
+class CompactRow(tp.Mapping[str, tp.Any]):
+    """
+    Read-only row stored as a tuple of values over a shared Schema: no hash table and no column
+    names per row. Behaves as a dict of its columns; mappers put changes in OverlayRow over it.
+    """
+
+    __slots__ = ('_schema', '_values')
+
+    def __init__(self, schema: Schema, values: tp.Tuple[tp.Any, ...]) -> None:
+        """
+        :param schema: columns of the row
+        :param values: values in order of schema columns
+        """
+        self._schema = schema
+        self._values = values
+
+    @property
+    def schema(self) -> Schema:
+        return self._schema
+
+    def __getitem__(self, key: str) -> tp.Any:
+        return self._values[self._schema.index[key]]
+
+    def get(self, key: str, default: tp.Any = None) -> tp.Any:
+        position = self._schema.index.get(key)
+        return default if position is None else self._values[position]
+
+    def __contains__(self, key: tp.Any) -> bool:
+        return key in self._schema.index
+
+    def __iter__(self) -> tp.Iterator[str]:
+        return iter(self._schema.columns)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def to_dict(self) -> TRow:
+        """Plain dict with all columns"""
+        return dict(zip(self._schema.columns, self._values))
+
+    def copy(self) -> TRow:
+        return self.to_dict()
+
+    def __eq__(self, other: tp.Any) -> bool:
+        if isinstance(other, CompactRow):
+            other = other.to_dict()
+        return self.to_dict() == other if isinstance(other, tp.Mapping) else NotImplemented
+
+    def __repr__(self) -> str:
+        return repr(self.to_dict())
+
+    def __reduce__(self) -> tp.Tuple[tp.Any, ...]:
+        return CompactRow, (self._schema, self._values)
+
+    def __sizeof__(self) -> int:
+        # schema is shared by all rows and is not counted
+        return object.__sizeof__(self) + sys.getsizeof(self._values)
+
+
+def as_dict(row: tp.Mapping[str, tp.Any]) -> TRow:
+    """Row as plain dict: dicts are returned as they are, other rows are copied"""
+    if row.__class__ is dict:
+        return row  # type: ignore[return-value]
+    if isinstance(row, (OverlayRow, CompactRow)):
+        return row.to_dict()
+    return dict(row)
+
+
+def compact(rows: tp.Iterable[tp.Mapping[str, tp.Any]],
+            schema: Schema | None = None) -> tp.Iterator[tp.Mapping[str, tp.Any]]:
+    """Store rows as compact rows
+    :param rows: rows to store, compact rows are passed as they are
+    :param schema: declared columns of all rows; if None, schema is inferred from columns of every row
+        and reused by rows with the same columns in the same order
+    """
+    if schema is not None:
+        record = schema.record
+        for row in rows:
+            yield row if row.__class__ is CompactRow else record(row)
+        return
+    schemas: tp.Dict[tp.Tuple[str, ...], Schema] = {}
+    for row in rows:
+        if row.__class__ is CompactRow:
+            yield row
+            continue
+        columns = tuple(row)
+        row_schema = schemas.get(columns)
+        if row_schema is None:
+            row_schema = schemas[columns] = Schema(columns)
+        yield CompactRow(row_schema, tuple(row.values()))
+
+
+def key_function(keys: tp.Sequence[str]) -> tp.Callable[[tp.Mapping[str, tp.Any]], tp.Tuple[tp.Any, ...]]:
+    """Function taking row to tuple of values of keys, compact rows are read by compiled indices"""
+    keys = tuple(keys)
+    mapping_key = _tuple_getter(keys)
+
+    def row_key(row: tp.Mapping[str, tp.Any]) -> tp.Tuple[tp.Any, ...]:
+        if row.__class__ is CompactRow:
+            return row._schema.getter(keys)(row._values)  # type: ignore[attr-defined]
+        return mapping_key(row)
+
+    return row_key
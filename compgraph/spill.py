@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+import itertools
+import os
+import pickle
+import sys
+import tempfile
+import typing as tp
+
+from .rows import key_function
+
+TRow = dict[str, tp.Any]
+TRowsIterable = tp.Iterable[TRow]
+TRowsGenerator = tp.Generator[TRow, None, None]
+
+SPILL_CHUNK_SIZE = 1024
+
+
+def read_spilled(path: str, remove: bool = True) -> TRowsGenerator:
+    """Stream rows back from a file written by partition_rows
+    :param path: file to read
+    :param remove: whether to delete the file after reading
+    """
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                chunk = pickle.load(f)
+            except EOFError:
+                break
+            yield from chunk
+    if remove:
+        os.remove(path)
+
+
+def write_spilled(rows: TRowsIterable, path: str) -> int:
+    """Spill rows to a file in chunks, read them back with read_spilled
+    :param rows: rows to spill
+    :param path: file to create
+    :return: number of rows written
+    """
+    rows = iter(rows)
+    count = 0
+    with open(path, 'wb') as f:
+        for chunk in iter(lambda: list(itertools.islice(rows, SPILL_CHUNK_SIZE)), []):
+            pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+            count += len(chunk)
+    return count
+
+
+def partition_rows(rows: TRowsIterable, keys: tp.Sequence[str], partitions: int, seed: int,
+                   run_dir: str, name: str) -> tp.List[str]:
+    """Spill rows to partition files by hash of their keys, rows of every partition keep input order
+    :param rows: rows to spill
+    :param keys: keys to hash
+    :param partitions: number of partition files
+    :param seed: mixed into hash, so that repeated partitioning of one partition splits it further
+    :param run_dir: directory to create files in
+    :param name: prefix of file names, must be unique in run_dir
+    :return: paths of partition files
+    """
+    paths = [os.path.join(run_dir, f'{name}_{index}.pickle') for index in range(partitions)]
+    buffers: tp.List[tp.List[TRow]] = [[] for _ in range(partitions)]
+    files = [open(path, 'wb') for path in paths]
+    row_key = key_function(keys)
+    try:
+        for row in rows:
+            index = hash((seed, row_key(row))) % partitions
+            buffer = buffers[index]
+            buffer.append(row)
+            if len(buffer) >= SPILL_CHUNK_SIZE:
+                pickle.dump(buffer, files[index], protocol=pickle.HIGHEST_PROTOCOL)
+                buffers[index] = []
+        for buffer, f in zip(buffers, files):
+            if buffer:
+                pickle.dump(buffer, f, protocol=pickle.HIGHEST_PROTOCOL)
+    finally:
+        for f in files:
+            f.close()
+    return paths
+
+
+class SpillingTee:
+    """
+    Fan-out of one row stream to a fixed number of readers, which may read at different pace.
+    Rows are pulled in chunks and kept until every reader has passed them; when kept rows exceed
+    memory_limit, the oldest chunks are moved to a temporary file and readers load them from there.
+    """
+
+    def __init__(self, rows: TRowsIterable, readers: int, memory_limit: int, tmp_dir: str | None = None) -> None:
+        """
+        :param rows: stream to share
+        :param readers: number of readers which will be created with reader()
+        :param memory_limit: budget for rows kept in memory (in bytes, estimated by sys.getsizeof)
+        :param tmp_dir: directory for the spill file, system default if None
+        """
+        self._rows = iter(rows)
+        self._readers = readers
+        self._memory_limit = memory_limit
+        self._tmp_dir = tmp_dir
+        self._positions: tp.List[float] = []
+        self._chunks: tp.List[tp.List[TRow] | int | None] = []
+        self._sizes: tp.List[int] = []
+        self._first_kept = 0
+        self._memory_size = 0
+        self._exhausted = False
+        self._path: str | None = None
+        self._file: tp.BinaryIO | None = None
+
+    @property
+    def spilled(self) -> bool:
+        return self._path is not None
+
+    def _pull(self) -> bool:
+        if self._exhausted:
+            return False
+        chunk = list(itertools.islice(self._rows, SPILL_CHUNK_SIZE))
+        if not chunk:
+            self._exhausted = True
+            return False
+        size = sum(map(sys.getsizeof, chunk))
+        self._chunks.append(chunk)
+        self._sizes.append(size)
+        self._memory_size += size
+        self._spill()
+        return True
+
+    def _spill(self) -> None:
+        index = self._first_kept
+        while self._memory_size > self._memory_limit and index < len(self._chunks) - 1:
+            chunk = self._chunks[index]
+            if isinstance(chunk, list):
+                if self._file is None:
+                    descriptor, self._path = tempfile.mkstemp(prefix='compgraph_tee_', dir=self._tmp_dir)
+                    self._file = os.fdopen(descriptor, 'wb')
+                self._chunks[index] = self._file.tell()
+                pickle.dump(chunk, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+                self._memory_size -= self._sizes[index]
+            index += 1
+        if self._file is not None:
+            self._file.flush()
+
+    def _release(self) -> None:
+        """Forget chunks every reader has passed"""
+        if len(self._positions) < self._readers:
+            return
+        lowest = min(self._positions)
+        while self._first_kept < min(lowest, len(self._chunks)):
+            if isinstance(self._chunks[self._first_kept], list):
+                self._memory_size -= self._sizes[self._first_kept]
+            self._chunks[self._first_kept] = None
+            self._first_kept += 1
+
+    def reader(self) -> TRowsGenerator:
+        """Register new reader, it gets all rows of the stream from the beginning"""
+        assert len(self._positions) < self._readers, 'all readers are already created'
+        self._positions.append(0)
+        return self._read(len(self._positions) - 1)
+
+    def _read(self, slot: int) -> TRowsGenerator:
+        handle: tp.BinaryIO | None = None
+        index = 0
+        try:
+            while index < len(self._chunks) or self._pull():
+                chunk = self._chunks[index]
+                if isinstance(chunk, int):
+                    if handle is None:
+                        assert self._path is not None
+                        handle = open(self._path, 'rb')
+                    handle.seek(chunk)
+                    chunk = pickle.load(handle)
+                assert chunk is not None
+                index += 1
+                self._positions[slot] = index
+                self._release()
+                yield from chunk
+        finally:
+            self._positions[slot] = float('inf')
+            self._release()
+            if handle is not None:
+                handle.close()
+
+    def close(self) -> None:
+        """Remove spill file"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._path is not None:
+            os.remove(self._path)
+            self._path = None
+        self._chunks.clear()
+
+    def __enter__(self) -> SpillingTee:
+        return self
+
+    def __exit__(self, *args: tp.Any) -> None:
+        self.close()
@@ -1,6 +1,7 @@
 from itertools import islice, cycle
 from operator import itemgetter
 
+import pytest
 from pytest import approx
 
 from compgraph import algorithms
@@ -63,8 +64,10 @@ def test_word_count_multiple_call() -> None:
     assert list(result2) == expected2
 
 
-def test_tf_idf() -> None:
-    graph = algorithms.inverted_index_graph('texts', doc_column='doc_id', text_column='text', result_column='tf_idf')
+@pytest.mark.parametrize('sort_workers', [1, 3])
+def test_tf_idf(sort_workers: int) -> None:
+    graph = algorithms.inverted_index_graph('texts', doc_column='doc_id', text_column='text', result_column='tf_idf',
+                                            sort_workers=sort_workers)
 
     rows = [
         {'doc_id': 1, 'text': 'hello, little world'},
@@ -97,8 +100,10 @@ def test_tf_idf() -> None:
     assert sorted(result, key=itemgetter('doc_id', 'text')) == expected
 
 
-def test_pmi() -> None:
-    graph = algorithms.pmi_graph('texts', doc_column='doc_id', text_column='text', result_column='pmi')
+@pytest.mark.parametrize('sort_workers', [1, 3])
+def test_pmi(sort_workers: int) -> None:
+    graph = algorithms.pmi_graph('texts', doc_column='doc_id', text_column='text', result_column='pmi',
+                                 sort_workers=sort_workers)
 
     rows = [
         {'doc_id': 1, 'text': 'hello, little world'},
@@ -122,12 +127,14 @@ def test_pmi() -> None:
     assert list(result) == expected
 
 
-def test_yandex_maps() -> None:
+@pytest.mark.parametrize('columnar', [False, True])
+def test_yandex_maps(columnar: bool) -> None:
     graph = algorithms.yandex_maps_graph(
         'travel_time', 'edge_length',
         enter_time_column='enter_time', leave_time_column='leave_time', edge_id_column='edge_id',
         start_coord_column='start', end_coord_column='end',
-        weekday_result_column='weekday', hour_result_column='hour', speed_result_column='speed'
+        weekday_result_column='weekday', hour_result_column='hour', speed_result_column='speed',
+        columnar=columnar
     )
 
     lengths = [
@@ -583,3 +583,56 @@ def test_joiner(case: JoinCase) -> None:
     result = ops.Join(case.joiner, case.join_keys)(iter(case.data_left), iter(case.data_right))
     assert isinstance(result, tp.Iterator)
     assert sorted(result, key=key_func) == sorted(case.ground_truth, key=key_func)
+
+
+@pytest.mark.parametrize('case', JOIN_CASES)
+@pytest.mark.parametrize('memory_limit, partitions', [(10 ** 9, 2), (0, 2), (0, 5)])
+def test_hash_join(case: JoinCase, memory_limit: int, partitions: int) -> None:
+    key_func = _Key(*case.cmp_keys)
+    result = ops.HashJoin(case.joiner, case.join_keys, memory_limit, partitions)(
+        iter(case.data_left), iter(case.data_right))
+    assert isinstance(result, tp.Iterator)
+    assert sorted(result, key=key_func) == sorted(case.ground_truth, key=key_func)
+
+
+@pytest.mark.parametrize('joiner', [ops.InnerJoiner(), ops.LeftJoiner(), ops.RightJoiner(), ops.OuterJoiner()])
+@pytest.mark.parametrize('left_size, right_size', [(3, 200), (200, 3), (150, 150)])
+def test_hash_join_unsorted_inputs(joiner: ops.Joiner, left_size: int, right_size: int) -> None:
+    left = [{'k': (i * 7) % 11, 'a': i} for i in range(left_size)]
+    right = [{'k': (i * 5) % 13, 'b': i} for i in range(right_size)]
+    key_func = _Key('k', 'a', 'b')
+    expected = ops.Join(joiner, ['k'])(sorted(left, key=lambda row: row['k']), sorted(right, key=lambda row: row['k']))
+    result = ops.HashJoin(joiner, ['k'], memory_limit=2000, partitions=3)(iter(left), iter(right))
+    assert sorted(result, key=key_func) == sorted(expected, key=key_func)
+
+
+@pytest.mark.parametrize('joiner', [ops.InnerJoiner(), ops.LeftJoiner(), ops.RightJoiner(), ops.OuterJoiner()])
+@pytest.mark.parametrize('left, right', [
+    ([{'a': 1}, {'a': 2, 'x': 0}], [{'total': 10, 'x': 1}]),
+    ([{'a': 1}, {'a': 2}], [{'b': 1}, {'b': 2}]),
+    ([], [{'b': 1}]),
+    ([{'a': 1}], []),
+])
+def test_broadcast_join(joiner: ops.Joiner, left: list[ops.TRow], right: list[ops.TRow]) -> None:
+    result = list(ops.BroadcastJoin(joiner)(iter(left), iter(right)))
+    expected = list(ops.Join(joiner, [])(iter(left), iter(right)))
+    if isinstance(joiner, ops.RightJoiner):
+        key_func = _Key('a', 'b', 'x', 'total')
+        assert sorted(result, key=key_func) == sorted(expected, key=key_func)
+    else:
+        assert result == expected
+
+
+def test_broadcast_join_converts_right_rows_once(monkeypatch: pytest.MonkeyPatch) -> None:
+    conversions = []
+    to_dict = ops.CompactRow.to_dict
+
+    def counting_to_dict(row: ops.CompactRow) -> ops.TRow:
+        conversions.append(row)
+        return to_dict(row)
+
+    monkeypatch.setattr(ops.CompactRow, 'to_dict', counting_to_dict)
+    right = list(ops.compact([{'total': 10}, {'total': 20}]))
+    result = list(ops.BroadcastJoin(ops.InnerJoiner())(iter([{'a': i} for i in range(100)]), iter(right)))
+    assert result == [{'a': i, 'total': total} for i in range(100) for total in (10, 20)]
+    assert len(conversions) == 2
@@ -34,12 +34,14 @@ def run_and_track_memory(callback: tp.Callable[[], tp.Any], limit: int) -> None:
     assert process_memory <= limit
 
 
-def test_yandex_maps_heavy(baseline_memory: int) -> None:
+@pytest.mark.parametrize('columnar', [False, True])
+def test_yandex_maps_heavy(baseline_memory: int, columnar: bool) -> None:
     graph = algorithms.yandex_maps_graph(
         'travel_time', 'edge_length',
         enter_time_column='enter_time', leave_time_column='leave_time', edge_id_column='edge_id',
         start_coord_column='start', end_coord_column='end',
-        weekday_result_column='weekday', hour_result_column='hour', speed_result_column='speed'
+        weekday_result_column='weekday', hour_result_column='hour', speed_result_column='speed',
+        columnar=columnar
     )
 
     lengths = [
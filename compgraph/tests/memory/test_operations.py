@@ -1,5 +1,7 @@
 import pytest
+import sys
 import time
+import tracemalloc
 import typing as tp
 
 from compgraph import operations as ops
@@ -100,3 +102,51 @@ def get_complexity_join_data() -> tp.Generator[dict[str, tp.Any], None, None]:
 ])
 def test_complexity_join(func_joiner: ops.Joiner) -> None:
     list(ops.Join(func_joiner, ('key', ))(get_complexity_join_data(), get_complexity_join_data()))
+
+
+@pytest.mark.parametrize('func_joiner', [ops.InnerJoiner(), ops.LeftJoiner(), ops.OuterJoiner()])
+def test_heavy_broadcast_join(func_joiner: ops.Joiner, baseline_memory: int) -> None:
+    def exhaust() -> None:
+        for _ in ops.BroadcastJoin(func_joiner)(get_reduce_data(), iter([{'total': 10}])):
+            pass
+    run_and_track_memory(exhaust, baseline_memory + 1 * MiB)
+
+
+def _allocated_per_row(mapper: ops.Mapper, row: dict[str, tp.Any], rows: int) -> float:
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        kept = [result for _ in range(rows) for result in mapper(row)]
+        allocated = tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+    assert len(kept) >= rows
+    return allocated / len(kept)
+
+
+@pytest.mark.parametrize('func_mapper', [
+    ops.Calculate(lambda row: row['n'] * 2, {}, 'double'),
+    ops.Split(column='data', separator=' '),
+    ops.LowerCase(column='data'),
+])
+def test_wide_row_is_shared_by_mapped_rows(func_mapper: ops.Mapper) -> None:
+    row = {f'column_{index}': f'value_{index}' for index in range(100)}
+    row.update({'data': 'HE LLO', 'n': 2})
+    assert _allocated_per_row(func_mapper, row, 1000) < sys.getsizeof(row) / 4
+
+
+def test_compact_rows_take_less_memory() -> None:
+    def traced(rows: tp.Callable[[], tp.List[tp.Any]]) -> int:
+        tracemalloc.start()
+        try:
+            start = tracemalloc.get_traced_memory()[0]
+            kept = rows()
+            return tracemalloc.get_traced_memory()[0] - start - sys.getsizeof(kept)
+        finally:
+            tracemalloc.stop()
+
+    def wide_rows() -> tp.Generator[dict[str, tp.Any], None, None]:
+        for index in range(10000):
+            yield {f'column_{column}': index for column in range(20)}
+
+    assert traced(lambda: list(ops.compact(wide_rows()))) < traced(lambda: list(wide_rows())) / 2
@@ -0,0 +1,190 @@
+# mypy: ignore-errors
+
+import asyncio
+import random
+import time
+
+import pytest
+from compgraph.algorithms import word_count_graph, yandex_maps_graph
+from compgraph.graph import Graph
+from compgraph.optimizer import SortRewrite
+from compgraph import operations as ops
+
+
+@pytest.fixture(scope='module')
+def docs():
+    random.seed(5)
+    words = ['one', 'two', 'three', 'four', 'five', 'six']
+    return [{'doc_id': i, 'text': ' '.join(random.choice(words) for _ in range(random.randint(1, 20)))}
+            for i in range(1000)]
+
+
+async def async_rows(rows):
+    for row in rows:
+        await asyncio.sleep(0)
+        yield dict(row)
+
+
+async def collect(graph, **kwargs):
+    return [row async for row in graph.run_async(**kwargs)]
+
+
+@pytest.mark.parametrize('source', [
+    lambda docs: async_rows(docs),
+    lambda docs: lambda: async_rows(docs),
+    lambda docs: lambda: iter(docs),
+])
+def test_run_async_matches_run(docs, source):
+    graph = word_count_graph('docs')
+    expected = list(graph.run(docs=lambda: iter(docs)))
+    assert asyncio.run(collect(graph, docs=source(docs))) == expected
+
+
+def test_run_async_with_joined_async_sources():
+    travel_times = [{'edge_id': i % 7, 'enter_time': '20171020T112238.723000', 'leave_time': '20171020T112338.723000'}
+                    for i in range(100)]
+    lengths = [{'edge_id': i, 'start': [37.84, 55.73], 'end': [37.85, 55.74]} for i in range(7)]
+    graph = yandex_maps_graph('travel_time', 'edge_length')
+    expected = list(graph.run(travel_time=lambda: iter(travel_times), edge_length=lambda: iter(lengths)))
+    result = asyncio.run(collect(graph, travel_time=lambda: async_rows(travel_times),
+                                 edge_length=lambda: async_rows(lengths)))
+    assert result == expected
+
+
+def test_event_loop_is_free_while_graph_sorts():
+    rows = [{'value': random.random()} for _ in range(100_000)]
+    graph = Graph.graph_from_iter('rows').sort(['value'])
+
+    async def main():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.001)
+
+        task = asyncio.create_task(ticker())
+        result = await collect(graph, rows=lambda: iter(rows))
+        task.cancel()
+        return result, ticks
+
+    result, ticks = asyncio.run(main())
+    assert result == sorted(rows, key=lambda row: row['value'])
+    assert ticks > 1
+
+
+def test_run_async_stops_graph_when_consumer_stops():
+    pulled = 0
+
+    def rows():
+        nonlocal pulled
+        for i in range(1_000_000):
+            pulled += 1
+            yield {'value': i}
+
+    async def main():
+        generator = Graph.graph_from_iter('rows').map(ops.DummyMapper()).run_async(rows=rows)
+        async for row in generator:
+            if row['value'] == 10:
+                break
+        await generator.aclose()
+
+    asyncio.run(main())
+    assert pulled < 100_000
+
+
+def test_run_async_raises_graph_error():
+    async def broken_rows():
+        yield {'value': 1}
+        raise ValueError('broken source')
+
+    with pytest.raises(ValueError, match='broken source'):
+        asyncio.run(collect(Graph.graph_from_iter('rows').sort(['value']), rows=broken_rows))
+
+
+class CacheServer:
+    """Stand-in of a cache service: every lookup waits for latency, at most capacity lookups are served at once"""
+
+    def __init__(self, latency, capacity=1000):
+        self.latency = latency
+        self.capacity = capacity
+        self.active = 0
+        self.max_active = 0
+
+    async def lookup(self, row, key):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.latency * random.random())
+            return row[key] * 10
+        finally:
+            self.active -= 1
+
+
+def test_async_map_matches_sync_lookups():
+    server = CacheServer(0.002)
+    rows = [{'id': i} for i in range(200)]
+    mapper = ops.AsyncCalculate(server.lookup, {'key': 'id'}, 'value', concurrency=8)
+    result = list(Graph.graph_from_iter('rows').map(mapper).run(rows=lambda: iter(rows)))
+    assert result == [{'id': i, 'value': i * 10} for i in range(200)]
+    assert server.max_active == 8
+    assert list(mapper({'id': 3})) == [{'id': 3, 'value': 30}]
+
+
+def test_unordered_async_map_yields_all_rows():
+    server = CacheServer(0.002)
+    rows = [{'id': i} for i in range(200)]
+    mapper = ops.AsyncCalculate(server.lookup, {'key': 'id'}, 'value', concurrency=8, ordered=False)
+    result = list(Graph.graph_from_iter('rows').map(mapper).run(rows=lambda: iter(rows)))
+    assert sorted(result, key=lambda row: row['id']) == [{'id': i, 'value': i * 10} for i in range(200)]
+
+
+def test_async_map_throughput_scales_with_concurrency():
+    rows = [{'id': i} for i in range(100)]
+
+    async def lookup(row):
+        await asyncio.sleep(0.01)
+        return row['id']
+
+    def elapsed(concurrency):
+        graph = Graph.graph_from_iter('rows').map(ops.AsyncCalculate(lookup, {}, 'value', concurrency=concurrency))
+        start = time.perf_counter()
+        assert len(list(graph.run(rows=lambda: iter(rows)))) == 100
+        return time.perf_counter() - start
+
+    assert elapsed(50) * 5 < elapsed(1)
+
+
+def test_async_map_timeout():
+    async def slow(row):
+        await asyncio.sleep(10 if row['id'] == 5 else 0)
+        return 1
+
+    graph = Graph.graph_from_iter('rows').map(ops.AsyncCalculate(slow, {}, 'value', timeout=0.05))
+    start = time.perf_counter()
+    with pytest.raises(TimeoutError):
+        list(graph.run(rows=lambda: iter([{'id': i} for i in range(10)])))
+    assert time.perf_counter() - start < 5
+
+
+def test_async_map_runs_on_loop_of_run_async():
+    async def main():
+        loop = asyncio.get_running_loop()
+
+        async def loop_of_call(row):
+            return asyncio.get_running_loop() is loop
+
+        graph = Graph.graph_from_iter('rows').map(ops.AsyncCalculate(loop_of_call, {}, 'same_loop'))
+        return await collect(graph, rows=lambda: async_rows([{'id': i} for i in range(50)]))
+
+    assert all(row['same_loop'] for row in asyncio.run(main()))
+
+
+def test_async_map_keeps_sortedness():
+    async def lookup(row):
+        return row['id']
+
+    graph = Graph.graph_from_iter('rows').sort(['id']) \
+        .map(ops.AsyncCalculate(lookup, {}, 'value')).sort(['id'])
+    assert [rewrite.action for rewrite in graph.sort_report()] == [SortRewrite.REMOVED]
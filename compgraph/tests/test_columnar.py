@@ -0,0 +1,224 @@
+# mypy: ignore-errors
+
+import datetime
+import random
+
+import pytest
+from compgraph.columnar import Batch, ColumnarStage, to_batches, to_rows, vectorize
+from compgraph.external_sort import ExternalSort
+from compgraph.dag import Plan
+from compgraph.graph import Graph
+from compgraph import algorithms
+from compgraph import operations as ops
+
+np = pytest.importorskip('numpy')
+
+
+@pytest.fixture
+def sales_rows():
+    random.seed(7)
+    return [
+        {'shop': f'shop_{random.randint(0, 9)}', 'day': random.randint(1, 7),
+         'price': random.choice([0.5, 1.25, 3.0, 10.0]), 'amount': random.randint(0, 5), 'id': i}
+        for i in range(5000)
+    ]
+
+
+def sales_graph(columnar, sort_memory_limit=64 * 1024 * 1024):
+    graph = Graph.graph_from_iter('sales') \
+        .map(ops.Filter(lambda row: row['amount'] > 0, vectorized=True)) \
+        .map(ops.Product(['price', 'amount'], 'revenue')) \
+        .map(ops.Calculate(lambda row, column: row[column] * 2, {'column': 'day'}, 'half_weeks', vectorized=True)) \
+        .map(ops.Project(['shop', 'day', 'revenue', 'half_weeks'])) \
+        .sort(['shop', 'day'], memory_limit=sort_memory_limit) \
+        .reduce(ops.Sum('revenue'), ['shop', 'day'])
+    graph.columnar = columnar
+    return graph
+
+
+def test_rows_survive_batches():
+    rows = [{'a': 1, 'b': 'x'}, {'a': 2, 'b': 'y'}, {'b': 'z', 'a': 3}, {'c': [1, 2]}, {'a': 1.5, 'b': None},
+            {'a': 2 ** 70, 'b': True}, {}]
+    batches = list(to_batches(rows, batch_rows=2))
+    assert [batch.length for batch in batches] == [2, 1, 1, 2, 1]
+    result = list(to_rows(batches))
+    assert result == rows
+    assert [list(row) for row in result] == [list(row) for row in rows]
+    assert [type(row['a']) for row in result if 'a' in row] == [int, int, int, float, int]
+
+
+def test_batch_take():
+    batch = Batch.from_rows([{'a': 1}, {'a': 2}, {'a': 3}])
+    assert list(batch.take(np.array([False, True, True])).to_rows()) == [{'a': 2}, {'a': 3}]
+    assert list(batch.take(np.array([2, 0])).to_rows()) == [{'a': 3}, {'a': 1}]
+
+
+@pytest.mark.parametrize('sort_memory_limit', [64 * 1024 * 1024, 4096])
+def test_columnar_graph_matches_row_graph(sales_rows, sort_memory_limit):
+    expected = list(sales_graph(False).run(sales=lambda: iter(sales_rows)))
+    result = list(sales_graph(True, sort_memory_limit).run(sales=lambda: iter(sales_rows)))
+    assert [{key: row[key] for key in ('shop', 'day')} for row in result] == \
+        [{key: row[key] for key in ('shop', 'day')} for row in expected]
+    assert [row['revenue'] for row in result] == pytest.approx([row['revenue'] for row in expected])
+
+
+@pytest.mark.parametrize('reducer, keys', [
+    (ops.Count('count'), ['shop']),
+    (ops.Count('count'), []),
+    (ops.Sum('amount'), ['shop', 'day']),
+    (ops.Average('price'), ['day']),
+])
+def test_reduce_kernel_groups_span_batches(sales_rows, reducer, keys):
+    graph = Graph.graph_from_iter('sales').sort(keys or ['id']).reduce(reducer, keys)
+    stage = ColumnarStage(graph.operations[1:], batch_rows=100)
+    expected = list(graph.run(sales=lambda: iter(sales_rows)))
+    result = list(stage(iter(sales_rows)))
+    assert [{key: row[key] for key in keys} for row in result] == [{key: row[key] for key in keys} for row in expected]
+    assert [row[reducer.column] for row in result] == pytest.approx([row[reducer.column] for row in expected])
+
+
+@pytest.mark.parametrize('reducer', [ops.Sum('value'), ops.Average('value')])
+@pytest.mark.parametrize('values', [
+    [2 ** 62, 2 ** 62, 2 ** 62, -1, 5],
+    [-2 ** 63, -1, 3, -2 ** 63],
+    [2 ** 63 - 1] * 3 + [-(2 ** 63 - 1)] * 3,
+    [2 ** 62, 0.5, 2 ** 62, 2 ** 62],
+])
+@pytest.mark.parametrize('batch_rows', [1, 2, 100])
+def test_reduce_kernel_sums_do_not_overflow(reducer, values, batch_rows):
+    rows = [{'key': 'a', 'value': value} for value in values] + [{'key': 'b', 'value': value} for value in values]
+    reduce = ops.Reduce(reducer, ['key'])
+    result = list(ColumnarStage([reduce], batch_rows=batch_rows)(iter(rows)))
+    assert result == list(reduce(iter(rows)))
+
+
+@pytest.mark.parametrize('tail', [
+    [{'k': -1, 'v': 7}],
+    [{'k': -1, 'v': 0.5}, {'k': -2, 'v': 1.5}],
+])
+@pytest.mark.parametrize('head_value', ['x', 1])
+@pytest.mark.parametrize('batch_rows', [3, 4096])
+def test_sort_kernel_keeps_types_of_mixed_batches(head_value, tail, batch_rows):
+    rows = [{'k': i, 'v': head_value} for i in range(4096)] + tail
+    sort = ExternalSort(['k'])
+    expected = sorted(rows, key=lambda row: row['k'])
+    result = list(ColumnarStage([sort], batch_rows=batch_rows)(iter(rows)))
+    assert result == expected
+    assert [type(row['v']) for row in result] == [type(row['v']) for row in expected]
+    graph = Graph.graph_from_iter('rows').sort(['k'])
+    graph.columnar = True
+    assert [(row['v'], type(row['v'])) for row in graph.run(rows=lambda: iter(rows))] == \
+        [(row['v'], type(row['v'])) for row in expected]
+
+
+def test_join_kernel_keeps_types_of_mixed_build_batches():
+    left = [{'id': i % 5, 'value': i} for i in range(8)] + [{'id': 1, 'value': 0.5}, {'id': 2, 'value': 1.5}]
+    right = [{'id': i, 'length': i * 2} for i in range(5000)]
+    join = ops.HashJoin(ops.InnerJoiner(), ['id'])
+    result = list(ColumnarStage([join], batch_rows=4)(iter(left), iter(right)))
+    expected = list(join(iter(left), iter(right)))
+    assert [(row['value'], type(row['value'])) for row in result] == \
+        [(row['value'], type(row['value'])) for row in expected]
+
+
+@pytest.mark.parametrize('batch_rows', [1, 2])
+def test_reduce_kernel_keeps_int_sums_next_to_float_carry(batch_rows):
+    rows = [{'key': 'a', 'value': 0.5}, {'key': 'a', 'value': 1.5}, {'key': 'a', 'value': 1}, {'key': 'b', 'value': 3}]
+    reduce = ops.Reduce(ops.Sum('value'), ['key'])
+    result = list(ColumnarStage([reduce], batch_rows=batch_rows)(iter(rows)))
+    expected = list(reduce(iter(rows)))
+    assert [(row['value'], type(row['value'])) for row in result] == \
+        [(row['value'], type(row['value'])) for row in expected]
+
+
+@pytest.mark.parametrize('rows', [
+    [{'a': 10 ** 10, 'b': 10 ** 10}, {'a': 2, 'b': 3}],
+    [{'a': -2 ** 32, 'b': 2 ** 31, 'c': 3}, {'a': 1, 'b': 1, 'c': 1}],
+    [{'a': 2 ** 62, 'b': 0.5}],
+    [{'a': 3, 'b': 4}],
+])
+def test_product_kernel_does_not_overflow(rows):
+    product = ops.Map(ops.Product(list(rows[0]), 'product'))
+    result = list(ColumnarStage([product])(iter(rows)))
+    expected = list(product(iter(rows)))
+    assert [(row['product'], type(row['product'])) for row in result] == \
+        [(row['product'], type(row['product'])) for row in expected]
+
+
+def test_vectorize_keeps_unsupported_operations():
+    operations = [
+        ops.ReadIterFactory('docs'),
+        ops.FusedMap([ops.Project(['text']), ops.LowerCase('text'), ops.Split('text'),
+                      ops.Filter(lambda row: row['text'] != '', vectorized=True)]),
+        ExternalSort(['text']),
+        ops.Reduce(ops.Count('count'), ['text']),
+        ops.Reduce(ops.FirstReducer(), ['text']),
+    ]
+    plan = vectorize(operations)
+    assert [type(operation) for operation in plan] == \
+        [ops.ReadIterFactory, ColumnarStage, ops.FusedMap, ColumnarStage, ops.Reduce]
+    assert len(plan[3].operations) == 3
+
+
+def test_word_count_in_columnar_mode():
+    docs = [{'doc_id': i, 'text': f'hello, little world {i % 3}! Hello {i % 5}'} for i in range(200)]
+    graph = algorithms.word_count_graph('docs')
+    expected = list(graph.run(docs=lambda: iter(docs)))
+    assert any(isinstance(operation, ColumnarStage) for operation in Plan(graph, columnar=True).output.operations)
+    graph.columnar = True
+    assert list(graph.run(docs=lambda: iter(docs))) == expected
+
+
+@pytest.mark.parametrize('values', [
+    ['20171020T112238.723000', '20171011T145553.04', '20240229T000000.1', '19991231T235959.999999'],
+    ['20171020T112238.723000'] * 3,
+])
+def test_parse_timestamps_matches_strptime(values):
+    parsed = ops.parse_timestamps(np.array(values))
+    assert parsed.tolist() == [datetime.datetime.strptime(value, ops.TIMESTAMP_FORMAT) for value in values]
+    column = {'time': np.array(values)}
+    assert ops.hour(column, 'time').tolist() == [ops.hour({'time': value}, 'time') for value in values]
+    assert ops.weekday(column, 'time').tolist() == [ops.weekday({'time': value}, 'time') for value in values]
+
+
+@pytest.mark.parametrize('value', ['20230230T000000.1', '20230101T250000.1', '20230101 000000.1', '20230101T000000.'])
+def test_parse_timestamps_rejects_as_strptime(value):
+    with pytest.raises(ValueError):
+        ops.parse_timestamps(np.array([value]))
+
+
+def test_vectorized_haversine_matches_row():
+    rows = [{'start': [37.84, 55.73], 'end': [37.85, 55.74]}, {'start': [-10.5, 0.0], 'end': [10.5, 1.0]}]
+    batch = Batch.from_rows(rows)
+    result = ops.haversine_distance(batch.columns, 'start', 'end')
+    assert result.tolist() == pytest.approx([ops.haversine_distance(row, 'start', 'end') for row in rows])
+
+
+@pytest.mark.parametrize('left_size, right_size', [(1000, 7), (7, 1000), (500, 500), (0, 10), (10, 0)])
+def test_join_kernel_matches_hash_join(left_size, right_size):
+    left = [{'id': i % 13, 'value': i, 'name': f'left_{i}'} for i in range(left_size)]
+    right = [{'id': i % 11, 'value': -i, 'length': i * 0.5} for i in range(right_size)]
+    join = ops.HashJoin(ops.InnerJoiner(), ['id'])
+    stage = ColumnarStage([join], batch_rows=64)
+    assert stage.join_inputs == 1
+    assert list(stage(iter(left), iter(right))) == list(join(iter(left), iter(right)))
+
+
+def test_join_kernel_falls_back_above_memory_limit():
+    left = [{'id': i % 13, 'value': i} for i in range(3000)]
+    right = [{'id': i % 11, 'length': i} for i in range(3000)]
+    join = ops.HashJoin(ops.InnerJoiner(), ['id'], memory_limit=1000)
+    result = list(ColumnarStage([join], batch_rows=64)(iter(left), iter(right)))
+    assert sorted(result, key=lambda row: (row['value'], row['length'])) == \
+        sorted(join(iter(left), iter(right)), key=lambda row: (row['value'], row['length']))
+
+
+def test_parsed_timestamps_in_batches():
+    values = ['20171020T112238.723000', '20171011T145553.040000']
+    rows = [{'time': value} for value in values]
+    stage = ColumnarStage([ops.Map(ops.ParseTimestamp('time', 'parsed')),
+                           ops.Map(ops.Calculate(ops.hour, {'datetime_column': 'parsed'}, 'hour', vectorized=True))])
+    result = list(stage(iter(rows)))
+    assert [row['parsed'] for row in result] == [ops.parse_timestamp(value) for value in values]
+    assert [row['hour'] for row in result] == [11, 14]
+    assert Batch.from_rows(result).columns['parsed'].dtype.kind == 'M'
@@ -0,0 +1,88 @@
+# mypy: ignore-errors
+
+import os
+import random
+
+import pytest
+from compgraph.algorithms import inverted_index_graph, pmi_graph, word_count_graph
+from compgraph.distributed import LocalCluster, RemoteTaskError, Stage, distribute
+from compgraph.graph import Graph
+from compgraph import operations as ops
+from compgraph.spill import read_spilled, write_spilled
+
+
+@pytest.fixture(scope='module')
+def docs():
+    random.seed(11)
+    words = ['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'theta', 'iota']
+    return [{'doc_id': i, 'text': ' '.join(random.choice(words) for _ in range(random.randint(1, 30)))}
+            for i in range(200)]
+
+
+@pytest.mark.parametrize('build_graph', [word_count_graph, inverted_index_graph, pmi_graph])
+def test_cluster_run_matches_local_run(docs, build_graph):
+    graph = build_graph('docs')
+    expected = list(graph.run(docs=lambda: iter(docs)))
+    with LocalCluster(2) as cluster:
+        graph.cluster = cluster
+        assert list(graph.run(docs=lambda: iter(docs))) == expected
+        assert cluster.stats.tasks > 0 and cluster.stats.retries == 0
+
+
+def test_lost_node_task_is_retried(docs):
+    graph = word_count_graph('docs')
+    expected = list(graph.run(docs=lambda: iter(docs)))
+    with LocalCluster(3) as cluster:
+        cluster.kill(1)
+        graph.cluster = cluster
+        assert list(graph.run(docs=lambda: iter(docs))) == expected
+        assert cluster.stats.lost_nodes == 1 and cluster.stats.retries >= 1 and cluster.size == 2
+
+
+def test_all_nodes_lost(docs):
+    with LocalCluster(1) as cluster:
+        cluster.kill(0)
+        graph = word_count_graph('docs')
+        graph.cluster = cluster
+        with pytest.raises(RuntimeError, match='all nodes of the cluster are lost'):
+            list(graph.run(docs=lambda: iter(docs)))
+        assert cluster.size == 0
+        with pytest.raises(RuntimeError, match='no cluster nodes are available'):
+            list(graph.run(docs=lambda: iter(docs)))
+
+
+def test_operation_error_is_not_retried():
+    with LocalCluster(2) as cluster:
+        stage = distribute(ops.Reduce(ops.Sum('value'), ['key']), cluster)
+        assert isinstance(stage, Stage)
+        with pytest.raises(RemoteTaskError):
+            list(stage(iter([{'key': 1, 'value': 'x'}, {'key': 1, 'value': 1}])))
+        assert cluster.stats.retries == 0 and cluster.size == 2
+        assert list(stage(iter([{'key': 1, 'value': 2}, {'key': 1, 'value': 3}]))) == [{'key': 1, 'value': 5}]
+
+
+def test_keyless_operations_stay_local():
+    with LocalCluster(1) as cluster:
+        reduce = ops.Reduce(ops.Count('count'), [])
+        assert distribute(reduce, cluster) is reduce
+        graph = Graph.graph_from_iter('rows').reduce(ops.Count('count'), [])
+        graph.cluster = cluster
+        assert list(graph.run(rows=lambda: iter([{'a': 1}] * 5))) == [{'count': 5}]
+
+
+@pytest.mark.skipif(not os.path.exists('/dev/full'), reason='needs /dev/full to simulate a full disk')
+def test_local_file_error_is_not_retried(tmp_path):
+    rows = sorted(({'key': i % 3, 'value': i} for i in range(30)), key=lambda row: row['key'])
+    reduce = ops.Reduce(ops.Sum('value'), ['key'])
+    expected = list(reduce(iter(rows)))
+    input_path, output_path = str(tmp_path / 'input'), str(tmp_path / 'output')
+    write_spilled(rows, input_path)
+    with LocalCluster(2) as cluster:
+        with pytest.raises(OSError):
+            cluster.submit(reduce, [input_path], str(tmp_path / 'missing' / 'output')).result()
+        with pytest.raises(OSError):
+            cluster.submit(reduce, [input_path], '/dev/full').result()
+        assert cluster.stats.retries == 0 and cluster.stats.lost_nodes == 0 and cluster.size == 2
+        for node in cluster.nodes:
+            node.run(reduce, [input_path], output_path)
+            assert list(read_spilled(output_path)) == expected
@@ -0,0 +1,150 @@
+# mypy: ignore-errors
+
+import os
+import random
+from operator import itemgetter
+
+import pytest
+from compgraph.external_sort import ExternalSort, ParallelSort, SortWorkerPool, choose_splitters, sort_rows
+from compgraph.spill import SpillingTee
+from compgraph import algorithms, external_sort
+
+
+@pytest.fixture
+def shuffled_rows():
+    random.seed(42)
+    rows = [{'key': random.randint(0, 50), 'name': f'name_{random.randint(0, 5)}', 'index': i} for i in range(3000)]
+    return rows
+
+
+@pytest.mark.parametrize('keys', [['key'], ['name', 'key'], ['key', 'name']])
+def test_spilled_sort_matches_in_memory_sort(shuffled_rows, keys):
+    result = list(ExternalSort(keys, memory_limit=4096)(iter(shuffled_rows)))
+    assert result == sorted(shuffled_rows, key=itemgetter(*keys))
+
+
+def test_sort_rows_keeps_temp_dir_clean(shuffled_rows, tmp_path):
+    rows = ((row, 100) for row in shuffled_rows)
+    result = list(sort_rows(rows, ['key'], memory_limit=1000, tmp_dir=str(tmp_path)))
+    assert result == sorted(shuffled_rows, key=itemgetter('key'))
+    assert os.listdir(tmp_path) == []
+
+
+def test_multi_pass_merge(shuffled_rows, monkeypatch):
+    monkeypatch.setattr(external_sort, 'MAX_MERGE_FAN_IN', 3)
+    rows = ((row, 1) for row in shuffled_rows)
+    result = list(sort_rows(rows, ['name'], memory_limit=100))
+    assert result == sorted(shuffled_rows, key=itemgetter('name'))
+
+
+@pytest.mark.parametrize('batch_size, expected_messages', [(1, 2 * 3001), (1000, 2 * 4), (5000, 2 * 2)])
+def test_batched_transport_counters(shuffled_rows, batch_size, expected_messages):
+    operation = ExternalSort(['key'], batch_size=batch_size)
+    result = list(operation(iter(shuffled_rows)))
+    assert result == sorted(shuffled_rows, key=itemgetter('key'))
+    assert operation.stats.messages_sent + operation.stats.messages_received == expected_messages
+    assert operation.stats.bytes_sent > 0 and operation.stats.bytes_received > 0
+
+
+def test_transport_stats_reset(shuffled_rows):
+    operation = ExternalSort(['key'], batch_size=100)
+    list(operation(iter(shuffled_rows)))
+    operation.stats.reset()
+    assert operation.stats.bytes_sent == operation.stats.messages_received == 0
+
+
+@pytest.mark.parametrize('workers, sample_size', [(1, 100), (4, 100), (4, 10), (8, 5000)])
+def test_parallel_sort_matches_external_sort(shuffled_rows, workers, sample_size):
+    keys = ['name', 'key']
+    operation = ParallelSort(keys, workers, memory_limit=4096, batch_size=64, sample_size=sample_size)
+    assert list(operation(iter(shuffled_rows))) == list(ExternalSort(keys)(iter(shuffled_rows)))
+
+
+def test_parallel_sort_empty_input():
+    assert list(ParallelSort(['key'], 4)(iter([]))) == []
+
+
+
+@pytest.mark.parametrize('order', [1, -1])
+def test_parallel_sort_of_sorted_input_uses_one_partition(shuffled_rows, order):
+    rows = sorted(shuffled_rows, key=itemgetter('key', 'index'), reverse=order < 0)
+    operation = ParallelSort(['key', 'index'], 4, sample_size=500)
+    assert list(operation(iter(rows))) == sorted(rows, key=itemgetter('key', 'index'))
+    assert operation.partition_rows == [len(rows)]
+
+
+@pytest.mark.parametrize('sample_size', [500, 5000])
+def test_parallel_sort_partitions_are_balanced(shuffled_rows, sample_size):
+    operation = ParallelSort(['key', 'index'], 4, sample_size=sample_size)
+    list(operation(iter(shuffled_rows)))
+    assert len(operation.partition_rows) == 4
+    assert all(abs(count - len(shuffled_rows) / 4) < len(shuffled_rows) / 10 for count in operation.partition_rows)
+
+
+def test_parallel_sort_of_sorted_input_within_sample_is_balanced(shuffled_rows):
+    rows = sorted(shuffled_rows, key=itemgetter('key', 'index'))
+    operation = ParallelSort(['key', 'index'], 4, sample_size=len(rows))
+    list(operation(iter(rows)))
+    assert operation.partition_rows == [len(rows) // 4] * 4
+
+@pytest.mark.parametrize('sample_keys, partitions, expected', [
+    ([1, 2, 3, 4, 5, 6, 7, 8], 4, [3, 5, 7]),
+    ([1, 1, 1, 1, 2], 3, [1]),
+    ([5], 4, [5]),
+    ([], 4, []),
+])
+def test_choose_splitters(sample_keys, partitions, expected):
+    assert choose_splitters(sample_keys, partitions) == expected
+
+
+def test_sort_worker_pool_reuses_processes(shuffled_rows):
+    with SortWorkerPool(max_workers=2) as pool:
+        pool.start(warm_workers=1)
+        assert pool.size == 1 and pool.stats.spawn_count == 1
+        for _ in range(3):
+            result = list(ParallelSort(['key'], 2)(iter(shuffled_rows), sort_pool=pool))
+            assert result == sorted(shuffled_rows, key=itemgetter('key'))
+        assert pool.size == 2
+        assert pool.stats.spawn_count == 2
+        assert pool.stats.sort_count == 3
+        assert pool.stats.sort_seconds > 0 and pool.stats.spawn_seconds > 0
+    assert pool.size == 0
+
+
+def test_sort_worker_pool_overflow_and_abandoned_sort(shuffled_rows):
+    pool = SortWorkerPool(max_workers=1).start()
+    first = ExternalSort(['key'])(iter(shuffled_rows), sort_pool=pool)
+    next(first)
+    second = ExternalSort(['name'])(iter(shuffled_rows), sort_pool=pool)
+    assert list(second) == sorted(shuffled_rows, key=itemgetter('name'))
+    assert pool.size == 1
+    first.close()
+    assert pool.size == 0
+    assert list(ExternalSort(['key'])(iter(shuffled_rows), sort_pool=pool)) == \
+        sorted(shuffled_rows, key=itemgetter('key'))
+    pool.shutdown()
+
+
+def test_graph_owned_sort_pool():
+    docs = [{'doc_id': 1, 'text': 'hello, my little WORLD'}, {'doc_id': 2, 'text': 'Hello, my little little hell'}]
+    graph = algorithms.word_count_graph('docs')
+    expected = list(graph.run(docs=lambda: iter(docs)))
+    with graph:
+        pool = graph.start_sort_pool(max_workers=2, warm_workers=2)
+        for _ in range(3):
+            assert list(graph.run(docs=lambda: iter(docs))) == expected
+        assert pool.stats.spawn_count == 2
+        assert pool.stats.sort_count == 6
+    assert graph.sort_pool is None and pool.size == 0
+
+
+@pytest.mark.parametrize('memory_limit', [10 ** 9, 1000])
+def test_spilling_tee_readers_at_different_pace(shuffled_rows, memory_limit, tmp_path):
+    with SpillingTee(iter(shuffled_rows), 3, memory_limit, tmp_dir=str(tmp_path)) as tee:
+        first, second, third = tee.reader(), tee.reader(), tee.reader()
+        head = [next(second) for _ in range(10)]
+        assert list(first) == shuffled_rows
+        assert tee.spilled == (memory_limit < 10 ** 9)
+        assert head + list(second) == shuffled_rows
+        assert list(third) == shuffled_rows
+    assert os.listdir(tmp_path) == []
@@ -1,7 +1,14 @@
 # mypy: ignore-errors
 
+import json
+import tempfile
+
 import pytest
 from compgraph.algorithms import word_count_graph, inverted_index_graph, pmi_graph, yandex_maps_graph
+from compgraph.graph import Graph
+from compgraph import operations as ops
+from compgraph.external_sort import ExternalSort, GroupSort
+from compgraph.optimizer import SortRewrite
 
 
 @pytest.fixture
@@ -107,3 +114,233 @@ def test_yandex_maps_graph(sample_map_data_time, sample_map_data_length):
 
     assert len(result) > 0
     assert all("weekday" in row and "hour" in row and "speed" in row for row in result)
+
+
+def test_consecutive_maps_are_fused():
+    graph = Graph.graph_from_iter('data') \
+        .map(ops.FilterPunctuation('text')) \
+        .map(ops.LowerCase('text')) \
+        .map(ops.Split('text')) \
+        .sort(['text'])
+    fused = [operation for operation in graph.plan() if isinstance(operation, ops.FusedMap)]
+    assert len(fused) == 1
+    assert [type(mapper) for mapper in fused[0].mappers] == [ops.FilterPunctuation, ops.LowerCase, ops.Split]
+    assert not any(isinstance(operation, ops.FusedMap) for operation in graph.plan(optimize=False))
+
+
+@pytest.mark.parametrize('mappers', [
+    [ops.FilterPunctuation('text'), ops.LowerCase('text'), ops.Split('text')],
+    [ops.Split('text'), ops.Filter(lambda row: len(row['text']) > 2), ops.LowerCase('text'), ops.Product(['n'])],
+    [ops.DummyMapper(), ops.Project(['text', 'n']), ops.Filter(lambda row: row['n'] > 1)],
+    [ops.Calculate(lambda row, column: len(row[column]), {'column': 'text'}, 'length'), ops.LowerCase('text')],
+])
+def test_fused_map_matches_plain_maps(mappers):
+    rows = [{'text': 'Hello, World! Hi', 'n': 2}, {'text': 'ONE two', 'n': 1}, {'text': '', 'n': 3}]
+    graph = Graph.graph_from_iter('data')
+    for mapper in mappers:
+        graph = graph.map(mapper)
+    optimized = list(graph.run(data=lambda: iter(rows)))
+    graph.optimize = False
+    assert optimized == list(graph.run(data=lambda: iter(rows)))
+    assert rows[0] == {'text': 'Hello, World! Hi', 'n': 2}
+
+
+def test_map_only_graph_yields_dicts():
+    graph = Graph.graph_from_iter('data') \
+        .map(ops.Calculate(lambda row: row['a'] * 2, {}, 'b')) \
+        .map(ops.Split('text'))
+    result = list(graph.run(data=lambda: iter([{'a': 1, 'text': 'x y'}])))
+    assert result == [{'a': 1, 'text': 'x', 'b': 2}, {'a': 1, 'text': 'y', 'b': 2}]
+    assert all(type(row) is dict for row in result)
+    assert json.loads(json.dumps(result)) == result
+
+
+def test_settings_survive_chaining():
+    settings = {'optimize': False, 'columnar': True, 'compact_rows': True, 'sort_pool': object(),
+                'cluster': object(), 'tee_memory_limit': 1, 'tee_tmp_dir': 'spill'}
+    graph = Graph.graph_from_iter('data')
+    for name, value in settings.items():
+        setattr(graph, name, value)
+    other = Graph.graph_from_iter('other')
+    chained = graph.map(ops.DummyMapper()).sort(['a']).reduce(ops.FirstReducer(), ['a']) \
+        .join(ops.InnerJoiner(), other, ['a'])
+    assert {name: getattr(chained, name) for name in settings} == settings
+    assert chained.graphs_to_join == [other]
+
+
+def test_redundant_sort_after_join_is_removed():
+    graph = inverted_index_graph(input_stream_name="data")
+    assert graph.sort_report() == [SortRewrite(SortRewrite.REMOVED, ['text'], ['text'])]
+    graph.optimize = False
+    assert graph.sort_report() == []
+
+
+@pytest.mark.parametrize('second_sort, expected_action', [
+    (['a'], SortRewrite.REMOVED),
+    (['a', 'b'], SortRewrite.REMOVED),
+    (['a', 'c'], SortRewrite.WEAKENED),
+    (['c', 'a'], None),
+])
+def test_sortedness_tracking(second_sort, expected_action):
+    rows = [{'a': i % 3, 'b': i % 5, 'c': (i * 7) % 4} for i in range(40)]
+    graph = Graph.graph_from_iter('data') \
+        .sort(['a', 'b']) \
+        .map(ops.Filter(lambda row: row['b'] != 1)) \
+        .map(ops.Product(['b', 'c'], 'product')) \
+        .sort(second_sort)
+    assert [rewrite.action for rewrite in graph.sort_report()] == ([expected_action] if expected_action else [])
+    if expected_action == SortRewrite.WEAKENED:
+        assert isinstance(graph.plan()[-1], GroupSort)
+    optimized = list(graph.run(data=lambda: iter(rows)))
+    graph.optimize = False
+    assert optimized == list(graph.run(data=lambda: iter(rows)))
+
+
+def test_changed_column_breaks_ordering():
+    graph = Graph.graph_from_iter('data') \
+        .sort(['text']) \
+        .map(ops.LowerCase('text')) \
+        .sort(['text'])
+    assert graph.sort_report() == []
+
+
+def test_hash_grouping_reduce_needs_no_sort(sample_word_data):
+    graph = Graph.graph_from_iter('data') \
+        .map(ops.Split('text')) \
+        .reduce(ops.Count('count'), ['text'], hash_grouping=True) \
+        .sort(['text'])
+    expected = Graph.graph_from_iter('data') \
+        .map(ops.Split('text')) \
+        .sort(['text']) \
+        .reduce(ops.Count('count'), ['text'])
+    assert list(graph.run(data=lambda: iter(sample_word_data))) == \
+        list(expected.run(data=lambda: iter(sample_word_data)))
+
+
+def test_combiner_is_inserted_before_sort(sample_word_data):
+    graph = word_count_graph(input_stream_name="data")
+    plan = graph.plan()
+    combine_index = next(index for index, operation in enumerate(plan) if isinstance(operation, ops.Combine))
+    assert isinstance(plan[combine_index + 1], ExternalSort)
+    assert isinstance(plan[combine_index + 2].reducer, ops.MergePartials)
+
+    sort = plan[combine_index + 1]
+    optimized = list(graph.run(data=lambda: iter(sample_word_data * 100)))
+    combined_bytes = sort.stats.bytes_sent
+    sort.stats.reset()
+    graph.optimize = False
+    assert optimized == list(graph.run(data=lambda: iter(sample_word_data * 100)))
+    assert combined_bytes < sort.stats.bytes_sent / 10
+
+
+
+def test_combiner_is_not_inserted_for_float_sums():
+    data = [{'k': index % 3, 'v': 0.1 * index} for index in range(1000)]
+    graph = Graph.graph_from_iter('data') \
+        .sort(['k']) \
+        .reduce(ops.Sum('v'), ['k'])
+    assert not any(isinstance(operation, ops.Combine) for operation in graph.plan())
+    optimized = list(graph.run(data=lambda: iter(data)))
+    graph.optimize = False
+    assert optimized == list(graph.run(data=lambda: iter(data)))
+
+def test_keyless_join_is_broadcast():
+    plan = inverted_index_graph(input_stream_name="data").graphs_to_join[0].plan()
+    assert any(isinstance(operation, ops.BroadcastJoin) for operation in plan)
+    assert not any(isinstance(operation, ops.Join) and not operation.keys for operation in plan)
+
+
+@pytest.mark.parametrize('build_graph', [inverted_index_graph, pmi_graph])
+def test_shared_prefix_runs_once(sample_document_data, build_graph):
+    graph = build_graph(input_stream_name="data")
+    docs = sample_document_data * 20
+    pulls = []
+
+    def source():
+        pulls.append(1)
+        return iter(docs)
+
+    result = list(graph.run(data=source))
+    assert len(pulls) == 1
+    graph.optimize = False
+    assert result == list(graph.run(data=source))
+
+
+def test_shared_stream_spills_to_graph_tmp_dir(sample_document_data, tmp_path, monkeypatch):
+    spill_dirs = []
+    mkstemp = tempfile.mkstemp
+
+    def recording_mkstemp(*args, **kwargs):
+        spill_dirs.append(kwargs.get('dir'))
+        return mkstemp(*args, **kwargs)
+
+    monkeypatch.setattr(tempfile, 'mkstemp', recording_mkstemp)
+    graph = inverted_index_graph(input_stream_name="data")
+    docs = sample_document_data * 2000
+    expected = list(graph.run(data=lambda: iter(docs)))
+    assert str(tmp_path) not in spill_dirs
+    graph.tee_memory_limit = 1
+    graph.tee_tmp_dir = str(tmp_path)
+    assert list(graph.run(data=lambda: iter(docs))) == expected
+    assert str(tmp_path) in spill_dirs
+
+
+@pytest.mark.parametrize('build_graph', [word_count_graph, inverted_index_graph, pmi_graph])
+def test_compact_rows_give_same_result(sample_document_data, build_graph):
+    graph = build_graph(input_stream_name="data")
+    expected = list(graph.run(data=lambda: iter(sample_document_data)))
+    graph.compact_rows = True
+    result = list(graph.run(data=lambda: iter(sample_document_data)))
+    assert result == expected
+    assert all(type(row) is dict for row in result)
+
+
+def test_compact_rows_leave_graph_as_dicts(sample_document_data):
+    graph = Graph.graph_from_iter('data', schema=['doc_id', 'text']).sort(['text'])
+    result = list(graph.run(data=lambda: iter(sample_document_data)))
+    assert result == sorted(sample_document_data, key=lambda row: row['text'])
+    assert all(type(row) is dict for row in result)
+
+
+def test_declared_schema(sample_document_data):
+    graph = Graph.graph_from_iter('data', schema=['doc_id', 'text']) \
+        .sort(['text']) \
+        .reduce(ops.Count('count'), ['text'])
+    rows = [{'text': row['text'], 'doc_id': row['doc_id']} for row in sample_document_data]
+    expected = list(Graph.graph_from_iter('data').sort(['text']).reduce(ops.Count('count'), ['text'])
+                    .run(data=lambda: iter(rows)))
+    assert list(graph.run(data=lambda: iter(rows))) == expected
+    with pytest.raises(ValueError):
+        list(graph.run(data=lambda: iter([{'doc_id': 1, 'text': 'a', 'extra': 2}])))
+
+
+def test_interned_tokens_are_sent_once_per_batch():
+    docs = [{'doc_id': index, 'text': ' '.join(['alpha', 'beta', 'gamma'] * 50)} for index in range(20)]
+    sent_bytes = []
+    results = []
+    for intern_tokens in (False, True):
+        graph = Graph.graph_from_iter('data') \
+            .map(ops.NormalizeText('text', intern_tokens=intern_tokens)) \
+            .sort(['text'])
+        results.append(list(graph.run(data=lambda: iter(docs))))
+        sent_bytes.append(graph.operations[-1].stats.bytes_sent)
+    assert results[0] == results[1]
+    assert sent_bytes[1] < sent_bytes[0] * 0.9
+
+
+def test_dictionary_codes_are_sorted_instead_of_words():
+    docs = [{'doc_id': index, 'text': ' '.join(f'word{number}' for number in range(300))} for index in range(20)]
+    sent_bytes = []
+    results = []
+    for dictionary in (None, ops.ValueDictionary()):
+        graph = Graph.graph_from_iter('data') \
+            .map(ops.NormalizeText('text', dictionary=dictionary)) \
+            .sort(['text'])
+        if dictionary is not None:
+            graph = graph.map(ops.DecodeColumn('text', dictionary))
+        results.append(list(graph.run(data=lambda: iter(docs))))
+        sort = next(operation for operation in graph.operations if isinstance(operation, ExternalSort))
+        sent_bytes.append(sort.stats.bytes_sent)
+    assert sorted(results[0], key=lambda row: (row['text'], row['doc_id'])) == \
+        sorted(results[1], key=lambda row: (row['text'], row['doc_id']))
+    assert sent_bytes[1] < sent_bytes[0] * 0.8
@@ -1,5 +1,9 @@
 # mypy: ignore-errors
 
+import datetime
+import pickle
+import sys
+
 import pytest
 from compgraph import operations as ops
 from pytest import approx
@@ -143,3 +147,128 @@ def test_calculate_hour(data, expected):
     result = [list(mapper(row))[0] for row in data]
     for r, e in zip(result, expected):
         assert r['hour'] == e['hour']
+
+
+def test_parsed_timestamp_is_accepted_by_time_functions():
+    row = {'enter_time': '20220101T235930.500000', 'leave_time': '20220102T000010.000000'}
+    parsed = list(ops.FusedMap([ops.ParseTimestamp('enter_time'), ops.ParseTimestamp('leave_time', 'leave')])(
+        [row]))[0]
+    assert parsed['enter_time'] == datetime.datetime(2022, 1, 1, 23, 59, 30, 500000)
+    assert parsed['leave_time'] == row['leave_time'] and isinstance(parsed['leave'], datetime.datetime)
+    assert ops.road_time(parsed, 'enter_time', 'leave') == ops.road_time(row, 'enter_time', 'leave_time') == 39.5
+    assert ops.hour(parsed, 'enter_time') == ops.hour(row, 'enter_time') == 23
+    assert ops.weekday(parsed, 'leave') == ops.weekday(row, 'leave_time') == 'Sun'
+    assert ops.parse_timestamp(row['enter_time']) is ops.parse_timestamp(row['enter_time'])
+
+
+HASH_REDUCE_ROWS = [{'word': f'w{(i * 7) % 13}', 'doc': i % 3, 'n': i} for i in range(500)]
+
+
+@pytest.mark.parametrize('reducer, keys', [
+    (ops.Count('count'), ('word',)),
+    (ops.Sum('n'), ('word', 'doc')),
+    (ops.Average('n'), ('doc',)),
+    (ops.TopN('n', 2), ('word',)),
+    (ops.FirstReducer(), ('doc', 'word')),
+    (ops.TermFrequency('word'), ('doc',)),
+])
+@pytest.mark.parametrize('memory_limit', [10 ** 9, 2000])
+def test_hash_reduce_matches_sorted_reduce(reducer, keys, memory_limit, tmp_path):
+    def sort_key(row):
+        return tuple(sorted((k, str(v)) for k, v in row.items()))
+
+    sorted_rows = sorted(HASH_REDUCE_ROWS, key=lambda row: tuple(row[key] for key in keys))
+    expected = sorted(ops.Reduce(reducer, keys)(sorted_rows), key=sort_key)
+    operation = ops.HashReduce(reducer, keys, memory_limit=memory_limit, partitions=3, tmp_dir=str(tmp_path))
+    assert sorted(operation(iter(HASH_REDUCE_ROWS)), key=sort_key) == expected
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_hash_reduce_keeps_first_appearance_order():
+    rows = [{'k': 'b'}, {'k': 'a'}, {'k': 'b'}, {'k': 'c'}, {'k': 'a'}]
+    result = list(ops.HashReduce(ops.Count('count'), ['k'])(iter(rows)))
+    assert result == [{'k': 'b', 'count': 2}, {'k': 'a', 'count': 2}, {'k': 'c', 'count': 1}]
+
+
+def test_overlay_row_behaves_as_dict():
+    parent = {'a': 1, 'b': 2}
+    row = ops.OverlayRow(parent)
+    row['c'] = 3
+    row['a'] = 10
+    del row['b']
+    assert row == {'a': 10, 'c': 3} and list(row) == ['a', 'c'] and 'b' not in row
+    assert parent == {'a': 1, 'b': 2}
+    nested = ops.OverlayRow(row, {'b': 4})
+    assert nested == {'a': 10, 'b': 4, 'c': 3} and row == {'a': 10, 'c': 3}
+    copied = pickle.loads(pickle.dumps([nested, row]))
+    assert copied == [nested, row] and copied[0]._parent is copied[1]._parent
+    with pytest.raises(KeyError):
+        del row['b']
+
+
+def test_compact_row_behaves_as_dict():
+    schema = ops.Schema(['a', 'b', 'c'])
+    row = schema.record({'c': 3, 'a': 1, 'b': 2})
+    assert row == {'a': 1, 'b': 2, 'c': 3} and list(row) == ['a', 'b', 'c'] and 'd' not in row
+    assert row.get('d', 0) == 0 and ops.key_function(['c', 'a'])(row) == (3, 1) == \
+        ops.key_function(['c', 'a'])({'a': 1, 'c': 3})
+    assert ops.key_function(['b'])(row) == (2,) and ops.key_function([])(row) == ()
+    changed = ops.OverlayRow(row, {'b': 20})
+    assert changed == {'a': 1, 'b': 20, 'c': 3} and row['b'] == 2
+    copied = pickle.loads(pickle.dumps([row, changed]))
+    assert copied == [row, changed] and copied[0].schema is copied[1]._parent.schema
+    inferred = list(ops.compact([{'a': 1}, {'b': 2}, {'a': 3}]))
+    assert inferred == [{'a': 1}, {'b': 2}, {'a': 3}] and inferred[0].schema is inferred[2].schema
+    with pytest.raises(KeyError):
+        schema.record({'a': 1, 'b': 2, 'd': 3})
+
+
+@pytest.mark.parametrize('separator', [r'\s+', ';', 'ab', r'[;.]', 'a*'])
+@pytest.mark.parametrize('text', ['', ' ', ';;', 'a', ' a\tb  ', ';a;;b;', 'ab\u00A0abab', 'x ; ' * 5000])
+def test_split_tokens_match_regular_expression(separator, text):
+    split = ops.Split('text', separator, intern_tokens=True)
+    assert list(split.tokens(text)) == list(split._scan(text))
+    result = list(split({'id': 1, 'text': text}))
+    assert result == [{'id': 1, 'text': token} for token in split._scan(text)]
+    assert all(row['text'] is sys.intern(row['text']) for row in result)
+
+
+@pytest.mark.parametrize('text', ['Hello, World! Hello...', ' \tÄrger: İstanbul — ÉTÉ;  ', '', '?!', 12])
+def test_normalize_text_matches_chained_mappers(text):
+    row = {'id': 1, 'text': text}
+    chained = ops.FusedMap([ops.FilterPunctuation('text'), ops.LowerCase('text'), ops.Split('text')])
+    assert list(ops.NormalizeText('text')(row)) == list(chained([row]))
+
+
+
+def test_encode_and_decode_column():
+    words = ops.ValueDictionary()
+    rows = [{'doc_id': index, 'text': word} for index, word in enumerate(['beta', 'alpha', 'beta', 'gamma'])]
+    encoded = [row for source in rows for row in ops.EncodeColumn('text', words)(source)]
+    assert [row['text'] for row in encoded] == [0, 1, 0, 2]
+    assert len(words) == 3
+    decoded = [row for source in encoded for row in ops.DecodeColumn('text', words)(source)]
+    assert [ops.as_dict(row) for row in decoded] == rows
+    assert ops.EncodeColumn('text', words).ordered_by(['doc_id', 'text']) == ('doc_id',)
+    assert ops.DecodeColumn('text', words).ordered_by(['text', 'doc_id']) == ()
+
+
+@pytest.mark.parametrize('repeat', [1, 5000])
+def test_normalize_text_emits_dictionary_codes(repeat):
+    words = ops.ValueDictionary()
+    row = {'doc_id': 1, 'text': 'Hello, World! hello world again ' * repeat}
+    plain = list(ops.NormalizeText('text')(row))
+    encoded = list(ops.NormalizeText('text', dictionary=words)(row))
+    assert [words.decode(row['text']) for row in encoded] == [row['text'] for row in plain]
+    assert [row['text'] for row in encoded[:5]] == [0, 1, 0, 1, 2]
+
+@pytest.mark.parametrize('reducer', [ops.Count('count'), ops.Sum('n'), ops.Average('n')])
+@pytest.mark.parametrize('max_groups', [1, 3, 1000])
+def test_combine_and_merge_partials(reducer, max_groups):
+    keys = ('word',)
+    sorted_rows = sorted(HASH_REDUCE_ROWS, key=lambda row: row['word'])
+    expected = list(ops.Reduce(reducer, keys)(sorted_rows))
+    partial_rows = sorted(ops.Combine(reducer, keys, max_groups)(iter(HASH_REDUCE_ROWS)), key=lambda row: row['word'])
+    assert all(set(row) == {'word', ops.PARTIAL_STATE_COLUMN} for row in partial_rows)
+    result = list(ops.Reduce(ops.MergePartials(reducer), keys)(partial_rows))
+    assert result == [{k: approx(v) if isinstance(v, float) else v for k, v in row.items()} for row in expected]
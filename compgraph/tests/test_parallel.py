@@ -0,0 +1,157 @@
+# mypy: ignore-errors
+
+import json
+import mmap
+import random
+from operator import itemgetter
+
+import pytest
+from compgraph.graph import Graph
+from compgraph.optimizer import stream_ordering
+from compgraph.parallel import ParallelJoin, ParallelMap, ParallelRead, ParallelReduce, line_chunks
+from compgraph import operations as ops
+
+
+@pytest.fixture
+def edges():
+    random.seed(3)
+    return [{'edge_id': i, 'start': [random.uniform(37, 38), random.uniform(55, 56)],
+             'end': [random.uniform(37, 38), random.uniform(55, 56)]} for i in range(2000)]
+
+
+def distance_mapper():
+    return ops.Calculate(ops.haversine_distance, {'start_coords': 'start', 'end_coords': 'end'}, 'length')
+
+
+@pytest.mark.parametrize('batch_size, max_in_flight', [(1, 1), (64, 3), (5000, None)])
+def test_ordered_parallel_map_matches_map(edges, batch_size, max_in_flight):
+    expected = list(ops.Map(distance_mapper())(iter(edges)))
+    result = list(ParallelMap(distance_mapper(), 3, batch_size, max_in_flight=max_in_flight)(iter(edges)))
+    assert result == expected
+
+
+def test_unordered_parallel_map_gives_same_rows():
+    mapper = ops.Split('text', ';')
+    rows = [{'id': i, 'text': ';'.join(['x'] * (i % 7))} for i in range(500)]
+    expected = list(ops.Map(mapper)(iter(rows)))
+    result = list(ParallelMap(mapper, 2, 16, ordered=False)(iter(rows)))
+    assert sorted(map(repr, result)) == sorted(map(repr, expected))
+
+
+def test_parallel_map_window_bounds_read_rows(edges):
+    pulled = []
+
+    def source():
+        for row in edges:
+            pulled.append(1)
+            yield row
+
+    rows = ParallelMap(distance_mapper(), 2, batch_size=10, max_in_flight=3)(source())
+    next(rows)
+    assert len(pulled) <= 3 * 10 + 10
+    rows.close()
+
+
+def test_graph_parallel_map_keeps_ordering(edges):
+    graph = Graph.graph_from_iter('edges') \
+        .sort(['edge_id']) \
+        .map(distance_mapper(), workers=2, batch_size=100) \
+        .sort(['edge_id'])
+    assert isinstance(graph.operations[2], ParallelMap)
+    assert stream_ordering(graph.plan()) == ('edge_id',) and len(graph.plan()) == 3
+    assert [row['length'] for row in graph.run(edges=lambda: iter(edges))] == \
+        [row['length'] for row in ops.Map(distance_mapper())(iter(edges))]
+
+
+@pytest.fixture
+def words():
+    random.seed(5)
+    rows = [{'doc_id': random.randint(0, 30), 'text': f'word_{random.randint(0, 200)}'} for _ in range(3000)]
+    return sorted(rows, key=itemgetter('text'))
+
+
+@pytest.mark.parametrize('reducer', [ops.Count('count'), ops.TermFrequency('doc_id'), ops.TopN('doc_id', 2)])
+def test_parallel_reduce_matches_reduce(words, reducer, tmp_path):
+    expected = list(ops.Reduce(reducer, ['text'])(iter(words)))
+    assert list(ParallelReduce(reducer, ['text'], 3, tmp_dir=str(tmp_path))(iter(words))) == expected
+    assert list(tmp_path.iterdir()) == []
+    shuffled = random.sample(words, len(words))
+    result = list(ParallelReduce(reducer, ['text'], 3, hash_grouping=True)(iter(shuffled)))
+    assert sorted(map(repr, result)) == sorted(map(repr, ops.HashReduce(reducer, ['text'])(iter(shuffled))))
+
+
+@pytest.mark.parametrize('joiner', [ops.InnerJoiner(), ops.OuterJoiner(), ops.LeftJoiner(), ops.RightJoiner()])
+def test_parallel_join_matches_join(words, joiner):
+    counts = list(ops.Reduce(ops.Count('count'), ['text'])(row for row in words if row['doc_id'] % 3))
+    expected = list(ops.Join(joiner, ['text'])(iter(words), iter(counts)))
+    assert list(ParallelJoin(joiner, ['text'], 4)(iter(words), iter(counts))) == expected
+    result = list(ParallelJoin(joiner, ['text'], 4, hash_join=True)(iter(words), iter(counts)))
+    assert sorted(map(repr, result)) == sorted(map(repr, expected))
+
+
+def test_graph_with_parallel_reduce_and_join(words):
+    counts = Graph.graph_from_iter('words').sort(['text']).reduce(ops.Count('count'), ['text'], workers=2)
+    graph = Graph.graph_from_iter('words').sort(['text']).join(ops.InnerJoiner(), counts, ['text'], workers=2) \
+        .sort(['text'])
+    assert [type(operation) for operation in graph.plan()][-1] is ParallelJoin
+    sequential = Graph.graph_from_iter('words').sort(['text']) \
+        .join(ops.InnerJoiner(), Graph.graph_from_iter('words').sort(['text']).reduce(ops.Count('count'), ['text']),
+              ['text'])
+    assert list(graph.run(words=lambda: iter(words))) == list(sequential.run(words=lambda: iter(words)))
+
+
+@pytest.fixture
+def jsonl_file(tmp_path):
+    random.seed(9)
+    path = tmp_path / 'rows.jsonl'
+    rows = [{'id': i, 'text': 'ж' * random.randint(0, 50)} for i in range(3000)]
+    path.write_text(''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in rows[:-1]) + json.dumps(rows[-1]))
+    return str(path)
+
+
+def parse_lines(lines):
+    return [json.loads(line) for line in lines]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 100, 4096, 10 ** 9])
+def test_line_chunks_cut_file_at_line_ends(jsonl_file, chunk_size):
+    with open(jsonl_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        chunks = list(line_chunks(data, chunk_size))
+        assert chunks[0][0] == 0 and chunks[-1][1] == len(data)
+        assert all(end == next_start for (_, end), (next_start, _) in zip(chunks, chunks[1:]))
+        assert all(data[end - 1:end] == b'\n' for _, end in chunks[:-1])
+
+
+@pytest.mark.parametrize('chunk_size, bulk', [(100, False), (4096, True), (10 ** 9, False)])
+def test_ordered_parallel_read_matches_read(jsonl_file, chunk_size, bulk):
+    expected = list(ops.Read(jsonl_file, json.loads)())
+    parser = parse_lines if bulk else json.loads
+    assert list(ParallelRead(jsonl_file, parser, 3, chunk_size, bulk=bulk)()) == expected
+    assert list(ops.Read(jsonl_file, parser, bulk=bulk)()) == expected
+
+
+def test_unordered_parallel_read_gives_same_rows(jsonl_file):
+    expected = list(ops.Read(jsonl_file, json.loads)())
+    result = list(ParallelRead(jsonl_file, json.loads, 3, 1000, ordered=False)())
+    assert sorted(result, key=itemgetter('id')) == expected
+
+
+def line_row(line):
+    return {'line': line}
+
+
+def test_parallel_read_keeps_line_ends(tmp_path):
+    path = tmp_path / 'lines.txt'
+    path.write_bytes(b'a\r\nb\n\nc\r\n' * 100)
+    expected = list(ops.Read(str(path), line_row)())
+    assert list(ParallelRead(str(path), line_row, 2, 7)()) == expected
+    empty = tmp_path / 'empty.txt'
+    empty.write_bytes(b'')
+    assert list(ParallelRead(str(empty), line_row, 2)()) == []
+
+
+def test_graph_from_file_with_workers(jsonl_file):
+    expected = list(Graph.graph_from_file(jsonl_file, json.loads).run())
+    graph = Graph.graph_from_file(jsonl_file, parse_lines, schema=['id', 'text'], workers=2, bulk=True,
+                                  chunk_size=1000)
+    assert list(graph.run()) == expected